@@ -0,0 +1,201 @@
+# analysis_scheduler.py
+# ©2024, Ovais Quraishi
+"""Model-affinity scheduling of analysis work
+
+    Looping through every model in LLMS for every item makes Ollama evict and
+    reload models all day long. Instead, pending work is grouped by model and
+    a model's queue is drained in large batches before moving on to the next
+    model, so each model is loaded once per run.
+"""
+
+import asyncio
+import logging
+import math
+import os
+from collections import deque
+
+# Import required local modules
+import logit
+from config import get_config
+from pipeline import PIPELINE_QUEUE_SIZE
+
+get_config()
+
+ANALYSIS_BATCH_SIZE = int(os.environ.get('ANALYSIS_BATCH_SIZE', 256))
+
+
+class ModelAffinityScheduler:
+    """Per-model queues of work items, served one model at a time
+    """
+
+    def __init__(self, llms, batch_size=ANALYSIS_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.pending = {llm: deque() for llm in llms}
+        self.current_llm = None
+
+    def add(self, work_item):
+        """Queue a work item for every model
+        """
+
+        for queue in self.pending.values():
+            queue.append(work_item)
+
+    def has_pending(self):
+        """True while any model has queued work
+        """
+
+        return any(self.pending.values())
+
+    def next_model(self):
+        """Model to serve next - stick with the current model until its queue is
+            empty, then move on to the model with the most queued work
+        """
+
+        if self.current_llm and self.pending[self.current_llm]:
+            return self.current_llm
+
+        candidates = [llm for llm, queue in self.pending.items() if queue and llm != self.current_llm]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda llm: len(self.pending[llm]))
+
+    def next_batch(self):
+        """Pop the next batch of work items
+
+            Returns:
+                tuple: (llm, list of work items), (None, []) when nothing is pending
+        """
+
+        llm = self.next_model()
+        if llm is None:
+            return None, []
+
+        self.current_llm = llm
+        queue = self.pending[llm]
+        batch = [queue.popleft() for _ in range(min(self.batch_size, len(queue)))]
+        return llm, batch
+
+    def is_last_batch(self):
+        """True when the current model has nothing left after the batch in flight
+        """
+
+        return not self.pending[self.current_llm]
+
+
+class ModelAffinityQueue:
+    """asyncio front end of ModelAffinityScheduler, used as the input queue of
+        the pipeline prompt stage
+
+        get() keeps returning work for the current model, waiting for more
+        rather than switching, until the producer has closed the queue and the
+        current model's work is drained, or the queue is full of other models'
+        work. on_drained(llm, next_llm) is called once the last item of a
+        model has been handed out, or when get() moves on to another model.
+
+        Every work item is queued once per model, put() waits while maxsize
+        entries are queued - by default PIPELINE_QUEUE_SIZE per model.
+    """
+
+    def __init__(self, llms, on_drained=None, maxsize=None):
+        self.scheduler = ModelAffinityScheduler(llms, batch_size=1)
+        self.on_drained = on_drained
+        self.maxsize = maxsize or PIPELINE_QUEUE_SIZE * len(llms)
+        self.closed = False
+        self.changed = asyncio.Condition()
+
+    def full(self):
+        return self.qsize() >= self.maxsize
+
+    async def put(self, work_item):
+        async with self.changed:
+            while self.full():
+                await self.changed.wait()
+            self.scheduler.add(work_item)
+            self.changed.notify_all()
+
+    async def close(self):
+        async with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+
+    async def get(self):
+        """Next (llm, work item), None once closed and drained
+        """
+
+        async with self.changed:
+            while True:
+                llm = self.scheduler.current_llm
+                if llm is None or not self.scheduler.pending[llm]:
+                    if not self.closed and llm is not None and not self.full():
+                        # more work for the current model may still arrive
+                        await self.changed.wait()
+                        continue
+                    previous_llm = llm
+                    llm, batch = self.scheduler.next_batch()
+                    if llm is None:
+                        if self.closed:
+                            return None
+                        await self.changed.wait()
+                        continue
+                    work_item = batch[0]
+                    if not self.closed and previous_llm not in (None, llm) and self.on_drained:
+                        # the queue filled up with the other models' work
+                        self.on_drained(previous_llm, llm)
+                else:
+                    work_item = self.scheduler.pending[llm].popleft()
+
+                if self.closed and self.scheduler.is_last_batch() and self.on_drained:
+                    self.on_drained(llm, self.scheduler.next_model())
+                # a producer may be waiting for room
+                self.changed.notify_all()
+                return llm, work_item
+
+    def qsize(self):
+        return sum(len(queue) for queue in self.scheduler.pending.values())
+
+    def pending(self, llm):
+        return len(self.scheduler.pending[llm])
+
+    def drained(self, llm):
+        """True once no more work for llm will be handed out
+        """
+
+        return self.closed and not self.scheduler.pending[llm]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile, 0.0 for no values
+    """
+
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+def report_batch(llm, batch_size, batch_stats, wall_time):
+    """Log load time versus eval time for a batch of prompts of one model
+
+        batch_stats is a list of prompt completion stats, None for prompts that
+        were answered from the prompt cache.
+    """
+
+    completed = [stats for stats in batch_stats if stats]
+    completion_times = [s['prompt_completion_time'] for s in completed]
+    report = {
+              'llm' : llm,
+              'items' : batch_size,
+              'prompted' : len(completed),
+              'cached' : batch_size - len(completed),
+              'wall_time' : round(wall_time, 3),
+              'load_duration' : round(sum(s['load_duration'] for s in completed), 3),
+              'prompt_eval_duration' : round(sum(s['prompt_eval_duration'] for s in completed), 3),
+              'eval_duration' : round(sum(s['eval_duration'] for s in completed), 3),
+              'p50_prompt_completion_time' : round(percentile(completion_times, 50), 3),
+              'p95_prompt_completion_time' : round(percentile(completion_times, 95), 3)
+             }
+
+    info_message = f'Analysis batch {report}'
+    logging.info(info_message)
+    logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'INFO', info_message)
+    return report
@@ -0,0 +1,218 @@
+# authors.py
+# ©2024, Ovais Quraishi
+"""Batched author lookups
+"""
+
+import asyncio
+import logging
+import os
+
+import redis
+from asyncprawcore import exceptions as async_exceptions
+from prawcore import exceptions
+
+# Import required local modules
+import logit
+from cache import add_key, redis_client
+from config import get_config
+from database import get_existing_ids, insert_rows_into_table
+from reddit_api import RedditPoolExhausted
+
+get_config()
+
+# the user data endpoint takes at most 100 ids
+AUTHOR_BATCH_SIZE = min(int(os.environ.get('AUTHOR_BATCH_SIZE', 100)), 100)
+AUTHOR_NEGATIVE_TTL = int(os.environ.get('AUTHOR_NEGATIVE_TTL', 604800))
+
+USER_DATA_PATH = 'api/user_data_by_account_ids'
+MISSING_PREFIX = 'author_missing:'
+
+
+def author_row(author_id, author_name, author_created_utc):
+    return {
+            'author_id': author_id,
+            'author_name': author_name,
+            'author_created_utc': int(author_created_utc),
+           }
+
+def missing_authors(names):
+    """Subset of names marked missing within AUTHOR_NEGATIVE_TTL
+    """
+
+    names = list(names)
+    try:
+        pipe = redis_client().pipeline()
+        for name in names:
+            pipe.exists(MISSING_PREFIX + name)
+        return {name for name, exists in zip(names, pipe.execute()) if exists}
+    except redis.exceptions.RedisError as e:
+        logging.warning('Unable to read missing authors %s', e)
+        return set()
+
+def mark_missing(names):
+    """Remember suspended and deleted authors, so they are not looked up again
+        for AUTHOR_NEGATIVE_TTL seconds
+    """
+
+    if not names:
+        return
+    try:
+        pipe = redis_client().pipeline()
+        for name in names:
+            pipe.set(MISSING_PREFIX + name, 1, ex=AUTHOR_NEGATIVE_TTL)
+        pipe.execute()
+    except redis.exceptions.RedisError as e:
+        logging.warning('Unable to mark missing authors %s', e)
+
+    for name in names:
+        # store this for later inspection, get_authors_comments skips these
+        add_key('author_id_' + name)
+    warn_message = f'AUTHORS suspended or deleted {names}'
+    logging.warning(warn_message)
+    logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'WARNING', warn_message)
+
+def chunked(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class AuthorResolver:
+    """Authors of one run, resolved in batches
+    """
+
+    def __init__(self, batch_size=AUTHOR_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.seen = set()
+        self.pending = {}
+        self.written = 0
+        self.missing = 0
+        self.lookups = 0
+
+    def add(self, author_name, author_fullname=None):
+        """Queue an author, once per resolver
+
+            Returns:
+                bool: True once a batch is due
+        """
+
+        if author_name and author_name != 'AutoModerator' and author_name not in self.seen:
+            self.seen.add(author_name)
+            self.pending[author_name] = author_fullname
+        return len(self.pending) >= self.batch_size
+
+    def take(self):
+        """Queued authors, the queue is emptied
+        """
+
+        pending, self.pending = self.pending, {}
+        return pending
+
+    def unknown(self, pending):
+        """Queued authors neither stored nor marked missing
+
+            Returns:
+                tuple: ({fullname: name}, [names without a fullname])
+        """
+
+        if not pending:
+            return {}, []
+        known = get_existing_ids('authors', 'author_name', pending) | missing_authors(pending)
+        by_fullname = {fullname : name for name, fullname in pending.items() if fullname and name not in known}
+        names = [name for name, fullname in pending.items() if not fullname and name not in known]
+        return by_fullname, names
+
+    def rows(self, by_fullname, user_data):
+        """authors rows of a user data answer, and the names it left out
+        """
+
+        rows, missing = [], []
+        for fullname, name in by_fullname.items():
+            data = user_data.get(fullname) or {}
+            # suspended accounts come back without account details, deleted
+            #  ones not at all
+            if data.get('is_suspended') or 'created_utc' not in data:
+                missing.append(name)
+            else:
+                rows.append(author_row(fullname.split('_', 1)[1], data.get('name', name), data['created_utc']))
+        return rows, missing
+
+    def record(self, rows, missing):
+        self.written += insert_rows_into_table('authors', rows)
+        mark_missing(missing)
+        self.missing += len(missing)
+
+    def lookup_failed(self, names, error):
+        # not marked missing, the next run tries them again
+        error_message = f'Unable to look up authors {names} {error}'
+        logging.error(error_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'ERROR', error_message)
+
+    def flush(self, reddit):
+        """Resolve the queued authors with a praw Reddit instance
+        """
+
+        by_fullname, names = self.unknown(self.take())
+        rows, missing = [], []
+        for fullnames in chunked(by_fullname, self.batch_size):
+            chunk = {fullname : by_fullname[fullname] for fullname in fullnames}
+            self.lookups += 1
+            try:
+                user_data = reddit.request(method='GET', path=USER_DATA_PATH, params={'ids' : ','.join(chunk)})
+            except exceptions.PrawcoreException as e:
+                self.lookup_failed(list(chunk.values()), e)
+                continue
+            chunk_rows, chunk_missing = self.rows(chunk, user_data)
+            rows += chunk_rows
+            missing += chunk_missing
+
+        for name in names:
+            self.lookups += 1
+            try:
+                author = reddit.redditor(name)
+                rows.append(author_row(author.id, author.name, author.created_utc))
+            except (AttributeError, exceptions.NotFound, exceptions.Forbidden):
+                missing.append(name)
+            except exceptions.PrawcoreException as e:
+                self.lookup_failed([name], e)
+
+        self.record(rows, missing)
+
+    async def flush_async(self, call, budget=None):
+        """Resolve the queued authors, call awaits func(reddit) on an
+            asyncpraw Reddit instance - e.g. Ingestion.with_failover - spending
+            from budget, a RateBudget, per request
+        """
+
+        pending = self.take()
+        by_fullname, names = await asyncio.to_thread(self.unknown, pending)
+        rows, missing = [], []
+        for fullnames in chunked(by_fullname, self.batch_size):
+            chunk = {fullname : by_fullname[fullname] for fullname in fullnames}
+            if budget:
+                await budget.spend()
+            self.lookups += 1
+            try:
+                user_data = await call(lambda reddit: reddit.request(method='GET',
+                                                                     path=USER_DATA_PATH,
+                                                                     params={'ids' : ','.join(chunk)}))
+            except (async_exceptions.AsyncPrawcoreException, RedditPoolExhausted) as e:
+                self.lookup_failed(list(chunk.values()), e)
+                continue
+            chunk_rows, chunk_missing = self.rows(chunk, user_data)
+            rows += chunk_rows
+            missing += chunk_missing
+
+        for name in names:
+            if budget:
+                await budget.spend()
+            self.lookups += 1
+            try:
+                author = await call(lambda reddit: reddit.redditor(name, fetch=True))
+                rows.append(author_row(author.id, author.name, author.created_utc))
+            except (AttributeError, async_exceptions.NotFound, async_exceptions.Forbidden):
+                missing.append(name)
+            except (async_exceptions.AsyncPrawcoreException, RedditPoolExhausted) as e:
+                self.lookup_failed([name], e)
+
+        await asyncio.to_thread(self.record, rows, missing)
@@ -0,0 +1,156 @@
+# comment_tree.py
+# ©2024, Ovais Quraishi
+"""Parent-child trees of comment threads
+
+    A tree is stored in parent_child_tree_data in a compact, canonical
+    encoding - comment ids in a fixed order and, for each, the index of its
+    parent, -1 for comments on the post itself:
+
+        {"format": "parents", "ids": ["k1", "k2", "k3"], "parents": [-1, 0, 0]}
+
+    Each comment has one parent, so merging newly seen comments into a stored
+    tree is a dict update, and the same tree always encodes, and so hashes,
+    the same way. A tree that did not change is not stored again. Trees
+    stored before, as {parent id: [child ids]}, are still read.
+
+    thread() rebuilds the nested thread of a post from its stored tree and
+    the stored comments, without going back to Reddit.
+"""
+
+import hashlib
+import json
+
+# Import required local modules
+from config import get_config
+from database import get_select_query_result_dicts
+from utils import unix_ts_str
+
+get_config()
+
+TREE_FORMAT = 'parents'
+# parent of a comment made on the post itself
+ROOT = None
+
+
+def parent_of(parent_fullname):
+    """Parent comment id of a parent fullname, ROOT for the post
+    """
+
+    kind, parent_id = parent_fullname.split('_', 1)
+    # t1_ parents are comments, t3_ the post itself
+    return parent_id if kind == 't1' else ROOT
+
+def decode_tree(parent_child_tree):
+    """{comment id: parent comment id or ROOT} of a stored tree
+    """
+
+    if not parent_child_tree:
+        return {}
+    if parent_child_tree.get('format') == TREE_FORMAT:
+        ids = parent_child_tree['ids']
+        return {comment_id : (ids[parent] if parent >= 0 else ROOT)
+                for comment_id, parent in zip(ids, parent_child_tree['parents'])}
+    # {parent id: [child ids]}, as stored before - it has no top level comments
+    return {child : parent for parent, children in parent_child_tree.items() for child in children}
+
+def id_order(comment_id):
+    # base36 ids, shorter ones are older
+    return len(comment_id), comment_id
+
+def encode_tree(parents):
+    """Canonical compact encoding of {comment id: parent comment id or ROOT}
+    """
+
+    # a parent that is not in the tree itself, e.g. of an old format tree,
+    #  gets an entry of its own
+    ids = sorted(set(parents) | {p for p in parents.values() if p is not ROOT}, key=id_order)
+    index = {comment_id : i for i, comment_id in enumerate(ids)}
+    return {
+            'format' : TREE_FORMAT,
+            'ids' : ids,
+            'parents' : [index[parents[comment_id]] if parents.get(comment_id) is not ROOT else -1 for comment_id in ids]
+           }
+
+def tree_digest(encoded_tree):
+    return hashlib.sha256(json.dumps(encoded_tree, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+def parent_child_tree_row(post_id, edges, stored=None):
+    """parent_child_tree_data row of the comments of a post, None if the tree
+        did not change
+
+        edges are (comment id, parent fullname) pairs, merged into stored,
+        the row stored last, if given
+    """
+
+    parents = decode_tree(stored['parent_child_tree']) if stored else {}
+    changed = not stored
+    for comment_id, parent_fullname in edges:
+        parent = parent_of(parent_fullname)
+        if comment_id not in parents or parents[comment_id] != parent:
+            parents[comment_id] = parent
+            changed = True
+    if not changed:
+        return None
+
+    encoded_tree = encode_tree(parents)
+    shasum256 = tree_digest(encoded_tree)
+    if stored and stored['shasum256'] == shasum256:
+        return None
+
+    return {
+            'timestamp' : unix_ts_str(), #string
+            'shasum256' : shasum256, #string
+            'post_id' : post_id, #string
+            'parent_child_tree' : json.dumps(encoded_tree, separators=(',', ':')) #json
+           }
+
+def nest(parents, comments):
+    """Nested thread of a parent map, replies oldest first
+
+        comments maps comment ids to their stored rows, comments that are not
+        stored keep only their id
+    """
+
+    replies = {}
+    for comment_id, parent in parents.items():
+        replies.setdefault(parent, []).append(comment_id)
+
+    def node(comment_id):
+        return {**comments.get(comment_id, {'comment_id' : comment_id}), 'replies' : []}
+
+    nodes = {comment_id : node(comment_id) for comment_id in parents}
+    for parent, children in replies.items():
+        children.sort(key=lambda c: (nodes[c].get('comment_created_utc') or 0, id_order(c)))
+        if parent is not ROOT:
+            nodes.setdefault(parent, node(parent))['replies'] = [nodes[c] for c in children]
+
+    roots = replies.get(ROOT, [])
+    # old format trees have no top level comments, their topmost parents
+    #  stand in
+    roots += sorted((c for c in nodes if c not in parents), key=id_order)
+    return [nodes[c] for c in roots]
+
+def thread(post_id):
+    """Comment thread of a post from its stored tree, None if it has none
+    """
+
+    rows = get_select_query_result_dicts("""SELECT shasum256, parent_child_tree, timestamp
+                                            FROM parent_child_tree_data
+                                            WHERE post_id = %s
+                                            ORDER BY id DESC
+                                            LIMIT 1;""", (post_id,))
+    if not rows:
+        return None
+
+    parents = decode_tree(rows[0]['parent_child_tree'])
+    comment_ids = set(parents) | {p for p in parents.values() if p is not ROOT}
+    comments = get_select_query_result_dicts("""SELECT comment_id, comment_author, comment_body,
+                                                       comment_created_utc, comment_upvote_count
+                                                FROM comments
+                                                WHERE comment_id = ANY(%s);""", (list(comment_ids),))
+    return {
+            'post_id' : post_id,
+            'tree_timestamp' : rows[0]['timestamp'],
+            'comments' : len(comment_ids),
+            'thread' : nest(parents, {c['comment_id'] : c for c in comments})
+           }
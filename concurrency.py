@@ -0,0 +1,136 @@
+# concurrency.py
+# ©2024, Ovais Quraishi
+"""Adaptive concurrency control for prompt dispatch
+
+    The right number of in-flight prompts depends on the model, the Ollama host
+    and the prompt length, so rather than a hand tuned PROC_WORKERS, the limit
+    per (llm, host) is found AIMD style: additive increase while completions
+    meet the latency SLO and tokens/sec target, multiplicative decrease when
+    they do not.
+"""
+
+import asyncio
+import datetime
+import logging
+import os
+from collections import deque
+
+# Import required local modules
+import logit
+from config import get_config
+
+get_config()
+
+CONCURRENCY_MIN = int(os.environ.get('CONCURRENCY_MIN', 1))
+CONCURRENCY_MAX = int(os.environ.get('CONCURRENCY_MAX', os.environ.get('PROC_WORKERS', 4)))
+CONCURRENCY_INITIAL = int(os.environ.get('CONCURRENCY_INITIAL', CONCURRENCY_MIN))
+# seconds a single prompt may take to complete
+CONCURRENCY_LATENCY_SLO = float(os.environ.get('CONCURRENCY_LATENCY_SLO', 120))
+# tokens/sec a single prompt should at least see
+CONCURRENCY_MIN_TPS = float(os.environ.get('CONCURRENCY_MIN_TPS', 5))
+CONCURRENCY_DECREASE_FACTOR = float(os.environ.get('CONCURRENCY_DECREASE_FACTOR', 0.5))
+CONCURRENCY_LOG_SIZE = int(os.environ.get('CONCURRENCY_LOG_SIZE', 1000))
+
+
+class AIMDController:
+    """Per (llm, host) in-flight prompt limits
+    """
+
+    def __init__(self,
+                 min_limit=CONCURRENCY_MIN,
+                 max_limit=CONCURRENCY_MAX,
+                 initial_limit=CONCURRENCY_INITIAL,
+                 latency_slo=CONCURRENCY_LATENCY_SLO,
+                 min_tokens_per_second=CONCURRENCY_MIN_TPS):
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.initial_limit = min(max(initial_limit, min_limit), self.max_limit)
+        self.latency_slo = latency_slo
+        self.min_tokens_per_second = min_tokens_per_second
+        self.limits = {}
+        # completions seen since the last decrease, one decrease per window
+        self.since_decrease = {}
+        self.decisions = deque(maxlen=CONCURRENCY_LOG_SIZE)
+
+    def limit(self, llm, host):
+        """Number of prompts allowed in flight
+        """
+
+        return int(self.limits.get((llm, host), self.initial_limit))
+
+    def observe(self, llm, host, completion_time, tokens_per_second):
+        """Adjust the limit from a completed prompt
+        """
+
+        key = (llm, host)
+        old_limit = self.limits.get(key, self.initial_limit)
+        self.since_decrease[key] = self.since_decrease.get(key, 0) + 1
+
+        if completion_time > self.latency_slo or tokens_per_second < self.min_tokens_per_second:
+            # prompts completed in the window before the last decrease were
+            #  already in flight at the old limit, do not punish them twice
+            if self.since_decrease[key] < old_limit:
+                return
+            new_limit = max(old_limit * CONCURRENCY_DECREASE_FACTOR, self.min_limit)
+            self.since_decrease[key] = 0
+            action = 'decrease'
+        else:
+            # +1 for every limit worth of completions
+            new_limit = min(old_limit + 1 / old_limit, self.max_limit)
+            action = 'increase'
+
+        self.limits[key] = new_limit
+        if int(new_limit) != int(old_limit):
+            self.log_decision(llm, host, action, int(old_limit), int(new_limit), completion_time, tokens_per_second)
+
+    def log_decision(self, llm, host, action, old_limit, new_limit, completion_time, tokens_per_second):
+        """Keep a record of limit changes
+        """
+
+        decision = {
+                    'timestamp' : datetime.datetime.now(tz=datetime.timezone.utc).isoformat(timespec='seconds'),
+                    'llm' : llm,
+                    'host' : host,
+                    'action' : action,
+                    'old_limit' : old_limit,
+                    'new_limit' : new_limit,
+                    'completion_time' : round(completion_time, 3),
+                    'tokens_per_second' : round(tokens_per_second, 3)
+                   }
+        self.decisions.append(decision)
+
+        info_message = f'Concurrency {decision}'
+        logging.info(info_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'INFO', info_message)
+
+    def decision_log(self):
+        """Most recent limit changes, oldest first
+        """
+
+        return list(self.decisions)
+
+
+class AdaptiveLimiter:
+    """asyncio gate that lets as many prompts per (llm, host) in flight as the
+        controller allows, and feeds completions back to the controller
+    """
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.in_flight = {}
+        self.changed = asyncio.Condition()
+
+    async def acquire(self, llm, host):
+        key = (llm, host)
+        async with self.changed:
+            while self.in_flight.get(key, 0) >= self.controller.limit(llm, host):
+                await self.changed.wait()
+            self.in_flight[key] = self.in_flight.get(key, 0) + 1
+
+    async def release(self, llm, host, completion_time=None, tokens_per_second=None):
+        key = (llm, host)
+        async with self.changed:
+            self.in_flight[key] -= 1
+            if completion_time is not None:
+                self.controller.observe(llm, host, completion_time, tokens_per_second)
+            self.changed.notify_all()
@@ -21,6 +21,9 @@ def read_config(file_path):
         config_obj.read(file_path)
         # Loop through each section in the config file
         for section_name, options in config_obj.items():
+            # [reddit:<name>] accounts would clobber [reddit], see reddit_api.py
+            if ':' in section_name:
+                continue
             # Loop through each option in the current section
             for option_name, option_value in options.items():
                 # Set an environment variable with the option name and value
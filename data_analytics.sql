@@ -208,3 +208,45 @@ FROM
 GROUP BY DATE_TRUNC('day', date)
 ORDER BY "SUM(total_tokens_per_request)" DESC
 LIMIT 30;
+
+--Time to first token, load, prompt eval and eval durations per model
+SELECT model AS model,
+       AVG(time_to_first_token) AS "AVG(time_to_first_token)",
+       AVG(load_duration) AS "AVG(load_duration)",
+       AVG(prompt_eval_duration) AS "AVG(prompt_eval_duration)",
+       AVG(eval_duration) AS "AVG(eval_duration)",
+       SUM(CASE WHEN completion_truncated THEN 1 ELSE 0 END) AS "SUM(completion_truncated)"
+FROM public.prompt_completion_details
+WHERE created_at >= NOW() - INTERVAL '7 days'
+GROUP BY model
+ORDER BY "AVG(time_to_first_token)" DESC;
+
+--Prompts that paid for a model load, and preload/unload events, per model per day
+SELECT DATE_TRUNC('day', pcd.created_at) AS date,
+       pcd.model AS model,
+       COUNT(*) AS "COUNT(prompts)",
+       SUM(CASE WHEN pcd.load_duration > 1 THEN 1 ELSE 0 END) AS "SUM(prompts_with_load)",
+       MAX(pcd.load_duration) AS "MAX(load_duration)",
+       (SELECT COUNT(*) FROM public.model_residency_events mre
+        WHERE mre.llm = pcd.model AND mre.event = 'preload'
+        AND DATE_TRUNC('day', mre.created_at) = DATE_TRUNC('day', pcd.created_at)) AS "COUNT(preloads)",
+       (SELECT AVG(mre.load_duration) FROM public.model_residency_events mre
+        WHERE mre.llm = pcd.model AND mre.event = 'preload'
+        AND DATE_TRUNC('day', mre.created_at) = DATE_TRUNC('day', pcd.created_at)) AS "AVG(preload_duration)"
+FROM public.prompt_completion_details pcd
+WHERE pcd.created_at >= NOW() - INTERVAL '30 days'
+GROUP BY DATE_TRUNC('day', pcd.created_at), pcd.model
+ORDER BY date DESC, model;
+
+--Answer relevancy score per model per week, as judged offline
+SELECT DATE_TRUNC('week', ad."timestamp") AS week,
+       ae.llm AS llm,
+       ae.judge AS judge,
+       COUNT(*) AS "COUNT(evaluations)",
+       AVG(ae.score) AS "AVG(score)",
+       SUM(CASE WHEN ae.success THEN 1 ELSE 0 END)::float / COUNT(*) AS "RATIO(success)"
+FROM public.analysis_evaluations ae
+JOIN public.analysis_documents ad ON ad.shasum_512 = ae.shasum_512
+WHERE ae.metric = 'answer_relevancy'
+GROUP BY DATE_TRUNC('week', ad."timestamp"), ae.llm, ae.judge
+ORDER BY week DESC, "AVG(score)" DESC;
@@ -7,6 +7,7 @@ import logging
 import os
 import psycopg2
 from psycopg2 import sql
+from psycopg2.extras import execute_values
 import cache
 from config import get_config
 from utils import subtract_lists
@@ -14,6 +15,10 @@ import logit
 
 get_config()
 
+# languages that are analyzed, rows detected as anything else are skipped
+#  und (undetermined) covers links, emoji and the like
+ANALYSIS_LANGUAGES = os.environ.get('ANALYSIS_LANGUAGES', 'en,und').split(',')
+
 def psql_connection(cursorfactory=None):
     """Connect to PostgreSQL server"""
 
@@ -70,6 +75,35 @@ def insert_data_into_table(table_name, data):
         conn.close()
         raise
 
+def insert_rows_into_table(table_name, rows):
+    """Insert many rows into table in a single round trip
+
+        rows is a list of dicts that all have the same keys
+    """
+
+    if not rows:
+        return 0
+
+    conn, cur = psql_connection()
+    try:
+        columns = list(rows[0].keys())
+        sql_query = sql.SQL("""INSERT INTO {} ({}) VALUES %s ON CONFLICT DO NOTHING;""").format(
+            sql.Identifier(table_name),
+            sql.SQL(', ').join(map(sql.Identifier, columns)))
+        execute_values(cur, sql_query.as_string(conn), [[row[column] for column in columns] for row in rows])
+        conn.commit()
+        info_message = f'Inserted {len(rows)} rows into {table_name}'
+        logging.info(info_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'INFO', info_message)
+        return len(rows)
+    except psycopg2.Error as e:
+        error_message = f'{e}'
+        logging.error(error_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'ERROR', error_message)
+        raise
+    finally:
+        conn.close()
+
 def get_select_query_results(sql_query, params=None):
     """Execute a query, return all rows for the query
     """
@@ -161,6 +195,7 @@ def db_get_post_ids():
                 SELECT post_id
                 FROM posts
                 WHERE post_body NOT IN ('', '[removed]', '[deleted]')
+                AND (language IS NULL OR language = ANY(%s))
                 AND NOT EXISTS (
                     SELECT 1
                     FROM analysis_documents
@@ -175,7 +210,7 @@ def db_get_post_ids():
                 );
                 """
 
-    post_ids = get_select_query_results(sql_query)
+    post_ids = get_select_query_results(sql_query, (ANALYSIS_LANGUAGES,))
     if not post_ids:
         warn_message = 'db_get_post_ids(): no post_ids found in DB'
         logging.warning(warn_message)
@@ -200,6 +235,7 @@ def db_get_comment_ids():
                 SELECT comment_id
                 FROM comments
                 WHERE md5(comment_body) NOT IN (md5(''), md5('[removed]'), md5('[deleted]'))
+                AND (language IS NULL OR language = ANY(%s))
                 AND NOT EXISTS (
                     SELECT 1
                     FROM analysis_documents
@@ -210,7 +246,7 @@ def db_get_comment_ids():
                 );
                 """
 
-    comment_ids = get_select_query_results(sql_query)
+    comment_ids = get_select_query_results(sql_query, (ANALYSIS_LANGUAGES,))
     if not comment_ids:
         warn_message = 'db_get_comment_ids(): no post_ids found in DB'
         logging.warning(warn_message)
@@ -224,3 +260,78 @@ def db_get_comment_ids():
     comment_id_list = subtract_lists(comment_id_list, cached_list)
 
     return comment_id_list
+
+def get_existing_ids(table_name, unique_column, ids):
+    """Subset of ids already in table, looked up by key rather than by
+        reading every id in the table
+    """
+
+    if not ids:
+        return set()
+
+    query = sql.SQL("""SELECT {} FROM {} WHERE {} = ANY(%s);""").format(
+        sql.Identifier(unique_column),
+        sql.Identifier(table_name),
+        sql.Identifier(unique_column))
+    conn, cur = psql_connection()
+    try:
+        cur.execute(query, (list(ids),))
+        return {row[0] for row in cur.fetchall()}
+    finally:
+        conn.close()
+
+def db_get_crawl_checkpoint(subreddit):
+    """Newest post seen by the last crawl of a subreddit, None if never crawled
+    """
+
+    sql_query = """SELECT subreddit, newest_fullname, newest_created_utc, last_crawled_at
+                   FROM crawl_checkpoints
+                   WHERE subreddit = %s;"""
+    rows = get_select_query_result_dicts(sql_query, (subreddit,))
+    return rows[0] if rows else None
+
+def db_update_crawl_checkpoint(subreddit, newest_fullname, newest_created_utc, new_posts, pages):
+    """Move a subreddit's crawl checkpoint forward, never back
+    """
+
+    sql_query = """INSERT INTO crawl_checkpoints
+                       (subreddit, newest_fullname, newest_created_utc, last_crawled_at, last_new_posts, last_pages)
+                   VALUES (%s, %s, %s, now(), %s, %s)
+                   ON CONFLICT (subreddit) DO UPDATE SET
+                       newest_fullname = CASE WHEN EXCLUDED.newest_created_utc >= crawl_checkpoints.newest_created_utc
+                                              THEN EXCLUDED.newest_fullname ELSE crawl_checkpoints.newest_fullname END,
+                       newest_created_utc = GREATEST(EXCLUDED.newest_created_utc, crawl_checkpoints.newest_created_utc),
+                       last_crawled_at = EXCLUDED.last_crawled_at,
+                       last_new_posts = EXCLUDED.last_new_posts,
+                       last_pages = EXCLUDED.last_pages;"""
+    conn, cur = psql_connection()
+    try:
+        cur.execute(sql_query, (subreddit, newest_fullname, newest_created_utc, new_posts, pages))
+        conn.commit()
+    except psycopg2.Error as e:
+        error_message = f'{e}'
+        logging.error(error_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'ERROR', error_message)
+        raise
+    finally:
+        conn.close()
+
+def db_get_post_comment_ids(post_id):
+    """Ids of the stored comments of a post
+    """
+
+    rows = get_select_query_results('SELECT comment_id FROM comments WHERE post_id = %s;', (post_id,))
+    return {row[0] for row in rows}
+
+def db_get_parent_child_tree(post_id):
+    """Latest stored parent-child tree row of a post's comments, shasum256
+        and parent_child_tree, None if none
+    """
+
+    sql_query = """SELECT shasum256, parent_child_tree
+                   FROM parent_child_tree_data
+                   WHERE post_id = %s
+                   ORDER BY id DESC
+                   LIMIT 1;"""
+    rows = get_select_query_result_dicts(sql_query, (post_id,))
+    return rows[0] if rows else None
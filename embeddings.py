@@ -0,0 +1,386 @@
+# embeddings.py
+# ©2024, Ovais Quraishi
+"""Embeddings and vector similarity index for posts and comments
+
+    Post and comment bodies are embedded in batches by Ollama's embed endpoint
+    and stored as float32 bytes in the embeddings table. A NumPy index holds
+    the L2 normalized vectors in memory, so a top-k similarity query is one
+    matrix-vector product rather than a table scan. New vectors are appended
+    to the index and the index is persisted to disk so it is not rebuilt from
+    the DB on every start.
+
+    Nearest neighbours of newly embedded items are also written to the
+    embedding_neighbors table for readers without the index (the frontend).
+"""
+
+import asyncio
+import datetime
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+from ollama import AsyncClient, ResponseError
+
+# Import required local modules
+import logit
+from config import get_config
+from database import get_select_query_results
+from database import insert_rows_into_table
+from resilience import OLLAMA_HOSTS, OllamaUnavailable
+
+get_config()
+
+EMBED_MODEL = os.environ.get('EMBED_MODEL', 'nomic-embed-text')
+EMBED_BATCH_SIZE = int(os.environ.get('EMBED_BATCH_SIZE', 64))
+# characters, well inside nomic-embed-text's context window
+EMBED_MAX_CHARS = int(os.environ.get('EMBED_MAX_CHARS', 8000))
+EMBED_TOP_K = int(os.environ.get('EMBED_TOP_K', 10))
+EMBED_INDEX_DIR = os.environ.get('EMBED_INDEX_DIR', 'embeddings_index')
+# pending rows read per query, the index is saved after each page
+EMBED_PAGE_SIZE = int(os.environ.get('EMBED_PAGE_SIZE', 1000))
+EMBED_TIMEOUT = float(os.environ.get('EMBED_TIMEOUT', 120))
+
+VECTOR_DTYPE = np.float32
+
+
+def vector_to_bytes(vector):
+    """Compact float32 representation of a vector for a bytea column
+    """
+
+    return np.asarray(vector, dtype=VECTOR_DTYPE).tobytes()
+
+def bytes_to_vector(data):
+    """Inverse of vector_to_bytes
+    """
+
+    return np.frombuffer(bytes(data), dtype=VECTOR_DTYPE)
+
+def normalize(vectors):
+    """L2 normalize rows so a dot product is the cosine similarity
+    """
+
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=VECTOR_DTYPE))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def embed_texts(texts, model=EMBED_MODEL):
+    """Embed a batch of texts in a single request
+
+        Returns:
+            numpy.ndarray: one float32 row per text, None on failure
+    """
+
+    async def embed_on(host):
+        return await AsyncClient(host=host, timeout=EMBED_TIMEOUT).embed(model=model,
+                                                                         input=[text[:EMBED_MAX_CHARS] for text in texts])
+
+    try:
+        response = asyncio.run(OLLAMA_HOSTS.call(embed_on))
+        return np.asarray(response['embeddings'], dtype=VECTOR_DTYPE)
+    except (OllamaUnavailable, ResponseError, KeyError, ValueError) as e:
+        error_message = f'Unable to embed {len(texts)} texts with {model} {e}'
+        logging.error(error_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'ERROR', error_message)
+        return None
+
+
+class VectorIndex:
+    """In-memory cosine similarity index over normalized float32 vectors
+
+        Storage grows by doubling so appends are amortized O(1).
+    """
+
+    def __init__(self, dims=None):
+        self.dims = dims
+        self.vectors = np.empty((0, dims or 0), dtype=VECTOR_DTYPE)
+        self.size = 0
+        self.ids = []
+        self.categories = []
+        self.positions = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    def append(self, ids, categories, vectors):
+        """Add vectors, ids already in the index are skipped
+        """
+
+        vectors = normalize(vectors)
+        with self.lock:
+            if self.dims is None:
+                self.dims = vectors.shape[1]
+                self.vectors = np.empty((0, self.dims), dtype=VECTOR_DTYPE)
+            if vectors.shape[1] != self.dims:
+                raise ValueError(f'Expected {self.dims} dimensions, got {vectors.shape[1]}')
+
+            keep = [i for i, reference_id in enumerate(ids) if reference_id not in self.positions]
+            if not keep:
+                return 0
+
+            needed = self.size + len(keep)
+            if needed > len(self.vectors):
+                grown = np.empty((max(needed, 2 * len(self.vectors), 1024), self.dims), dtype=VECTOR_DTYPE)
+                grown[:self.size] = self.vectors[:self.size]
+                self.vectors = grown
+
+            self.vectors[self.size:needed] = vectors[keep]
+            for i in keep:
+                self.positions[ids[i]] = len(self.ids)
+                self.ids.append(ids[i])
+                self.categories.append(categories[i])
+            self.size = needed
+            return len(keep)
+
+    def vector(self, reference_id):
+        """Stored vector of an id, None if it is not in the index
+        """
+
+        position = self.positions.get(reference_id)
+        if position is None:
+            return None
+        return self.vectors[position]
+
+    def search(self, vector, k=EMBED_TOP_K, category=None, exclude=None):
+        """Top-k most similar ids to vector
+
+            Returns:
+                list: [{'reference_id', 'category', 'score'}] best first
+        """
+
+        if not self.size:
+            return []
+
+        with self.lock:
+            scores = self.vectors[:self.size] @ normalize(vector)[0]
+            if category:
+                scores = np.where(np.asarray(self.categories) == category, scores, -np.inf)
+            if exclude is not None and exclude in self.positions:
+                scores[self.positions[exclude]] = -np.inf
+
+            k = min(k, self.size)
+            # partial sort - only the top k are ordered
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+
+            return [{
+                     'reference_id' : self.ids[i],
+                     'category' : self.categories[i],
+                     'score' : round(float(scores[i]), 6)
+                    } for i in top if np.isfinite(scores[i])]
+
+    def save(self, index_dir=EMBED_INDEX_DIR):
+        """Persist the index, files are replaced atomically
+        """
+
+        os.makedirs(index_dir, exist_ok=True)
+        with self.lock:
+            vectors_path = os.path.join(index_dir, 'vectors.npy')
+            with open(f'{vectors_path}.tmp', 'wb') as npy_file:
+                np.save(npy_file, self.vectors[:self.size])
+            ids_path = os.path.join(index_dir, 'ids.json')
+            with open(f'{ids_path}.tmp', 'w', encoding='utf-8') as ids_file:
+                json.dump({'ids' : self.ids, 'categories' : self.categories}, ids_file)
+            os.replace(f'{vectors_path}.tmp', vectors_path)
+            os.replace(f'{ids_path}.tmp', ids_path)
+
+    @classmethod
+    def load(cls, index_dir=EMBED_INDEX_DIR):
+        """Load a persisted index, None if there is none
+        """
+
+        try:
+            vectors = np.load(os.path.join(index_dir, 'vectors.npy'))
+            with open(os.path.join(index_dir, 'ids.json'), encoding='utf-8') as ids_file:
+                ids = json.load(ids_file)
+        except (OSError, ValueError) as e:
+            info_message = f'No usable vector index in {index_dir} {e}'
+            logging.info(info_message)
+            return None
+
+        index = cls(vectors.shape[1] if vectors.ndim == 2 else None)
+        if len(ids['ids']):
+            index.append(ids['ids'], ids['categories'], vectors)
+        return index
+
+
+INDEX = {'index' : None, 'mtime' : None}
+
+
+def index_mtime(index_dir=EMBED_INDEX_DIR):
+    try:
+        return os.path.getmtime(os.path.join(index_dir, 'ids.json'))
+    except OSError:
+        return None
+
+def load_index_from_db():
+    """Rebuild the index from the embeddings table
+    """
+
+    sql_query = """SELECT reference_id, category, vector
+                   FROM embeddings
+                   WHERE model=%s;"""
+    rows = get_select_query_results(sql_query, (EMBED_MODEL,))
+
+    index = VectorIndex()
+    if rows:
+        index.append([row[0] for row in rows],
+                     [row[1] for row in rows],
+                     np.vstack([bytes_to_vector(row[2]) for row in rows]))
+    return index
+
+def db_count_embeddings():
+    rows = get_select_query_results('SELECT count(*) FROM embeddings WHERE model=%s;', (EMBED_MODEL,))
+    return rows[0][0] if rows else 0
+
+def get_index():
+    """Process wide index, reloaded when another process has saved a newer one
+        and rebuilt from the DB when the saved one misses stored embeddings
+    """
+
+    mtime = index_mtime()
+    if INDEX['index'] is None or (mtime and mtime != INDEX['mtime']):
+        index = VectorIndex.load()
+        if index is not None and len(index) != db_count_embeddings():
+            # a run died between storing embeddings and saving the index
+            info_message = f'Vector index in {EMBED_INDEX_DIR} is out of date, rebuilding it'
+            logging.info(info_message)
+            index = None
+        if index is None:
+            index = load_index_from_db()
+            if len(index):
+                index.save()
+            mtime = index_mtime()
+        INDEX['index'] = index
+        INDEX['mtime'] = mtime
+    return INDEX['index']
+
+def db_get_unembedded(category, after_id='', limit=EMBED_PAGE_SIZE):
+    """Next page of posts or comments with a body that have no embedding
+        yet, in id order after after_id
+
+        Returns:
+            list: (reference_id, text) tuples
+    """
+
+    if category == 'post':
+        sql_query = """SELECT p.post_id, coalesce(p.post_title, '') || ' ' || p.post_body
+                       FROM posts p
+                       WHERE p.post_id > %s
+                       AND p.post_body NOT IN ('', '[removed]', '[deleted]')
+                       AND NOT EXISTS (
+                           SELECT 1 FROM embeddings e
+                           WHERE e.reference_id = p.post_id AND e.model = %s
+                       )
+                       ORDER BY p.post_id
+                       LIMIT %s;"""
+    else:
+        sql_query = """SELECT c.comment_id, c.comment_body
+                       FROM comments c
+                       WHERE c.comment_id > %s
+                       AND md5(c.comment_body) NOT IN (md5(''), md5('[removed]'), md5('[deleted]'))
+                       AND NOT EXISTS (
+                           SELECT 1 FROM embeddings e
+                           WHERE e.reference_id = c.comment_id AND e.model = %s
+                       )
+                       ORDER BY c.comment_id
+                       LIMIT %s;"""
+
+    return get_select_query_results(sql_query, (after_id, EMBED_MODEL, limit))
+
+def store_neighbors(index, ids, categories, vectors):
+    """Write top-k neighbours of newly embedded items, both ways round
+    """
+
+    created_at = datetime.datetime.now(tz=datetime.timezone.utc)
+    rows = []
+    for reference_id, category, vector in zip(ids, categories, vectors):
+        for neighbor in index.search(vector, EMBED_TOP_K, exclude=reference_id):
+            for a, a_category, b, b_category in ((reference_id, category, neighbor['reference_id'], neighbor['category']),
+                                                 (neighbor['reference_id'], neighbor['category'], reference_id, category)):
+                rows.append({
+                             'reference_id' : a,
+                             'category' : a_category,
+                             'neighbor_id' : b,
+                             'neighbor_category' : b_category,
+                             'model' : EMBED_MODEL,
+                             'score' : neighbor['score'],
+                             'created_at' : created_at
+                            })
+    insert_rows_into_table('embedding_neighbors', rows)
+
+def embed_pending():
+    """Embed every post and comment that has no embedding yet, append them to
+        the index and persist it
+
+        Returns:
+            dict: number of items embedded per category
+    """
+
+    index = get_index()
+    embedded = {}
+
+    for category in ('post', 'comment'):
+        embedded[category] = 0
+        # keyset paging, rows that failed to embed are not read again this run
+        after_id = ''
+        while True:
+            pending = db_get_unembedded(category, after_id) or []
+            if not pending:
+                break
+            after_id = pending[-1][0]
+            page_embedded = 0
+
+            for start in range(0, len(pending), EMBED_BATCH_SIZE):
+                batch = pending[start:start + EMBED_BATCH_SIZE]
+                vectors = embed_texts([text for _, text in batch])
+                if vectors is None:
+                    continue
+
+                ids = [reference_id for reference_id, _ in batch]
+                categories = [category] * len(batch)
+                created_at = datetime.datetime.now(tz=datetime.timezone.utc)
+                insert_rows_into_table('embeddings', [{
+                                                       'reference_id' : reference_id,
+                                                       'category' : category,
+                                                       'model' : EMBED_MODEL,
+                                                       'dims' : int(vectors.shape[1]),
+                                                       'vector' : vector_to_bytes(vector),
+                                                       'created_at' : created_at
+                                                      } for reference_id, vector in zip(ids, vectors)])
+                index.append(ids, categories, vectors)
+                store_neighbors(index, ids, categories, vectors)
+                page_embedded += len(batch)
+
+            if page_embedded:
+                index.save()
+                INDEX['mtime'] = index_mtime()
+                embedded[category] += page_embedded
+
+        info_message = f'Embedded {embedded[category]} {category}s with {EMBED_MODEL}'
+        logging.info(info_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'INFO', info_message)
+
+    return embedded
+
+def similar(reference_id=None, text=None, k=EMBED_TOP_K, category=None):
+    """Top-k items most similar to an embedded item or to a piece of text
+
+        Returns:
+            list: [{'reference_id', 'category', 'score'}], None when the item
+                  or text could not be embedded
+    """
+
+    index = get_index()
+    if reference_id:
+        vector = index.vector(reference_id)
+    else:
+        vectors = embed_texts([text])
+        vector = vectors[0] if vectors is not None else None
+
+    if vector is None:
+        return None
+    return index.search(vector, k, category=category, exclude=reference_id)
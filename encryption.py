@@ -1,45 +1,159 @@
 # encryption.py
 # ©2024, Ovais Quraishi
 
-"""This module provides functions for encrypting and decrypting 
+"""This module provides functions for encrypting and decrypting
     text using the Fernet cryptography library.
+
+    ENCRYPTION_KEY is a comma separated list of key files, newest first. Text
+    is encrypted with the first key and decrypted with whichever key
+    encrypted it, so a new key can be put in front of the old ones and
+    existing analyses re-encrypted with rotate_analysis_documents(). The keys
+    are read once per process.
 """
 
 import logging
 import os
-from cryptography.fernet import Fernet
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+from psycopg2.extras import execute_values
+
+# Import required local modules
+import logit
 from config import get_config
+from database import psql_connection
 
 get_config()
 
-def load_key():
+# batches at least this large are spread over a process pool
+ENCRYPTION_POOL_THRESHOLD = int(os.environ.get('ENCRYPTION_POOL_THRESHOLD', 5000))
+ENCRYPTION_POOL_WORKERS = int(os.environ.get('ENCRYPTION_POOL_WORKERS', os.cpu_count() or 1))
+ENCRYPTION_ROTATE_CHUNK = int(os.environ.get('ENCRYPTION_ROTATE_CHUNK', 1000))
+
+# every Fernet token starts with its version byte, 0x80, base64 encoded
+FERNET_TOKEN_PREFIX = 'gAAAAA'
+
+
+def key_files():
+    return [f.strip() for f in os.environ['ENCRYPTION_KEY'].split(',') if f.strip()]
+
+def load_key(filename=None):
     """Loads a key used to encrypt and decrypt text.
     """
-    
+
+    filename = filename or key_files()[0]
     try:
-        filename = os.environ['ENCRYPTION_KEY']
         with open(filename, 'rb') as key_file:
             key = key_file.read()
         return key
     except FileNotFoundError:
         logging.error("%s not found", filename)
 
+@lru_cache(maxsize=1)
+def cipher():
+    """MultiFernet of every key in ENCRYPTION_KEY, built once per process
+    """
+
+    return MultiFernet([Fernet(load_key(filename)) for filename in key_files()])
+
+def reload_keys():
+    """Pick up a changed ENCRYPTION_KEY in this process
+    """
+
+    cipher.cache_clear()
+
 def encrypt_text(text):
     """Encrypts a piece of text using the loaded key.
     """
 
-    key = load_key()
-    cipher_suite = Fernet(key)
     encoded_text = text.encode()
-    encrypted_text = cipher_suite.encrypt(encoded_text)
+    encrypted_text = cipher().encrypt(encoded_text)
     return encrypted_text
 
 def decrypt_text(encrypted_text):
     """Decrypts a piece of encrypted text using the loaded key.
     """
 
-    key = load_key()
-    cipher_suite = Fernet(key)
-    decrypted_text = cipher_suite.decrypt(encrypted_text)
+    decrypted_text = cipher().decrypt(encrypted_text)
     decoded_text = decrypted_text.decode()
     return decoded_text
+
+def map_batch(func, items):
+    """func over items, in a process pool once the batch is large enough to
+        be worth pickling
+    """
+
+    if len(items) < ENCRYPTION_POOL_THRESHOLD or ENCRYPTION_POOL_WORKERS < 2:
+        return [func(item) for item in items]
+
+    chunksize = max(len(items) // (ENCRYPTION_POOL_WORKERS * 4), 1)
+    with ProcessPoolExecutor(max_workers=ENCRYPTION_POOL_WORKERS) as executor:
+        return list(executor.map(func, items, chunksize=chunksize))
+
+def encrypt_texts(texts):
+    """Encrypts a list of texts, order preserved
+    """
+
+    return map_batch(encrypt_text, list(texts))
+
+def decrypt_texts(encrypted_texts):
+    """Decrypts a list of encrypted texts, order preserved
+    """
+
+    return map_batch(decrypt_text, list(encrypted_texts))
+
+def rotate_token(token):
+    """Re-encrypt a token with the first key, None if it is not a token of any
+        of the keys
+    """
+
+    try:
+        return cipher().rotate(token.encode()).decode('utf-8')
+    except InvalidToken:
+        return None
+
+def rotate_analysis_documents():
+    """Re-encrypt encrypted analyses with the first key in ENCRYPTION_KEY,
+        walking analysis_documents by id in chunks
+
+        Returns:
+            dict: number of analyses rotated, and skipped as not decryptable
+    """
+
+    rotated = skipped = 0
+    last_id = 0
+    while True:
+        conn, cur = psql_connection()
+        try:
+            cur.execute("""SELECT id, analysis_document ->> 'analysis'
+                           FROM analysis_documents
+                           WHERE id > %s
+                               AND analysis_document ->> 'analysis' LIKE %s
+                           ORDER BY id
+                           LIMIT %s;""", (last_id, f'{FERNET_TOKEN_PREFIX}%', ENCRYPTION_ROTATE_CHUNK))
+            rows = cur.fetchall()
+            if not rows:
+                break
+
+            last_id = rows[-1][0]
+            tokens = map_batch(rotate_token, [analysis for _, analysis in rows])
+            updates = [(row[0], token) for row, token in zip(rows, tokens) if token]
+            skipped += len(rows) - len(updates)
+            if updates:
+                execute_values(cur,
+                               """UPDATE analysis_documents
+                                  SET analysis_document = jsonb_set(analysis_document, '{analysis}', to_jsonb(v.analysis))
+                                  FROM (VALUES %s) AS v(id, analysis)
+                                  WHERE analysis_documents.id = v.id;""",
+                               updates)
+                conn.commit()
+            rotated += len(updates)
+        finally:
+            conn.close()
+
+        info_message = f'Encryption key rotation {rotated} analyses rotated, {skipped} skipped'
+        logging.info(info_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'INFO', info_message)
+
+    return {'rotated' : rotated, 'skipped' : skipped}
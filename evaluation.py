@@ -0,0 +1,190 @@
+# evaluation.py
+# ©2024, Ovais Quraishi
+"""Offline scoring of stored analyses with deepeval
+
+    Every stored analysis is scored against the post or comment it answers,
+    with a local Ollama model as the judge. Evaluations run concurrently, up
+    to EVAL_CONCURRENCY at once, and their results go to analysis_evaluations,
+    keyed by (analysis shasum_512, metric, judge), so a re-run only scores
+    analyses that have not been scored by that metric and judge yet.
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+from deepeval.metrics import AnswerRelevancyMetric
+from deepeval.models import DeepEvalBaseLLM
+from deepeval.test_case import LLMTestCase
+from ollama import AsyncClient
+
+# Import required local modules
+import logit
+from config import get_config
+from database import get_select_query_result_dicts, insert_rows_into_table
+from encryption import decrypt_text, FERNET_TOKEN_PREFIX
+from resilience import OLLAMA_HOSTS
+
+get_config()
+
+EVAL_JUDGE_MODEL = os.environ.get('EVAL_JUDGE_MODEL', 'phi4')
+EVAL_METRICS = [m.strip() for m in os.environ.get('EVAL_METRICS', 'answer_relevancy').split(',') if m.strip()]
+EVAL_THRESHOLD = float(os.environ.get('EVAL_THRESHOLD', 0.5))
+EVAL_CONCURRENCY = int(os.environ.get('EVAL_CONCURRENCY', 8))
+EVAL_CHUNK = int(os.environ.get('EVAL_CHUNK', 200))
+EVAL_MAX_CHARS = int(os.environ.get('EVAL_MAX_CHARS', 8000))
+
+METRICS = {
+           'answer_relevancy' : AnswerRelevancyMetric
+          }
+
+# as sent by rollama.load_post and rollama.load_comment
+PROMPTS = {
+           'post' : 'respond to this post title and post body: ',
+           'comment' : 'respond to this comment: '
+          }
+
+
+class OllamaJudge(DeepEvalBaseLLM):
+    """deepeval judge model served by Ollama, through the Ollama host pool
+    """
+
+    def __init__(self, model_name=EVAL_JUDGE_MODEL):
+        self.model_name = model_name
+        super().__init__(model_name)
+
+    def load_model(self):
+        return self.model_name
+
+    def get_model_name(self):
+        return self.model_name
+
+    def messages(self, prompt):
+        return [{'role' : 'user', 'content' : prompt}]
+
+    def parse(self, content, schema):
+        return schema.model_validate_json(content) if schema else content
+
+    async def chat(self, prompt, schema):
+        async def chat_on(host):
+            return await AsyncClient(host=host).chat(model=self.model_name,
+                                                     messages=self.messages(prompt),
+                                                     format=schema.model_json_schema() if schema else 'json',
+                                                     options={'temperature' : 0})
+
+        response = await OLLAMA_HOSTS.call(chat_on)
+        return self.parse(response['message']['content'], schema)
+
+    def generate(self, prompt, schema=None):
+        # deepeval calls this outside of an event loop
+        return asyncio.run(self.chat(prompt, schema))
+
+    async def a_generate(self, prompt, schema=None):
+        return await self.chat(prompt, schema)
+
+
+def get_unevaluated(metric, judge, after_id, limit):
+    """Next chunk of analyses with their source text that metric and judge
+        have not scored, in id order
+    """
+
+    sql_query = """SELECT
+                        a.id,
+                        a.shasum_512,
+                        a.analysis_document ->> 'llm' AS llm,
+                        a.analysis_document ->> 'category' AS category,
+                        a.analysis_document ->> 'reference_id' AS reference_id,
+                        a.analysis_document ->> 'analysis' AS analysis,
+                        coalesce(p.post_title || p.post_body, c.comment_body) AS source_text
+                    FROM analysis_documents a
+                    LEFT JOIN posts p
+                        ON a.analysis_document ->> 'category' = 'post'
+                        AND p.post_id = a.analysis_document ->> 'reference_id'
+                    LEFT JOIN comments c
+                        ON a.analysis_document ->> 'category' = 'comment'
+                        AND c.comment_id = a.analysis_document ->> 'reference_id'
+                    WHERE a.id > %s
+                        AND a.analysis_document ? 'analysis'
+                        AND coalesce(p.post_body, c.comment_body) IS NOT NULL
+                        AND NOT EXISTS (SELECT 1 FROM analysis_evaluations e
+                                        WHERE e.shasum_512 = a.shasum_512
+                                            AND e.metric = %s
+                                            AND e.judge = %s)
+                    ORDER BY a.id
+                    LIMIT %s;
+                """
+    return get_select_query_result_dicts(sql_query, (after_id, metric, judge, limit))
+
+def test_case_for(row):
+    analysis = row['analysis']
+    if analysis.startswith(FERNET_TOKEN_PREFIX):
+        analysis = decrypt_text(analysis.encode())
+    source_text = row['source_text'][:EVAL_MAX_CHARS]
+    return LLMTestCase(input=PROMPTS.get(row['category'], '') + source_text,
+                       actual_output=analysis)
+
+async def evaluate_row(row, metric_name, judge, semaphore):
+    """Score one analysis, None if the evaluation failed
+    """
+
+    async with semaphore:
+        metric = METRICS[metric_name](threshold=EVAL_THRESHOLD, model=judge, async_mode=True)
+        start_time = time.time()
+        try:
+            await metric.a_measure(test_case_for(row))
+        except Exception as e:
+            # one bad judge answer must not end the run, it is retried next run
+            error_message = f'Evaluation {metric_name} of {row["shasum_512"][:16]} failed {e}'
+            logging.error(error_message)
+            logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'ERROR', error_message)
+            return None
+
+    return {
+            'shasum_512' : row['shasum_512'],
+            'metric' : metric_name,
+            'judge' : judge.get_model_name(),
+            'llm' : row['llm'],
+            'category' : row['category'],
+            'reference_id' : row['reference_id'],
+            'score' : metric.score,
+            'success' : metric.is_successful(),
+            'reason' : metric.reason,
+            'evaluation_duration' : time.time() - start_time
+           }
+
+async def run_evaluations(limit=None):
+    """Score every unscored analysis with every metric in EVAL_METRICS
+
+        Returns:
+            dict: per metric, number of analyses scored and failed
+    """
+
+    judge = OllamaJudge()
+    semaphore = asyncio.Semaphore(EVAL_CONCURRENCY)
+    report = {}
+    for metric_name in EVAL_METRICS:
+        scored = failed = 0
+        last_id = 0
+        while limit is None or scored + failed < limit:
+            chunk = EVAL_CHUNK if limit is None else min(EVAL_CHUNK, limit - scored - failed)
+            rows = await asyncio.to_thread(get_unevaluated, metric_name, judge.get_model_name(), last_id, chunk)
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+
+            results = await asyncio.gather(*[evaluate_row(row, metric_name, judge, semaphore) for row in rows])
+            evaluations = [result for result in results if result]
+            await asyncio.to_thread(insert_rows_into_table, 'analysis_evaluations', evaluations)
+            scored += len(evaluations)
+            failed += len(rows) - len(evaluations)
+
+        report[metric_name] = {'judge' : judge.get_model_name(), 'scored' : scored, 'failed' : failed}
+        info_message = f'Evaluation {metric_name} {report[metric_name]}'
+        logging.info(info_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'INFO', info_message)
+
+    return report
+
+def evaluate_analyses(limit=None):
+    return asyncio.run(run_evaluations(limit))
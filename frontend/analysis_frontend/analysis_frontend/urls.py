@@ -18,9 +18,11 @@ from django.contrib import admin
 from django.urls import path
 from posts.views import post_detail
 from posts.views import row_counts
+from posts.views import similar
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('post-detail/', post_detail, name='post_detail'),
     path('counts/', row_counts, name='counts'),
+    path('similar/', similar, name='similar'),
 ]
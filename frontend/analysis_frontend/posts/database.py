@@ -4,7 +4,6 @@
 """
 
 from . import config
-import ast
 import json
 import logging
 import markdown
@@ -196,12 +195,16 @@ def deb_get_post_analysis_comments():
                 SELECT 
                     p.subreddit,
                     MAX(p.post_title || '  -  ' || p.post_body) AS post,
-                    array_to_string(array_agg(ad.analysis_document), ', ') as analysis_docs,
+                    jsonb_agg(CASE WHEN src.shasum_512 IS NULL THEN ad.analysis_document
+                                   ELSE ad.analysis_document || jsonb_build_object('analysis', src.analysis_document->'analysis')
+                              END) as analysis_docs,
                     pc.comment_bodies
                 FROM 
                     public.posts p
                 JOIN 
                     public.analysis_documents ad ON p.post_id = (ad.analysis_document->>'reference_id')::varchar
+                LEFT JOIN
+                    public.analysis_documents src ON src.shasum_512 = ad.analysis_document->>'analysis_shasum_512'
                 LEFT JOIN
                     post_comments pc ON p.post_id = pc.post_id
                 WHERE 
@@ -222,7 +225,9 @@ def deb_get_post_analysis_comments():
         # Convert markdown to HTML for UI rendering
         post_html = markdown.markdown(result['post'])
         # Convert analysis docs to list of dictionaries with analysis converted to HTML
-        analysis_docs = [dict({**row, 'analysis': markdown.markdown(row['analysis'])}) for row in ast.literal_eval(result['analysis_docs'])]
+        #  prompt cache hits get the analysis of the document they point at, one
+        #  whose source is gone has none
+        analysis_docs = [dict({**row, 'analysis': markdown.markdown(row['analysis'])}) for row in result['analysis_docs'] if 'analysis' in row]
         new_list = [markdown.markdown(text) for text in result['comment_bodies']]
         return {
             'subreddit': result['subreddit'],
@@ -232,3 +237,35 @@ def deb_get_post_analysis_comments():
         }
     else:
         return False
+
+def db_get_similar(reference_id, k=10):
+    """Nearest neighbours of a post or comment, precomputed by the embedding
+        job, with a snippet of their text
+    """
+
+    sql_query = """
+                SELECT
+                    en.neighbor_id,
+                    en.neighbor_category,
+                    en.score,
+                    left(coalesce(p.post_title || '  -  ' || p.post_body, c.comment_body), 500) AS body
+                FROM
+                    public.embedding_neighbors en
+                LEFT JOIN
+                    public.posts p ON en.neighbor_category = 'post' AND p.post_id = en.neighbor_id
+                LEFT JOIN
+                    public.comments c ON en.neighbor_category = 'comment' AND c.comment_id = en.neighbor_id
+                WHERE
+                    en.reference_id = %s
+                ORDER BY
+                    en.score DESC
+                LIMIT %s;
+                """
+
+    conn, cur = psql_connection(cursorfactory=RealDictCursor)
+
+    cur.execute(sql_query, (reference_id, k))
+    result = cur.fetchall()
+    conn.close()
+
+    return [{**row, 'body': markdown.markdown(row['body'] or '')} for row in result]
@@ -37,3 +37,12 @@ def row_counts(request):
                 """
     results = database.get_select_query_result_dicts(sql_query)
     return render(request, 'posts/database_counts.html', {'data': results})
+
+@require_http_methods(["GET"])
+def similar(request):
+    """Posts and comments most similar to a given reference_id
+    """
+
+    reference_id = request.GET.get('reference_id', '')
+    results = database.db_get_similar(reference_id) if reference_id else []
+    return render(request, 'posts/similar.html', {'reference_id': reference_id, 'data': results})
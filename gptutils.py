@@ -3,58 +3,189 @@
 """Ollama-GPT module
 """
 
+import asyncio
 import hashlib
 import logging
 import os
+import time
 import httpx
 from pathlib import Path
 
 from ollama import AsyncClient
-from deepeval import evaluate
-from deepeval.test_case import LLMTestCase
-from deepeval.metrics import AnswerRelevancyMetric
 
 from config import get_config
 from encryption import encrypt_text
 from logit import log_message_to_db, get_rollama_version
+from sanitizer import sanitize_string
 from utils import ts_int_to_dt_obj
-from utils import sanitize_string
 from utils import get_semver
 
 get_config()
 
 
+# streaming mode and per prompt budgets, 0 means no budget
+OLLAMA_STREAM = os.environ.get('OLLAMA_STREAM', 'False').lower() == 'true'
+PROMPT_TIMEOUT_SECS = float(os.environ.get('PROMPT_TIMEOUT_SECS', 0))
+PROMPT_MAX_TOKENS = int(os.environ.get('PROMPT_MAX_TOKENS', 0))
+
+NS_PER_SEC = 1000000000
+
+# the Ollama version rarely changes, look it up at most every
+#  OLLAMA_VER_TTL seconds instead of once per prompt
+OLLAMA_VER_TTL = int(os.environ.get('OLLAMA_VER_TTL', 300))
+# a stalled host must not hold up the prompt waiting on its version
+OLLAMA_VER_TIMEOUT = float(os.environ.get('OLLAMA_VER_TIMEOUT', 5))
+# host -> {'version', 'expires'}
+OLLAMA_VER_CACHE = {}
+
+
+def ollama_version(host):
+    """Cached Ollama semantic version of a host
+    """
+
+    now = time.monotonic()
+    cached = OLLAMA_VER_CACHE.setdefault(host, {'version' : None, 'expires' : 0.0})
+    if cached['version'] is None or now >= cached['expires']:
+        version = get_semver(host, OLLAMA_VER_TIMEOUT)
+        if version:
+            cached['version'] = version
+            cached['expires'] = now + OLLAMA_VER_TTL
+        else:
+            return cached['version'] or version
+    return cached['version']
+
+def ns_to_secs(nanoseconds):
+    """Ollama reports durations in nanoseconds
+    """
+
+    return nanoseconds / NS_PER_SEC if nanoseconds else 0.0
+
+async def stream_chat(client, llm, messages, options, keep_alive=None):
+    """Consume a streamed chat completion chunk by chunk
+
+        Stops early, closing the stream so Ollama cancels the generation, once
+        PROMPT_TIMEOUT_SECS or PROMPT_MAX_TOKENS is exceeded.
+
+        Returns:
+            tuple: (content, final chunk or None when truncated,
+                    time to first token, number of streamed tokens)
+    """
+
+    start_time = time.monotonic()
+    parts = []
+    stats = {'time_to_first_token' : None, 'final' : None}
+
+    async def consume():
+        stream = await client.chat(
+                                   model=llm,
+                                   stream=True,
+                                   messages=messages,
+                                   options=options,
+                                   keep_alive=keep_alive
+                                  )
+        try:
+            async for chunk in stream:
+                if chunk['message']['content']:
+                    if stats['time_to_first_token'] is None:
+                        stats['time_to_first_token'] = time.monotonic() - start_time
+                    parts.append(chunk['message']['content'])
+                if chunk.get('done'):
+                    stats['final'] = chunk
+                    return
+                if PROMPT_MAX_TOKENS and len(parts) >= PROMPT_MAX_TOKENS:
+                    return
+        finally:
+            await stream.aclose()
+
+    try:
+        await asyncio.wait_for(consume(), timeout=PROMPT_TIMEOUT_SECS or None)
+    except asyncio.TimeoutError:
+        pass
+
+    if stats['final'] is None:
+        warn_message = f'{llm} generation cancelled after {len(parts)} tokens, {time.monotonic() - start_time:.1f}s'
+        logging.warning(warn_message)
+        log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'WARNING', warn_message)
+
+    return ''.join(parts), stats['final'], stats['time_to_first_token'], len(parts)
+
 async def prompt_chat(llm,
                       content,
                       encrypt_analysis=False,
+                      stream=None,
+                      keep_alive=None,
+                      options=None,
+                      host=None,
                      ):
     """Llama Chat Prompting and response
     """
 
     dt = ts_int_to_dt_obj()
-    OLLAMA_VER = get_semver()
+    host = host or os.environ['OLLAMA_API_URL']
+    # blocking HTTP, kept off the event loop
+    OLLAMA_VER = await asyncio.to_thread(ollama_version, host)
 
-    client = AsyncClient(host=os.environ['OLLAMA_API_URL'])
-    logging.info('Running for %s', llm)
+    if stream is None:
+        stream = OLLAMA_STREAM
+
+    messages = [
+                {
+                 'role': 'user',
+                 'content': content
+                },
+               ]
+    options = {
+               'temperature' : 0.1,
+               **(options or {})
+              }
+    if PROMPT_MAX_TOKENS:
+        # let Ollama enforce the token budget too
+        options['num_predict'] = min(options.get('num_predict', PROMPT_MAX_TOKENS), PROMPT_MAX_TOKENS)
+
+    client = AsyncClient(host=host)
+    logging.info('Running for %s on %s', llm, host)
     try:
-        response = await client.chat(
-                                     model=llm,
-                                     stream=False,
-                                     messages=[
-                                               {
-                                                'role': 'user',
-                                                'content': content
-                                               },
-                                              ],
-                                     options = {
-                                                'temperature' : 0.1
-                                               }
-                                    )
+        start_time = time.monotonic()
+        time_to_first_token = None
+        if stream:
+            analysis, response, time_to_first_token, num_tokens = await stream_chat(client, llm, messages, options, keep_alive)
+        else:
+            response = await client.chat(
+                                         model=llm,
+                                         stream=False,
+                                         messages=messages,
+                                         options=options,
+                                         keep_alive=keep_alive
+                                        )
+            analysis = response['message']['content']
+
+        if response is not None:
+            completion_stats = {
+                                'load_duration' : ns_to_secs(response.get('load_duration')),
+                                'prompt_eval_count' : response.get('prompt_eval_count') or 0,
+                                'prompt_eval_duration' : ns_to_secs(response.get('prompt_eval_duration')),
+                                'eval_count' : response.get('eval_count') or 0,
+                                'eval_duration' : ns_to_secs(response.get('eval_duration')),
+                                'completion_truncated' : False
+                               }
+        else:
+            # generation was cancelled, Ollama never sent its stats
+            eval_duration = time.monotonic() - start_time - (time_to_first_token or 0)
+            completion_stats = {
+                                'load_duration' : 0.0,
+                                'prompt_eval_count' : 0,
+                                'prompt_eval_duration' : time_to_first_token or 0.0,
+                                'eval_count' : num_tokens,
+                                'eval_duration' : eval_duration,
+                                'completion_truncated' : True
+                               }
 
         # chatgpt analysis
-        analysis = response['message']['content']
         analysis = sanitize_string(analysis)
-        tokens_per_second = (response['eval_count']/response['eval_duration'] * 1000000000)
+        if completion_stats['eval_duration']:
+            tokens_per_second = completion_stats['eval_count'] / completion_stats['eval_duration']
+        else:
+            tokens_per_second = 0.0
 
         # this is for the analysis text only - the idea is to avoid
         #  duplicate text document, to allow indexing the column so
@@ -72,7 +203,10 @@ async def prompt_chat(llm,
                         'shasum_512' : analysis_sha512,
                         'analysis' : analysis,
                         'ollama_ver': OLLAMA_VER,
-                        'tokens_per_second' : tokens_per_second
+                        'ollama_host' : host,
+                        'tokens_per_second' : tokens_per_second,
+                        'time_to_first_token' : time_to_first_token,
+                        **completion_stats
                         }
 
         return analyzed_obj, encrypt_analysis
@@ -80,21 +214,3 @@ async def prompt_chat(llm,
         log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version(), 'ERROR', e)
         logging.error('%s',e.args[0])
         raise httpx.ConnectError('Unable to reach Ollama Server') from None
-
-def test_answer_relevancy():
-    """
-        deepeval set-local-model --model-name=phi4 \
-        --base-url="http://<OLLAMA URL>/v1/" \
-        --api-key="ollama"
-    """
-    answer_relevancy_metric = AnswerRelevancyMetric(threshold=0.5)
-    test_case = LLMTestCase(
-        input="What is the recommended daily protein intake for adults?",
-        actual_output="The recommended daily protein intake for adults is 0.8 grams per kilogram of body weight.",
-        retrieval_context=["""Protein is an essential macronutrient that plays crucial roles in building and 
-        repairing tissues.Good sources include lean meats, fish, eggs, and legumes. The recommended 
-        daily allowance (RDA) for protein is 0.8 grams per kilogram of body weight for adults. 
-        Athletes and active individuals may need more, ranging from 1.2 to 2.0 
-        grams per kilogram of body weight."""]
-    )
-    evaluate([test_case], [answer_relevancy_metric])
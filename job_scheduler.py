@@ -6,13 +6,26 @@
     ©2024, Ovais Quraishi
 """
 
-import daemon
+import json
+import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import daemon
+import psycopg2
+import redis
 import requests
 import schedule
-import time
 import urllib3
+
+# Import required local modules
+import logit
+from analysis_scheduler import percentile
+from cache import redis_client
 from config import get_config
+from database import get_select_query_result_dicts
 
 # disable warning for self-signed SSL cert
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -22,10 +35,28 @@ get_config()
 
 # Constants
 
+SCHED_TICK_SECS = float(os.environ.get('SCHED_TICK_SECS', 5))
+SCHED_REFRESH_SECS = float(os.environ.get('SCHED_REFRESH_SECS', 600))
+SCHED_REPORT_SECS = float(os.environ.get('SCHED_REPORT_SECS', 900))
+SCHED_RATE_WINDOW_DAYS = float(os.environ.get('SCHED_RATE_WINDOW_DAYS', 7))
+# posts a crawl should find, on average
+SCHED_TARGET_NEW_POSTS = float(os.environ.get('SCHED_TARGET_NEW_POSTS', 10))
+SCHED_MIN_INTERVAL_SECS = float(os.environ.get('SCHED_MIN_INTERVAL_SECS', 300))
+SCHED_MAX_INTERVAL_SECS = float(os.environ.get('SCHED_MAX_INTERVAL_SECS', 21600))
+SCHED_API_CALLS_PER_MIN = float(os.environ.get('SCHED_API_CALLS_PER_MIN', 60))
+# a crawl costs its listing pages plus about this many calls per new post
+SCHED_CALLS_PER_POST = float(os.environ.get('SCHED_CALLS_PER_POST', 2))
+SCHED_WORKERS = int(os.environ.get('SCHED_WORKERS', 2))
+SCHED_HTTP_TIMEOUT = float(os.environ.get('SCHED_HTTP_TIMEOUT', 3600))
+
+SCHED_STATS = 'scheduler_stats'
+LISTING_CALLS = 2
+
 LOGIN_HEADERS = {
                  'Content-Type' : 'application/json'
                 }
 
+
 def get_auth_token():
 
     end_point = 'login'
@@ -41,31 +72,207 @@ def get_auth_token():
     response_json = response.json()['access_token']
     return response_json
 
-def do_get(end_point):
+def do_get(end_point, params=None):
     url = os.environ['ENDPOINT_URL'] + end_point
     auth_token = get_auth_token()
     headers = {
                'Authorization' : f'Bearer {auth_token}'
               }
-    response = requests.get(url, headers=headers, verify=True)
-    response_json = response.json()['access_token']
-    return response_json
+    response = requests.get(url, headers=headers, params=params, verify=True, timeout=SCHED_HTTP_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+def subreddit_activity():
+    """Subscribed subreddits with their posts created within the rate window
+        and the time of their last crawl
+    """
+
+    window_start = int(time.time() - SCHED_RATE_WINDOW_DAYS * 86400)
+    sql_query = """SELECT
+                        s.subreddit,
+                        count(p.post_id) AS recent_posts,
+                        extract(epoch FROM c.last_crawled_at) AS last_crawled_at
+                    FROM (SELECT DISTINCT subreddit FROM subscription) s
+                    LEFT JOIN posts p
+                        ON p.subreddit = s.subreddit
+                        AND p.post_created_utc >= %s
+                    LEFT JOIN crawl_checkpoints c
+                        ON c.subreddit = s.subreddit
+                    GROUP BY s.subreddit, c.last_crawled_at;
+                """
+    return get_select_query_result_dicts(sql_query, (window_start,))
+
+def arrival_rate(recent_posts):
+    """Posts per second, half a post per window for subreddits with none so
+        they are still polled, at SCHED_MAX_INTERVAL_SECS
+    """
+
+    return max(recent_posts, 0.5) / (SCHED_RATE_WINDOW_DAYS * 86400)
+
+def poll_interval(rate):
+    """Seconds until SCHED_TARGET_NEW_POSTS new posts are expected
+    """
+
+    return min(max(SCHED_TARGET_NEW_POSTS / rate, SCHED_MIN_INTERVAL_SECS), SCHED_MAX_INTERVAL_SECS)
+
+def crawl_cost(rate, since_secs):
+    """Estimated API calls of a crawl, capped at the budget so any crawl can
+        run eventually
+    """
+
+    expected_posts = rate * since_secs
+    return min(LISTING_CALLS + expected_posts * SCHED_CALLS_PER_POST, SCHED_API_CALLS_PER_MIN)
+
+
+class CallBudget:
+    """Token bucket of API calls, refilled at SCHED_API_CALLS_PER_MIN
+    """
+
+    def __init__(self, per_min=SCHED_API_CALLS_PER_MIN):
+        self.per_min = per_min
+        self.tokens = per_min
+        self.updated_at = time.monotonic()
+
+    def take(self, cost):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.updated_at) * self.per_min / 60, self.per_min)
+        self.updated_at = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True
+        return False
+
+
+class Scheduler:
+    """Per subreddit poll times, and the tasks in flight
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=SCHED_WORKERS)
+        self.lock = threading.Lock()
+        self.running = set()
+        self.budget = CallBudget()
+        # subreddit -> {'rate', 'last_crawled_at', 'due_at'}
+        self.subs = {}
+        self.finished = {}
+        self.lags = []
+        self.counts = {'dispatched' : 0, 'overlaps_skipped' : 0, 'budget_waits' : 0, 'failed' : 0}
+
+    def submit(self, task_name, func, *args):
+        """Run func in the background unless a run of task_name is in flight
+        """
+
+        with self.lock:
+            if task_name in self.running:
+                self.counts['overlaps_skipped'] += 1
+                return False
+            self.running.add(task_name)
+        self.executor.submit(self.run, task_name, func, *args)
+        return True
+
+    def run(self, task_name, func, *args):
+        try:
+            func(*args)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            with self.lock:
+                self.counts['failed'] += 1
+            error_message = f'Scheduled task {task_name} failed {e}'
+            logging.error(error_message)
+            logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'ERROR', error_message)
+        finally:
+            with self.lock:
+                self.running.discard(task_name)
+
+    def refresh(self):
+        """Re-read arrival rates and last crawl times
+        """
+
+        now = time.time()
+        try:
+            rows = subreddit_activity()
+        except psycopg2.Error:
+            # keep polling on the schedule read last
+            return
+        subs = {}
+        for row in rows:
+            sub = row['subreddit']
+            rate = arrival_rate(row['recent_posts'])
+            # crawls that found nothing new do not move the checkpoint
+            last_crawled_at = max(float(row['last_crawled_at'] or 0), self.finished.get(sub, 0))
+            subs[sub] = {
+                         'rate' : rate,
+                         'last_crawled_at' : last_crawled_at,
+                         'due_at' : last_crawled_at + poll_interval(rate) if last_crawled_at else now
+                        }
+        self.subs = subs
+
+    def crawl(self, sub):
+        try:
+            report = do_get('get_sub_posts', {'sub' : sub})
+            logging.info('Crawled %s %s', sub, report)
+        finally:
+            # a failed crawl waits for its next interval too, not the next tick
+            self.finished[sub] = time.time()
+            if sub in self.subs:
+                self.subs[sub]['last_crawled_at'] = self.finished[sub]
+                self.subs[sub]['due_at'] = self.finished[sub] + poll_interval(self.subs[sub]['rate'])
+
+    def dispatch(self):
+        """Start due crawls, most overdue first, while the budget lasts
+        """
+
+        now = time.time()
+        due = sorted((state['due_at'], sub) for sub, state in self.subs.items() if state['due_at'] <= now)
+        for due_at, sub in due:
+            state = self.subs[sub]
+            if f'get_sub_posts {sub}' in self.running:
+                continue
+            since = now - state['last_crawled_at'] if state['last_crawled_at'] else SCHED_MAX_INTERVAL_SECS
+            if not self.budget.take(crawl_cost(state['rate'], since)):
+                # keep the order, the most overdue crawl goes first next tick
+                self.counts['budget_waits'] += 1
+                return
+            if self.submit(f'get_sub_posts {sub}', self.crawl, sub):
+                self.counts['dispatched'] += 1
+                self.lags.append(now - due_at)
+
+    def report(self):
+        """Log schedule lag since the last report, and keep it in Redis
+        """
+
+        now = time.time()
+        lags, self.lags = self.lags, []
+        stats = {
+                 'subreddits' : len(self.subs),
+                 'overdue' : sum(1 for state in self.subs.values() if state['due_at'] <= now),
+                 'running' : len(self.running),
+                 'lag_p50_secs' : round(percentile(lags, 50), 3),
+                 'lag_p95_secs' : round(percentile(lags, 95), 3),
+                 'lag_max_secs' : round(max(lags, default=0.0), 3),
+                 'next_due_in_secs' : round(min((state['due_at'] for state in self.subs.values()), default=now) - now, 3),
+                 **self.counts
+                }
+        info_message = f'Scheduler {stats}'
+        logging.info(info_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'INFO', info_message)
+        try:
+            redis_client().set(SCHED_STATS, json.dumps({**stats, 'reported_at' : now}))
+        except redis.exceptions.RedisError as e:
+            logging.warning('Unable to store scheduler stats %s', e)
+
+
+SCHEDULER = Scheduler()
 
 # Tasks setup
 def get_authors_comments():
-    print("Get all comments of all authors listed in the author table")
-    do_get('get_authors_comments')
+    logging.info("Get all comments of all authors listed in the author table")
+    SCHEDULER.submit('get_authors_comments', do_get, 'get_authors_comments')
 
 def join_new_subs():
-    print("Join new subreddits listed in the subscription table")
-
-def get_sub_posts():
-    print("Get all submissions from a subreddit")
+    logging.info("Join new subreddits listed in the subscription table")
+    SCHEDULER.submit('join_new_subs', do_get, 'join_new_subs')
 
 # Task scheduling
-# After every 5 to 10mins in between run get_sub_posts()
-schedule.every(5).to(10).minutes.do(get_sub_posts)
-
 # Every monday join_new_subs() is called
 schedule.every().monday.do(join_new_subs)
 
@@ -74,12 +281,22 @@ schedule.every().tuesday.at("18:00").do(get_authors_comments)
 
 def main():
     # Loop so that the scheduling task
-    #  keeps on running 
+    #  keeps on running
+    refreshed_at = reported_at = 0.0
     while True:
         # Checks whether a scheduled task
         #  is pending to run or not
         schedule.run_pending()
-        time.sleep(2)
+        now = time.monotonic()
+        if now - refreshed_at >= SCHED_REFRESH_SECS:
+            SCHEDULER.refresh()
+            refreshed_at = now
+        SCHEDULER.dispatch()
+        if now - reported_at >= SCHED_REPORT_SECS:
+            if reported_at:
+                SCHEDULER.report()
+            reported_at = now
+        time.sleep(SCHED_TICK_SECS)
 
 if __name__ == '__main__':
     with daemon.DaemonContext():
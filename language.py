@@ -0,0 +1,176 @@
+# language.py
+# ©2024, Ovais Quraishi
+"""Language detection of post and comment bodies
+
+    Language is detected once, at ingest, and stored in the language column of
+    posts and comments so that the analysis queries filter in SQL. Most text
+    is decided by cheap heuristics - the Unicode script of its letters, and for
+    Latin script text the share of common English words. Only text those
+    cannot decide goes to langdetect, seeded so it gives the same answer
+    every time. Results are cached by body hash.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import unicodedata
+from collections import OrderedDict
+
+import langdetect
+from langdetect import DetectorFactory, detect
+from psycopg2.extras import execute_values
+
+# Import required local modules
+import logit
+from config import get_config
+from database import psql_connection, ANALYSIS_LANGUAGES
+
+get_config()
+
+# langdetect is non-deterministic unless seeded
+DetectorFactory.seed = 0
+
+LANG_CACHE_SIZE = int(os.environ.get('LANG_CACHE_SIZE', 100000))
+# texts with fewer words are too short for statistical detection
+LANG_SHORT_TEXT_WORDS = int(os.environ.get('LANG_SHORT_TEXT_WORDS', 4))
+# share of English stopwords above which Latin script text is English
+LANG_ENGLISH_RATIO = float(os.environ.get('LANG_ENGLISH_RATIO', 0.15))
+LANG_BACKFILL_CHUNK = int(os.environ.get('LANG_BACKFILL_CHUNK', 5000))
+
+UNKNOWN = 'und'
+
+WORD_RE = re.compile(r"[^\W\d_]+(?:'[^\W\d_]+)?")
+URL_RE = re.compile(r'https?://\S+|\bwww\.\S+|/?[ur]/\w+')
+
+ENGLISH_STOPWORDS = frozenset("""
+a about after all also am an and any are as at be because been but by can
+could did do does don't for from get had has have he her him his how i i'm
+if in into is it it's just like me more my no not now of on one only or our
+out people so some than that that's the their them then there they think this
+to up us was we were what when which who why will with would you your
+""".split())
+
+# scripts that name their language outright, others (Latin, Cyrillic, Arabic,
+#  Han, Devanagari) are shared by several languages
+SCRIPT_LANGUAGES = {
+                    'GREEK' : 'el',
+                    'HEBREW' : 'he',
+                    'THAI' : 'th',
+                    'HANGUL' : 'ko',
+                    'HIRAGANA' : 'ja',
+                    'KATAKANA' : 'ja',
+                    'ARMENIAN' : 'hy',
+                    'GEORGIAN' : 'ka',
+                   }
+
+LANGUAGE_CACHE = OrderedDict()
+
+
+def body_hash(text):
+    return hashlib.md5(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+def dominant_script(text):
+    """Unicode script name shared by most letters of text, None if no letters
+    """
+
+    counts = {}
+    for char in text:
+        if char.isalpha():
+            # unicode names start with the script, e.g. GREEK SMALL LETTER ALPHA
+            script = unicodedata.name(char, 'UNKNOWN').split(' ')[0]
+            counts[script] = counts.get(script, 0) + 1
+    if not counts:
+        return None
+    return max(counts, key=counts.get)
+
+def detect_uncached(text):
+    """Heuristics first, seeded langdetect for what they cannot decide
+    """
+
+    text = URL_RE.sub(' ', text)
+    script = dominant_script(text)
+    if script is None:
+        return UNKNOWN
+    if script in SCRIPT_LANGUAGES:
+        return SCRIPT_LANGUAGES[script]
+
+    words = WORD_RE.findall(text.casefold())
+    if script == 'LATIN':
+        english = sum(1 for word in words if word in ENGLISH_STOPWORDS)
+        if english / max(len(words), 1) >= LANG_ENGLISH_RATIO:
+            return 'en'
+        if len(words) < LANG_SHORT_TEXT_WORDS:
+            # "lol", "this", "+1" - langdetect guesses wildly on these
+            return 'en' if text.isascii() else UNKNOWN
+
+    try:
+        return detect(text)
+    except langdetect.lang_detect_exception.LangDetectException:
+        return UNKNOWN
+
+def detect_language(text):
+    """ISO 639-1 code of the language of text, 'und' if undetermined
+    """
+
+    if not text:
+        return UNKNOWN
+
+    key = body_hash(text)
+    language = LANGUAGE_CACHE.get(key)
+    if language is not None:
+        LANGUAGE_CACHE.move_to_end(key)
+        return language
+
+    language = detect_uncached(text)
+    LANGUAGE_CACHE[key] = language
+    if len(LANGUAGE_CACHE) > LANG_CACHE_SIZE:
+        LANGUAGE_CACHE.popitem(last=False)
+    return language
+
+def is_analyzed_language(language):
+    """True if text in language is to be analyzed
+    """
+
+    return language in ANALYSIS_LANGUAGES
+
+def backfill_languages(table):
+    """Detect and store the language of rows ingested before the language
+        column existed, in chunks
+
+        Returns:
+            int: number of rows updated
+    """
+
+    if table == 'posts':
+        id_column, text_sql = 'post_id', "coalesce(post_title, '') || coalesce(post_body, '')"
+    else:
+        id_column, text_sql = 'comment_id', "coalesce(comment_body, '')"
+
+    updated = 0
+    while True:
+        conn, cur = psql_connection()
+        try:
+            cur.execute(f"""SELECT {id_column}, {text_sql}
+                            FROM {table}
+                            WHERE language IS NULL
+                            LIMIT %s;""", (LANG_BACKFILL_CHUNK,))
+            rows = cur.fetchall()
+            if not rows:
+                break
+
+            execute_values(cur,
+                           f"""UPDATE {table} SET language = v.language
+                               FROM (VALUES %s) AS v(id, language)
+                               WHERE {table}.{id_column} = v.id;""",
+                           [(row_id, detect_language(text)) for row_id, text in rows])
+            conn.commit()
+            updated += len(rows)
+        finally:
+            conn.close()
+
+        info_message = f'Language backfill {table} {updated} rows'
+        logging.info(info_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'INFO', info_message)
+
+    return updated
@@ -0,0 +1,206 @@
+# near_duplicates.py
+# ©2024, Ovais Quraishi
+"""Near-duplicate detection of post and comment bodies
+
+    The prompt cache only catches texts that are identical once normalized.
+    Reworded reposts are caught here with MinHash signatures over word
+    shingles and LSH banding: a signature is cut into bands, each band is
+    hashed into a Redis bucket, and texts sharing any bucket are candidates
+    whose signature agreement estimates their Jaccard similarity.
+
+    Signatures and buckets live in Redis so that every worker process shares
+    one index, and are added to as comments and posts are ingested.
+"""
+
+import hashlib
+import logging
+import os
+import time
+
+import numpy as np
+import redis
+
+# Import required local modules
+import logit
+from cache import redis_client
+from config import get_config
+from database import get_select_query_results
+from prompt_cache import normalize_text
+
+get_config()
+
+# estimated Jaccard similarity at or above which texts are near duplicates
+NEAR_DUP_THRESHOLD = float(os.environ.get('NEAR_DUP_THRESHOLD', 0.8))
+NEAR_DUP_NUM_PERM = int(os.environ.get('NEAR_DUP_NUM_PERM', 128))
+# bands x rows = NUM_PERM, more bands catch lower similarities
+NEAR_DUP_BANDS = int(os.environ.get('NEAR_DUP_BANDS', 32))
+NEAR_DUP_SHINGLE_SIZE = int(os.environ.get('NEAR_DUP_SHINGLE_SIZE', 3))
+# shorter texts are left to the exact match prompt cache
+NEAR_DUP_MIN_WORDS = int(os.environ.get('NEAR_DUP_MIN_WORDS', 8))
+NEAR_DUP_MAX_CANDIDATES = int(os.environ.get('NEAR_DUP_MAX_CANDIDATES', 50))
+# a bucket keeps its most recently indexed members only
+NEAR_DUP_BUCKET_SIZE = int(os.environ.get('NEAR_DUP_BUCKET_SIZE', 100))
+NEAR_DUP_TTL = int(os.environ.get('NEAR_DUP_TTL', 2592000)) # 30 days
+
+SIGNATURE_PREFIX = 'minhash_'
+# buckets are sorted sets by time indexed, formerly sets under lsh_
+BUCKET_PREFIX = 'lshz_'
+NEAR_DUP_STATS = 'near_duplicate_stats'
+
+ROWS_PER_BAND = NEAR_DUP_NUM_PERM // NEAR_DUP_BANDS
+# fixed seed, signatures must be comparable across processes and restarts
+HASH_PARAMS = np.random.RandomState(20240101).randint(1, 2**63 - 1, size=(2, NEAR_DUP_NUM_PERM), dtype=np.int64).astype(np.uint64)
+HASH_PARAMS[0] |= np.uint64(1) # multiply-shift hashing needs odd multipliers
+
+
+def shingles(text):
+    """Set of word shingles of normalized text
+    """
+
+    words = normalize_text(text).split()
+    if len(words) < NEAR_DUP_MIN_WORDS:
+        return set()
+    size = min(NEAR_DUP_SHINGLE_SIZE, len(words))
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def minhash_signature(text):
+    """MinHash signature of text, None for texts too short to compare
+    """
+
+    text_shingles = shingles(text)
+    if not text_shingles:
+        return None
+
+    hashes = np.fromiter((int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=4).digest(), 'little')
+                          for shingle in text_shingles),
+                         dtype=np.uint64,
+                         count=len(text_shingles))
+    # one multiply-shift hash function per permutation, uint64 arithmetic wraps
+    permuted = (np.outer(HASH_PARAMS[0], hashes) + HASH_PARAMS[1][:, None]) >> np.uint64(32)
+    return permuted.min(axis=1).astype(np.uint32)
+
+def band_keys(signature):
+    """Redis bucket key of every band of a signature
+    """
+
+    keys = []
+    for band in range(NEAR_DUP_BANDS):
+        rows = signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+        keys.append(f'{BUCKET_PREFIX}{band}_{hashlib.md5(rows.tobytes()).hexdigest()}')
+    return keys
+
+def member(category, reference_id):
+    return f'{category}:{reference_id}'
+
+def index_signature(client, category, reference_id, signature):
+    """Store a signature and add it to its LSH buckets, trimming each to its
+        NEAR_DUP_BUCKET_SIZE newest members
+    """
+
+    pipe = client.pipeline()
+    pipe.set(f'{SIGNATURE_PREFIX}{member(category, reference_id)}', signature.tobytes(), ex=NEAR_DUP_TTL)
+    now = time.time()
+    for key in band_keys(signature):
+        pipe.zadd(key, {member(category, reference_id) : now})
+        pipe.zremrangebyrank(key, 0, -NEAR_DUP_BUCKET_SIZE - 1)
+        pipe.expire(key, NEAR_DUP_TTL)
+    pipe.execute()
+
+def index_text(category, reference_id, text):
+    """Add an ingested post or comment to the near-duplicate index
+    """
+
+    signature = minhash_signature(text or '')
+    if signature is None:
+        return False
+
+    try:
+        index_signature(redis_client(), category, reference_id, signature)
+        return True
+    except redis.exceptions.RedisError as e:
+        error_message = f'Near duplicate index failed {category} {reference_id} {e}'
+        logging.error(error_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'ERROR', error_message)
+        return False
+
+def find_near_duplicates(category, reference_id, text):
+    """Indexed items of the same category whose estimated similarity to text
+        is at least NEAR_DUP_THRESHOLD, the item itself is indexed as well
+
+        Returns:
+            list: (reference_id, similarity) tuples, most similar first
+    """
+
+    signature = minhash_signature(text or '')
+    if signature is None:
+        return []
+
+    try:
+        client = redis_client()
+        pipe = client.pipeline()
+        for key in band_keys(signature):
+            # newest first, a common band can not pull in the whole index
+            pipe.zrevrange(key, 0, NEAR_DUP_MAX_CANDIDATES - 1)
+        candidates = set()
+        for bucket in pipe.execute():
+            candidates.update(m.decode('utf-8') for m in bucket)
+        candidates.discard(member(category, reference_id))
+        candidates = [m for m in candidates if m.startswith(f'{category}:')][:NEAR_DUP_MAX_CANDIDATES]
+
+        near_duplicates = []
+        if candidates:
+            stored = client.mget([f'{SIGNATURE_PREFIX}{m}' for m in candidates])
+            for candidate, candidate_signature in zip(candidates, stored):
+                if candidate_signature is None:
+                    continue
+                similarity = float(np.mean(np.frombuffer(candidate_signature, dtype=np.uint32) == signature))
+                if similarity >= NEAR_DUP_THRESHOLD:
+                    near_duplicates.append((candidate.split(':', 1)[1], similarity))
+
+        index_signature(client, category, reference_id, signature)
+        return sorted(near_duplicates, key=lambda x: x[1], reverse=True)
+    except redis.exceptions.RedisError as e:
+        # a broken index must never stop analysis - treat it as no match
+        error_message = f'Near duplicate lookup failed {category} {reference_id} {e}'
+        logging.error(error_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'ERROR', error_message)
+        return []
+
+def find_near_duplicate_analysis(llm, category, reference_id, text):
+    """Analysis by llm of the most similar near duplicate of text
+
+        Returns:
+            dict: {'reference_id', 'similarity', 'shasum_512'}, None when no near
+                  duplicate has been analyzed by llm
+    """
+
+    near_duplicates = find_near_duplicates(category, reference_id, text)
+    if not near_duplicates:
+        return None
+
+    sql_query = """SELECT analysis_document ->> 'reference_id', shasum_512
+                   FROM analysis_documents
+                   WHERE analysis_document ->> 'reference_id' = ANY(%s)
+                   AND analysis_document ->> 'llm' = %s
+                   AND analysis_document ? 'analysis'
+                   AND NOT coalesce((analysis_document ->> 'completion_truncated')::boolean, false);"""
+    analyzed = dict(get_select_query_results(sql_query, ([rid for rid, _ in near_duplicates], llm)))
+
+    for near_duplicate_id, similarity in near_duplicates:
+        if near_duplicate_id in analyzed:
+            try:
+                redis_client().hincrby(NEAR_DUP_STATS, 'hits', 1)
+            except redis.exceptions.RedisError:
+                pass
+            return {
+                    'reference_id' : near_duplicate_id,
+                    'similarity' : round(similarity, 3),
+                    'shasum_512' : analyzed[near_duplicate_id]
+                   }
+    return None
+
+def near_duplicate_hits():
+    """Number of prompts answered by linking to a near duplicate's analysis
+    """
+
+    return int(redis_client().hget(NEAR_DUP_STATS, 'hits') or 0)
@@ -0,0 +1,211 @@
+# ollama_residency.py
+# ©2024, Ovais Quraishi
+"""Ollama model residency management
+
+    After an idle period the first prompts to a model pay for loading it. The
+    residency manager loads the model that is up next before its work arrives,
+    asks Ollama to keep a model loaded for about as long as its remaining
+    queue will take rather than a fixed time, and unloads a model as soon as
+    it has no work left so the next model does not have to evict it. Models
+    are loaded and unloaded on every Ollama host prompts are spread across.
+
+    Preloads and unloads are recorded in model_residency_events, and the
+    current state is published to Redis for the /ollama_residency endpoint.
+"""
+
+import datetime
+import json
+import logging
+import os
+import threading
+
+import redis
+import requests
+
+# Import required local modules
+import logit
+from cache import redis_client
+from config import get_config
+from database import insert_data_into_table
+from utils import prewarm_model, get_model_info
+
+get_config()
+
+# bounds of the keep_alive sent with each prompt, in seconds
+RESIDENCY_MIN_KEEP_ALIVE = int(os.environ.get('RESIDENCY_MIN_KEEP_ALIVE', 60))
+RESIDENCY_MAX_KEEP_ALIVE = int(os.environ.get('RESIDENCY_MAX_KEEP_ALIVE', 3600))
+# prompt completion time assumed until one has been observed
+RESIDENCY_DEFAULT_ITEM_SECS = float(os.environ.get('RESIDENCY_DEFAULT_ITEM_SECS', 30))
+RESIDENCY_UNLOAD_IDLE = os.environ.get('RESIDENCY_UNLOAD_IDLE', 'True').lower() == 'true'
+# a preload waits for the model to load, unloads and /api/ps answer at once
+RESIDENCY_LOAD_TIMEOUT = float(os.environ.get('RESIDENCY_LOAD_TIMEOUT', 600))
+RESIDENCY_REQUEST_TIMEOUT = float(os.environ.get('RESIDENCY_REQUEST_TIMEOUT', 30))
+
+RESIDENCY_STATE = 'ollama_residency'
+EWMA_WEIGHT = 0.2
+
+
+def utc_now():
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
+def unload_model(llm, host=None):
+    """Ask Ollama to unload a model now
+    """
+
+    host = host or os.environ['OLLAMA_API_URL']
+    url = f"{host}/api/generate" # keep_alive 0 without a prompt unloads
+
+    try:
+        response = requests.post(url, json={'model' : llm, 'keep_alive' : 0, 'stream' : False}, timeout=RESIDENCY_REQUEST_TIMEOUT)
+        response.raise_for_status()
+        return True
+    except requests.exceptions.RequestException as e:
+        error_message = f'Unable to unload {llm} on {host} {e}'
+        logging.error(error_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'ERROR', error_message)
+        return False
+
+
+class ResidencyManager:
+    """Per-model residency state of one analysis run
+    """
+
+    def __init__(self, llms, hosts):
+        self.hosts = hosts
+        self.lock = threading.Lock()
+        self.state = {llm : {
+                             'pending' : 0,
+                             'in_flight' : 0,
+                             'drained' : False,
+                             'item_secs' : RESIDENCY_DEFAULT_ITEM_SECS,
+                             'keep_alive' : None,
+                             'last_load_duration' : None,
+                             'last_preload' : None,
+                             'last_unload' : None
+                            } for llm in llms}
+
+    def keep_alive_for(self, llm, pending, concurrency=1):
+        """keep_alive long enough for the pending work of a model to be
+            prompted, at the current pace
+        """
+
+        with self.lock:
+            state = self.state[llm]
+            state['pending'] = pending
+            seconds = pending * state['item_secs'] / max(concurrency, 1) + RESIDENCY_MIN_KEEP_ALIVE
+            keep_alive = f'{int(min(max(seconds, RESIDENCY_MIN_KEEP_ALIVE), RESIDENCY_MAX_KEEP_ALIVE))}s'
+            state['keep_alive'] = keep_alive
+        return keep_alive
+
+    def started(self, llm):
+        with self.lock:
+            self.state[llm]['in_flight'] += 1
+
+    def finished(self, llm, completion_time=None):
+        """Record a completed prompt, unload the model if it was the last one
+        """
+
+        with self.lock:
+            state = self.state[llm]
+            state['in_flight'] -= 1
+            if completion_time is not None:
+                state['item_secs'] += EWMA_WEIGHT * (completion_time - state['item_secs'])
+            unload = RESIDENCY_UNLOAD_IDLE and state['drained'] and state['in_flight'] == 0
+
+        if unload:
+            self.unload(llm)
+
+    def drained(self, llm):
+        """No work left for a model other than what is in flight
+        """
+
+        with self.lock:
+            state = self.state[llm]
+            state['drained'] = True
+            state['pending'] = 0
+            unload = RESIDENCY_UNLOAD_IDLE and state['in_flight'] == 0
+
+        if unload:
+            self.unload(llm)
+        else:
+            self.publish(llm)
+
+    def preload(self, llm, pending, concurrency, host):
+        """Load a model on a host ahead of its work, concurrency is the
+            model's prompt limit summed over all hosts
+        """
+
+        keep_alive = self.keep_alive_for(llm, pending, concurrency)
+        load_duration = prewarm_model(llm, keep_alive, host, RESIDENCY_LOAD_TIMEOUT)
+        if load_duration is False:
+            return False
+
+        with self.lock:
+            self.state[llm]['last_load_duration'] = load_duration
+            self.state[llm]['last_preload'] = utc_now().isoformat(timespec='seconds')
+        self.record(llm, host, 'preload', keep_alive, load_duration)
+        self.publish(llm)
+        return load_duration
+
+    def unload(self, llm):
+        """Unload a model on every host
+        """
+
+        unloaded = [host for host in self.hosts if unload_model(llm, host)]
+        if not unloaded:
+            return False
+
+        with self.lock:
+            self.state[llm]['last_unload'] = utc_now().isoformat(timespec='seconds')
+            self.state[llm]['keep_alive'] = None
+        for host in unloaded:
+            self.record(llm, host, 'unload', '0', None)
+        self.publish(llm)
+        return True
+
+    def record(self, llm, host, event, keep_alive, load_duration):
+        info_message = f'Residency {event} {llm} on {host} keep_alive {keep_alive} load_duration {load_duration}'
+        logging.info(info_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'INFO', info_message)
+
+        insert_data_into_table('model_residency_events', {
+                                                          'created_at' : utc_now(),
+                                                          'llm' : llm,
+                                                          'ollama_host' : host,
+                                                          'event' : event,
+                                                          'keep_alive' : keep_alive,
+                                                          'load_duration' : load_duration
+                                                         })
+
+    def publish(self, llm):
+        """Share a model's state with the other worker processes
+        """
+
+        with self.lock:
+            state = {k: v for k, v in self.state[llm].items() if k != 'drained'}
+        state['updated_at'] = utc_now().isoformat(timespec='seconds')
+        try:
+            redis_client().hset(RESIDENCY_STATE, llm, json.dumps(state))
+        except redis.exceptions.RedisError as e:
+            warn_message = f'Unable to publish residency of {llm} {e}'
+            logging.warning(warn_message)
+
+
+def residency(hosts):
+    """Models each Ollama host has loaded now, and what the residency
+        manager last did with each model
+    """
+
+    loaded = {}
+    for host in hosts:
+        try:
+            loaded[host] = [{
+                             'name' : model['name'],
+                             'size_vram' : model['size_vram'],
+                             'expires_at' : model['expires_at']
+                            } for model in get_model_info(host, RESIDENCY_REQUEST_TIMEOUT)]
+        except requests.exceptions.RequestException as e:
+            loaded[host] = {'error' : f'{e}'}
+
+    managed = {k.decode('utf-8'): json.loads(v) for k, v in redis_client().hgetall(RESIDENCY_STATE).items()}
+    return {'loaded' : loaded, 'managed' : managed}
@@ -0,0 +1,178 @@
+# pipeline.py
+# ©2024, Ovais Quraishi
+"""Asyncio producer/consumer pipeline
+
+    Items flow from a source through a chain of stages connected by bounded
+    queues. Each stage runs its own number of workers, so slow network bound
+    stages (DB, cache service, Ollama) can run at high concurrency in a single
+    process without a process per item.
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+# Import required local modules
+import logit
+from config import get_config
+
+get_config()
+
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', 256))
+PIPELINE_REPORT_SECS = int(os.environ.get('PIPELINE_REPORT_SECS', 60))
+PIPELINE_LOAD_CONCURRENCY = int(os.environ.get('PIPELINE_LOAD_CONCURRENCY', 16))
+PIPELINE_FILTER_CONCURRENCY = int(os.environ.get('PIPELINE_FILTER_CONCURRENCY', 8))
+PIPELINE_PERSIST_CONCURRENCY = int(os.environ.get('PIPELINE_PERSIST_CONCURRENCY', 8))
+
+CLOSED = object() # end of stream marker
+
+
+class ClosableQueue:
+    """Bounded asyncio queue that can be closed by its producer, once closed
+        and empty get() returns None to every consumer
+    """
+
+    def __init__(self, maxsize=PIPELINE_QUEUE_SIZE):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    async def put(self, item):
+        await self.queue.put(item)
+
+    async def get(self):
+        item = await self.queue.get()
+        if item is CLOSED:
+            # hand the marker on to the next consumer
+            await self.queue.put(CLOSED)
+            return None
+        return item
+
+    async def close(self):
+        await self.queue.put(CLOSED)
+
+    def qsize(self):
+        return self.queue.qsize()
+
+
+class Stage:
+    """A pipeline stage - func takes an item and returns the item for the next
+        stage, or None to drop it
+    """
+
+    def __init__(self, name, func, concurrency=1, queue=None):
+        self.name = name
+        self.func = func
+        self.concurrency = concurrency
+        self.queue = queue if queue is not None else ClosableQueue()
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.busy_secs = 0.0
+
+    async def worker(self, next_stage):
+        """Take items off the stage queue until it is closed
+        """
+
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+
+            start_time = time.monotonic()
+            try:
+                result = await self.func(item)
+            except Exception as e:
+                # one bad item must not take the whole pipeline down
+                self.errors += 1
+                error_message = f'Pipeline stage {self.name} failed {e}'
+                logging.error(error_message)
+                logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'ERROR', error_message)
+                continue
+            finally:
+                self.busy_secs += time.monotonic() - start_time
+
+            if result is None:
+                self.dropped += 1
+                continue
+
+            self.processed += 1
+            if next_stage:
+                await next_stage.queue.put(result)
+
+    def stats(self, elapsed):
+        """Queue depth and throughput of the stage
+        """
+
+        return {
+                'concurrency' : self.concurrency,
+                'queue_depth' : self.queue.qsize(),
+                'processed' : self.processed,
+                'dropped' : self.dropped,
+                'errors' : self.errors,
+                'items_per_sec' : round(self.processed / elapsed, 3) if elapsed else 0.0,
+                'busy_secs' : round(self.busy_secs, 3)
+               }
+
+
+class Pipeline:
+    """Chain of stages fed from a source iterable
+    """
+
+    def __init__(self, name, stages):
+        self.name = name
+        self.stages = stages
+        self.start_time = None
+
+    def report(self):
+        """Per-stage queue depths and throughput
+        """
+
+        elapsed = time.monotonic() - self.start_time
+        return {
+                'pipeline' : self.name,
+                'elapsed_secs' : round(elapsed, 3),
+                'stages' : {stage.name : stage.stats(elapsed) for stage in self.stages}
+               }
+
+    def log_report(self):
+        info_message = f'Pipeline {self.report()}'
+        logging.info(info_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'INFO', info_message)
+
+    async def reporter(self):
+        while True:
+            await asyncio.sleep(PIPELINE_REPORT_SECS)
+            self.log_report()
+
+    async def feed(self, source):
+        for item in source:
+            await self.stages[0].queue.put(item)
+        await self.stages[0].queue.close()
+
+    async def run_stage(self, index):
+        """Run a stage's workers, close the next stage's queue once they are done
+        """
+
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        await asyncio.gather(*(stage.worker(next_stage) for _ in range(stage.concurrency)))
+        if next_stage:
+            await next_stage.queue.close()
+
+    async def run(self, source):
+        """Push every item of source through the pipeline
+
+            Returns:
+                dict: final per-stage report
+        """
+
+        self.start_time = time.monotonic()
+        reporter = asyncio.create_task(self.reporter())
+        try:
+            await asyncio.gather(self.feed(source),
+                                 *(self.run_stage(index) for index in range(len(self.stages))))
+        finally:
+            reporter.cancel()
+
+        self.log_report()
+        return self.report()
@@ -0,0 +1,105 @@
+# prompt_builder.py
+# ©2024, Ovais Quraishi
+"""Token budget aware prompt construction
+
+    Posts can run to thousands of words, comments can be a single word. Token
+    counts are estimated per model, over budget input is truncated, and
+    num_ctx/num_predict are sized to the input instead of using one size for
+    everything.
+"""
+
+import logging
+import math
+import os
+
+# Import required local modules
+import logit
+from config import get_config
+from utils import count_words_and_punctuation
+
+get_config()
+
+# rough tokens per word, LLM_TOKENS_PER_WORD overrides it per model
+#  e.g. llama3.2:1.3,gemma2:1.4
+TOKENS_PER_WORD = float(os.environ.get('PROMPT_TOKENS_PER_WORD', 1.3))
+# default context window size - changing num_ctx makes Ollama reload a model,
+#  so it is only raised for inputs that do not fit
+PROMPT_NUM_CTX = int(os.environ.get('PROMPT_NUM_CTX', 2048))
+# largest context window, LLM_NUM_CTX_MAX overrides it per model
+#  e.g. llama3.2:131072,gemma2:8192
+PROMPT_NUM_CTX_MAX = int(os.environ.get('PROMPT_NUM_CTX_MAX', 8192))
+PROMPT_MIN_PREDICT = int(os.environ.get('PROMPT_MIN_PREDICT', 128))
+PROMPT_MAX_PREDICT = int(os.environ.get('PROMPT_MAX_PREDICT', 1024))
+PROMPT_PREDICT_RATIO = float(os.environ.get('PROMPT_PREDICT_RATIO', 2.0))
+
+TRUNCATION_MARKER = ' [...] '
+
+
+def per_model_setting(env_var, llm, default):
+    """Look up a model's value in a llm:value,llm:value style setting
+    """
+
+    for pair in os.environ.get(env_var, '').split(','):
+        name, _, value = pair.rpartition(':')
+        if name and name in (llm, llm.split(':')[0]):
+            return type(default)(value)
+    return default
+
+def estimate_tokens(text, llm):
+    """Estimate number of tokens text takes up for a given model
+    """
+
+    word_count, punctuation_count = count_words_and_punctuation(text)
+    tokens_per_word = per_model_setting('LLM_TOKENS_PER_WORD', llm, TOKENS_PER_WORD)
+
+    return math.ceil(word_count * tokens_per_word) + punctuation_count
+
+def truncate_text(text, max_tokens, llm):
+    """Cut text down to max_tokens, keeping the head and the tail of it
+        - the gist of a post is usually at its start, the ask at its end
+    """
+
+    words = text.split()
+    ratio = max_tokens / max(estimate_tokens(text, llm), 1)
+    keep = max(int(len(words) * ratio), 1)
+    head = math.ceil(keep * 2 / 3)
+    tail = keep - head
+
+    return ' '.join(words[:head]) + TRUNCATION_MARKER + (' '.join(words[-tail:]) if tail else '')
+
+def build_prompt(llm, prompt, text):
+    """Build prompt content and Ollama options for a given model
+
+        Returns:
+            dict: content, options (num_ctx, num_predict) and input_tokens_estimate
+    """
+
+    num_ctx_max = per_model_setting('LLM_NUM_CTX_MAX', llm, PROMPT_NUM_CTX_MAX)
+    prompt_tokens = estimate_tokens(prompt, llm)
+    input_tokens = estimate_tokens(text, llm)
+
+    # leave room in the context window for the answer
+    input_budget = num_ctx_max - PROMPT_MIN_PREDICT - prompt_tokens
+    if input_tokens > input_budget:
+        info_message = f'Truncating {input_tokens} tokens to {input_budget} for {llm}'
+        logging.info(info_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'INFO', info_message)
+        text = truncate_text(text, input_budget, llm)
+        input_tokens = estimate_tokens(text, llm)
+
+    input_tokens += prompt_tokens
+    num_predict = int(min(max(input_tokens * PROMPT_PREDICT_RATIO, PROMPT_MIN_PREDICT), PROMPT_MAX_PREDICT))
+    num_predict = min(num_predict, num_ctx_max - input_tokens)
+
+    num_ctx = PROMPT_NUM_CTX
+    while num_ctx < input_tokens + num_predict and num_ctx < num_ctx_max:
+        num_ctx *= 2
+
+    return {
+            'content' : prompt + text,
+            'options' : {
+                         'num_ctx' : min(num_ctx, num_ctx_max),
+                         'num_predict' : num_predict
+                        },
+            'input_tokens_estimate' : input_tokens
+           }
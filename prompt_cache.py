@@ -0,0 +1,110 @@
+# prompt_cache.py
+# ©2024, Ovais Quraishi
+"""Content-addressed prompt result cache
+
+    Reddit is full of identical text (copypasta, "this", bot replies). Rather
+    than prompting every model with the same text over and over, prompt results
+    are keyed by (llm, prompt template, normalized text hash) and the key points
+    at the shasum_512 of the analysis document that was produced the first time.
+
+    Hit/miss counters and the GPU seconds that were not spent are kept in a
+    Redis hash so that they add up across all worker processes.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+
+import redis
+
+# Import required local modules
+import logit
+from cache import redis_client
+from config import get_config
+
+get_config()
+
+PROMPT_CACHE_PREFIX = 'prompt_result_'
+PROMPT_CACHE_STATS = 'prompt_cache_stats'
+PROMPT_CACHE_TTL = int(os.environ.get('PROMPT_CACHE_TTL', 2592000)) # 30 days
+
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalize_text(text):
+    """Case fold and collapse whitespace so trivially different copies of the
+        same text hash the same
+    """
+
+    return WHITESPACE_RE.sub(' ', text).strip().casefold()
+
+def prompt_cache_key(llm, prompt, text):
+    """Build cache key from llm, prompt template and normalized text
+    """
+
+    prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()[:16]
+    text_hash = hashlib.sha256(normalize_text(text).encode()).hexdigest()
+
+    return f'{PROMPT_CACHE_PREFIX}{llm}_{prompt_hash}_{text_hash}'
+
+def lookup_prompt_result(cache_key):
+    """Look up a cached prompt result, update hit/miss counters
+
+        Returns:
+            dict: {'shasum_512': ..., 'gpu_seconds': ...} on a hit, otherwise None
+    """
+
+    try:
+        client = redis_client()
+        cached = client.get(cache_key)
+        if cached is None:
+            client.hincrby(PROMPT_CACHE_STATS, 'misses', 1)
+            return None
+
+        prompt_result = json.loads(cached)
+        pipe = client.pipeline()
+        pipe.hincrby(PROMPT_CACHE_STATS, 'hits', 1)
+        pipe.hincrbyfloat(PROMPT_CACHE_STATS, 'gpu_seconds_saved', prompt_result['gpu_seconds'])
+        pipe.execute()
+        return prompt_result
+    except (redis.exceptions.RedisError, ValueError, KeyError) as e:
+        # a broken cache must never stop analysis - treat it as a miss
+        error_message = f'Prompt cache lookup failed {cache_key} {e}'
+        logging.error(error_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'ERROR', error_message)
+        return None
+
+def store_prompt_result(cache_key, shasum_512, gpu_seconds):
+    """Point cache key at the analysis document produced for it
+    """
+
+    prompt_result = {
+                     'shasum_512' : shasum_512,
+                     'gpu_seconds' : gpu_seconds
+                    }
+    try:
+        redis_client().set(cache_key, json.dumps(prompt_result), ex=PROMPT_CACHE_TTL)
+        return True
+    except redis.exceptions.RedisError as e:
+        error_message = f'Prompt cache store failed {cache_key} {e}'
+        logging.error(error_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'ERROR', error_message)
+        return False
+
+def prompt_cache_stats():
+    """Hit ratio and GPU seconds saved by the prompt cache
+    """
+
+    stats = {k.decode('utf-8'): float(v) for k, v in redis_client().hgetall(PROMPT_CACHE_STATS).items()}
+    hits = int(stats.get('hits', 0))
+    misses = int(stats.get('misses', 0))
+    lookups = hits + misses
+
+    return {
+            'hits' : hits,
+            'misses' : misses,
+            'hit_ratio' : hits / lookups if lookups else 0.0,
+            'gpu_seconds_saved' : round(stats.get('gpu_seconds_saved', 0.0), 3)
+           }
@@ -1,31 +1,225 @@
 # reddit_api.py
 # ©2024, Ovais Quraishi
 """Reddit object
+
+    Besides [reddit], setup.config may hold more accounts, one [reddit:<name>]
+    section each with the same options. RedditClientPool keeps an
+    authenticated client per account, each with its own rate limit
+    accounting, and runs work on the least recently limited one. A client
+    that is answered 429, or is close to running out of requests, is set
+    aside until its limit resets and the work goes to another client.
 """
 
 import logging
 import os
+import threading
+import time
+from functools import lru_cache
+
+import asyncpraw
 import praw
 import logit
 from praw import exceptions
+from prawcore import exceptions as prawcore_exceptions
 from config import get_config
 
-def create_reddit_instance():
-    """Create and return a Reddit instance"""
+# set a client aside when fewer requests than this remain in its window
+REDDIT_POOL_MIN_REMAINING = int(os.environ.get('REDDIT_POOL_MIN_REMAINING', 5))
+# how long a limited client is set aside when Reddit does not say
+REDDIT_POOL_LIMITED_SECS = float(os.environ.get('REDDIT_POOL_LIMITED_SECS', 60))
+
+ACCOUNT_SECTION = 'reddit'
+
+
+class RedditPoolExhausted(Exception):
+    """Every Reddit account is rate limited
+    """
+
+
+def endpoint_urls(account=None):
+    """Reddit API base urls, when reddit_oauth_url and reddit_url point
+        somewhere else than Reddit - e.g. tools/reddit_replay.py
+    """
+
+    account = os.environ if account is None else account
+    urls = {'oauth_url' : account.get('reddit_oauth_url'), 'reddit_url' : account.get('reddit_url')}
+    return {k: v for k, v in urls.items() if v}
+
+def credentials(account=None):
+    """praw/asyncpraw keyword arguments of an account section, of [reddit]
+        as loaded into the environment by default
+    """
+
+    account = os.environ if account is None else account
+    return {
+            'client_id' : account['client_id'],
+            'client_secret' : account['client_secret'],
+            'password' : account['rpassword'],
+            'user_agent' : account['user_agent'],
+            'username' : account['username'],
+            **endpoint_urls(account)
+           }
+
+def reddit_accounts():
+    """Credential sections by name, [reddit] first then every
+        [reddit:<name>]
+    """
+
+    config_obj = get_config()
+    if config_obj is None:
+        # no setup.config, the environment holds the one account
+        return {ACCOUNT_SECTION : None}
+
+    return {section : dict(config_obj.items(section)) for section in config_obj.sections()
+            if section == ACCOUNT_SECTION or section.startswith(ACCOUNT_SECTION + ':')}
+
+def create_reddit_instance(account=None):
+    """Create and return a Reddit instance, of [reddit] unless an account
+        section is given
+    """
 
     get_config()
 
     try:
-        reddit = praw.Reddit(
-                             client_id=os.environ['client_id'],
-                             client_secret=os.environ['client_secret'],
-                             password=os.environ['rpassword'],
-                             user_agent=os.environ['user_agent'],
-                             username=os.environ['username'],
-                            )
+        reddit = praw.Reddit(**credentials(account))
         return reddit
     except exceptions.APIException as e:
         error_message = f'Unable to reach Reddit API: {e}'
         logging.error(error_message)
         logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'ERROR', error_message)
         raise
+
+def create_async_reddit_instance(session=None, account=None):
+    """Create and return an asyncpraw Reddit instance, call from within a
+        coroutine. session is an optional aiohttp.ClientSession to send
+        requests through, account an optional account section
+    """
+
+    get_config()
+
+    return asyncpraw.Reddit(
+                            requestor_kwargs={'session' : session} if session else None,
+                            **credentials(account)
+                           )
+
+
+class RedditClient:
+    """praw instance of one account, and when it was last rate limited
+    """
+
+    def __init__(self, name, account):
+        self.name = name
+        self.account = account
+        self.reddit = create_reddit_instance(account)
+        self.limited_until = 0.0
+        self.last_limited_at = 0.0
+        self.calls = 0
+        self.limited = 0
+
+    def remaining(self):
+        return self.reddit.auth.limits.get('remaining')
+
+    def available(self, now):
+        if now < self.limited_until:
+            return False
+        remaining = self.remaining()
+        if remaining is not None and remaining < REDDIT_POOL_MIN_REMAINING:
+            reset = self.reddit.auth.limits.get('reset_timestamp')
+            self.set_aside(reset - now if reset and reset > now else REDDIT_POOL_LIMITED_SECS, f'{remaining} requests remaining')
+            return False
+        return True
+
+    def set_aside(self, secs, reason):
+        now = time.time()
+        self.limited_until = now + secs
+        self.last_limited_at = now
+        self.limited += 1
+        warn_message = f'Reddit account {self.name} limited for {secs:.0f}s, {reason}'
+        logging.warning(warn_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'WARNING', warn_message)
+
+
+class RedditClientPool:
+    """Clients of every configured account, work goes to the least recently
+        limited available one
+    """
+
+    def __init__(self, accounts=None):
+        accounts = reddit_accounts() if accounts is None else accounts
+        self.clients = [RedditClient(name, account) for name, account in accounts.items()]
+        self.lock = threading.Lock()
+
+    def pick(self, exclude=()):
+        """Least recently limited client that can take requests, the least
+            used one of those never limited, None if all are limited
+        """
+
+        now = time.time()
+        with self.lock:
+            candidates = [client for client in self.clients if client not in exclude and client.available(now)]
+            if not candidates:
+                return None
+            client = min(candidates, key=lambda c: (c.last_limited_at, c.calls))
+            client.calls += 1
+            return client
+
+    def retry_after(self):
+        """Seconds until some client takes requests again
+        """
+
+        return max(min(client.limited_until for client in self.clients) - time.time(), 0.0)
+
+    def call(self, func):
+        """func(reddit) on an available client, again on another one if the
+            client is answered 429
+
+            Raises:
+                RedditPoolExhausted: every client is limited
+        """
+
+        tried = []
+        while True:
+            client = self.pick(exclude=tried)
+            if client is None:
+                raise RedditPoolExhausted(f'All Reddit accounts rate limited, retry in {self.retry_after():.0f}s')
+            try:
+                return func(client.reddit)
+            except prawcore_exceptions.TooManyRequests as e:
+                client.set_aside(float(e.retry_after or REDDIT_POOL_LIMITED_SECS), '429 Too Many Requests')
+                tried.append(client)
+
+    def account(self):
+        """Section of the least recently limited account, for an asyncpraw
+            instance of it
+        """
+
+        client = self.pick()
+        if client is None:
+            raise RedditPoolExhausted(f'All Reddit accounts rate limited, retry in {self.retry_after():.0f}s')
+        return client.name, client.account
+
+    def limited(self, name, retry_after=None):
+        """Set an account aside after an asyncpraw instance of it was
+            answered 429
+        """
+
+        for client in self.clients:
+            if client.name == name:
+                client.set_aside(float(retry_after or REDDIT_POOL_LIMITED_SECS), '429 Too Many Requests')
+
+    def state(self):
+        now = time.time()
+        return {client.name : {
+                               'calls' : client.calls,
+                               'limited' : client.limited,
+                               'limited_for_secs' : round(max(client.limited_until - now, 0.0), 1),
+                               'remaining' : client.remaining()
+                              } for client in self.clients}
+
+
+@lru_cache(maxsize=1)
+def reddit_pool():
+    """Client pool of the configured accounts, built once per process
+    """
+
+    return RedditClientPool()
@@ -0,0 +1,105 @@
+# reddit_extract.py
+# ©2024, Ovais Quraishi
+"""posts and comments rows from Reddit JSON
+"""
+
+# Import required local modules
+from language import detect_language
+
+DELETED_AUTHOR = '[deleted]'
+
+
+def thing_data(thing):
+    """Fields of a thing as Reddit sent them
+
+        thing is the data dict of a listing child, or a praw or asyncpraw
+        object - read from its instance dict, so nothing is fetched, unless
+        it is a lazy object that has never been fetched at all
+    """
+
+    if isinstance(thing, dict):
+        return thing
+
+    if not getattr(thing, '_fetched', True) and 'created_utc' not in vars(thing):
+        # built from an id alone, one explicit fetch
+        thing._fetch()
+
+    data = {k: v for k, v in vars(thing).items() if not k.startswith('_')}
+    # praw replaces these with objects whose str is the name sent
+    for field in ('author', 'subreddit'):
+        if data.get(field) is not None and not isinstance(data[field], str):
+            data[field] = str(data[field])
+    return data
+
+def author_name(data):
+    author = data.get('author')
+    return None if author in (None, DELETED_AUTHOR) else author
+
+def post_row(post):
+    """posts table row of a submission, its data or praw or asyncpraw object
+    """
+
+    data = thing_data(post)
+    return {
+            'subreddit': data['subreddit'],
+            'post_id': data['id'],
+            'post_author': author_name(data),
+            'post_title': data['title'],
+            'post_body': data['selftext'],
+            'post_created_utc': int(data['created_utc']),
+            'is_post_oc': data.get('is_original_content'),
+            'is_post_video': data.get('is_video'),
+            'post_upvote_count': data.get('ups'),
+            'post_downvote_count': data.get('downs'),
+            'subreddit_members': data.get('subreddit_subscribers'),
+            'language': detect_language(data['title'] + data['selftext'])
+           }
+
+def comment_row(comment):
+    """comments table row of a comment, its data or praw or asyncpraw object
+    """
+
+    data = thing_data(comment)
+    return {
+            'comment_id': data['id'],
+            'comment_author': author_name(data),
+            'is_comment_submitter': data.get('is_submitter'),
+            'is_comment_edited': str(int(data['edited'])) if data.get('edited') else False,
+            'comment_created_utc': int(data['created_utc']),
+            'comment_upvote_count': data.get('ups'),
+            'comment_downvote_count': data.get('downs'),
+            'comment_body': data['body'],
+            # link_id is t3_<post id>
+            'post_id': data['link_id'].split('_', 1)[1],
+            'subreddit': data['subreddit'],
+            'language': detect_language(data['body'])
+           }
+
+def listing_things(listing):
+    """(kind, data) of every child of a listing payload, or of a list of
+        listings as a comments page answers, replies included
+    """
+
+    listings = listing if isinstance(listing, list) else [listing]
+    for a_listing in listings:
+        for child in a_listing['data']['children']:
+            yield child['kind'], child['data']
+            # replies come nested in their comment, "" when there are none
+            if isinstance(child['data'].get('replies'), dict):
+                yield from listing_things(child['data']['replies'])
+
+def listing_rows(listing):
+    """posts and comments rows of a listing payload, "load more" stubs are
+        left out
+
+        Returns:
+            dict: {'posts': [rows], 'comments': [rows]}
+    """
+
+    rows = {'posts' : [], 'comments' : []}
+    for kind, data in listing_things(listing):
+        if kind == 't3':
+            rows['posts'].append(post_row(data))
+        elif kind == 't1':
+            rows['comments'].append(comment_row(data))
+    return rows
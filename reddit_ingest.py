@@ -0,0 +1,426 @@
+# reddit_ingest.py
+# ©2024, Ovais Quraishi
+"""Asynchronous Reddit ingestion
+"""
+
+import asyncio
+import heapq
+import logging
+import os
+import random
+import time
+
+import aiohttp
+from asyncpraw.models import MoreComments
+from asyncpraw.models.comment_forest import CommentForest
+from asyncprawcore import exceptions
+
+# Import required local modules
+import logit
+from authors import AuthorResolver
+from cache import check_and_increment
+from comment_tree import parent_child_tree_row
+from config import get_config
+from database import get_existing_ids, insert_data_into_table, insert_rows_into_table
+from database import db_get_crawl_checkpoint, db_update_crawl_checkpoint
+from database import db_get_post_comment_ids, db_get_parent_child_tree
+from near_duplicates import index_text
+from reddit_api import create_async_reddit_instance, reddit_pool, RedditPoolExhausted
+from reddit_extract import thing_data, post_row, comment_row
+
+get_config()
+
+INGEST_POST_CONCURRENCY = int(os.environ.get('INGEST_POST_CONCURRENCY', 4))
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', 200))
+# first crawl of a subreddit, Reddit listings stop at about 1000 anyway
+CRAWL_NEW_LIMIT = int(os.environ.get('CRAWL_NEW_LIMIT', 1000))
+CRAWL_HOT_LIMIT = int(os.environ.get('CRAWL_HOT_LIMIT', 25))
+# empty for no limit
+COMMENTS_MORE_LIMIT = int(os.environ.get('COMMENTS_MORE_LIMIT') or 0) or None
+COMMENTS_MORE_THRESHOLD = int(os.environ.get('COMMENTS_MORE_THRESHOLD', 0))
+COMMENTS_MAX_DEPTH = int(os.environ.get('COMMENTS_MAX_DEPTH') or 0) or None
+
+RATE_BUDGET_KEY = 'rollama'
+
+
+class CommentExpansion:
+    """Expands the comment tree of a fetched submission under the
+        COMMENTS_* policy, yielding comments as they arrive
+    """
+
+    def __init__(self, submission, known_ids=frozenset(),
+                 more_limit=COMMENTS_MORE_LIMIT,
+                 threshold=COMMENTS_MORE_THRESHOLD,
+                 max_depth=COMMENTS_MAX_DEPTH):
+        self.submission = submission
+        self.known_ids = known_ids
+        self.more_limit = more_limit
+        self.threshold = threshold
+        self.max_depth = max_depth
+        self.more_calls = 0
+        self.more_skipped = 0
+
+    def wanted(self, more):
+        """True if a MoreComments stub is worth a request
+        """
+
+        if self.max_depth is not None and getattr(more, 'depth', 0) > self.max_depth:
+            return False
+        if more.children:
+            if more.count < self.threshold:
+                return False
+            # every comment behind it is stored already
+            return not self.known_ids.issuperset(more.children)
+        # "continue this thread" stubs do not list their comments, follow
+        #  them only below comments that are new
+        return more.parent_id.split('_', 1)[1] not in self.known_ids
+
+    async def comments(self):
+        pending = []
+        items = self.submission.comments.list()
+        while True:
+            for item in items:
+                if isinstance(item, MoreComments):
+                    # MoreComments sort largest first
+                    heapq.heappush(pending, item)
+                else:
+                    yield item
+
+            more = None
+            while pending:
+                candidate = heapq.heappop(pending)
+                if self.more_limit is not None and self.more_calls >= self.more_limit:
+                    self.more_skipped += len(pending) + 1
+                    pending = []
+                elif self.wanted(candidate):
+                    more = candidate
+                    break
+                else:
+                    self.more_skipped += 1
+            if more is None:
+                return
+
+            more.submission = self.submission
+            result = await more.comments()
+            self.more_calls += 1
+            # morechildren answers a flat list, continue this thread a forest
+            items = result.list() if isinstance(result, CommentForest) else result
+
+
+class RateBudget:
+    """The Redis rate budget shared with the synchronous ingestion code, when
+        it runs out every coroutine of the run pauses, not only the one that
+        found it empty
+    """
+
+    def __init__(self, key=RATE_BUDGET_KEY):
+        self.key = key
+        self.resume_at = 0.0
+
+    async def spend(self):
+        while time.monotonic() < self.resume_at:
+            await asyncio.sleep(self.resume_at - time.monotonic())
+        if not await asyncio.to_thread(check_and_increment, self.key):
+            sleep_for = random.randrange(60, 65)
+            logging.info("Sleeping for %s seconds", sleep_for)
+            self.resume_at = max(self.resume_at, time.monotonic() + sleep_for)
+            await asyncio.sleep(sleep_for)
+
+
+class BatchWriter:
+    """Buffers rows of one table and inserts them INGEST_BATCH_SIZE at a time
+    """
+
+    def __init__(self, table_name, batch_size=INGEST_BATCH_SIZE):
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self.rows = []
+        self.written = 0
+        # inserts run one at a time, in order, so a flush returns only once
+        #  every row added before it is committed
+        self.lock = asyncio.Lock()
+
+    async def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        # swap before awaiting, other coroutines keep adding meanwhile
+        rows, self.rows = self.rows, []
+        async with self.lock:
+            if rows:
+                await asyncio.to_thread(insert_rows_into_table, self.table_name, rows)
+                self.written += len(rows)
+
+
+def index_comments(comments):
+    for comment_id, body in comments:
+        index_text('comment', comment_id, body)
+
+
+class Ingestion:
+    """State of one ingestion run
+    """
+
+    def __init__(self):
+        self.reddit = None
+        self.account = None
+        self.session = None
+        self.reopen_lock = asyncio.Lock()
+        self.failovers = 0
+        self.start_time = time.monotonic()
+        self.budget = RateBudget()
+        self.post_slots = asyncio.Semaphore(INGEST_POST_CONCURRENCY)
+        self.writers = {table : BatchWriter(table) for table in ('posts', 'comments')}
+        self.authors = AuthorResolver()
+        self.author_tasks = []
+        self.pages = 0
+        self.more_calls = 0
+        self.more_skipped = 0
+        self.errors = 0
+        # ids of posts that could not be ingested
+        self.failed = set()
+
+    def submit_author(self, author_name, author_fullname=None):
+        """Queue an author, resolving a batch in the background once it is
+            full
+        """
+
+        if self.authors.add(author_name, author_fullname):
+            self.author_tasks.append(asyncio.create_task(self.authors.flush_async(self.with_failover, self.budget)))
+
+    async def failover(self, reddit, error):
+        """Set the account of reddit aside after a 429 and go on with the
+            least recently rate limited account
+
+            Raises:
+                RedditPoolExhausted: every account is rate limited
+        """
+
+        async with self.reopen_lock:
+            # other coroutines answered 429 on the same account reopen once
+            if reddit is not self.reddit:
+                return
+            reddit_pool().limited(self.account, error.retry_after)
+            self.account, account = await asyncio.to_thread(reddit_pool().account)
+            # the replaced instance is not closed, it shares the session
+            self.reddit = create_async_reddit_instance(self.session, account)
+            self.failovers += 1
+
+    async def with_failover(self, func):
+        """Await func(reddit), again on another account when answered 429
+        """
+
+        while True:
+            reddit = self.reddit
+            try:
+                return await func(reddit)
+            except exceptions.TooManyRequests as e:
+                await self.failover(reddit, e)
+
+    async def load_post(self, reddit, post_id, known_ids, written_ids):
+        """Post and its comments not in known_ids or written_ids, the ids of
+            comments written are added to written_ids
+
+            Returns:
+                tuple: (comment edges, CommentExpansion)
+        """
+
+        await self.budget.spend()
+        submission = await reddit.submission(post_id)
+        submission_data = thing_data(submission)
+        post_data = post_row(submission_data)
+        self.submit_author(post_data['post_author'], submission_data.get('author_fullname'))
+        await asyncio.to_thread(index_text, 'post', post_id, post_data['post_title'] + post_data['post_body'])
+
+        # a retry skips the comments written by the attempt before it
+        expansion = CommentExpansion(submission, known_ids | written_ids)
+        edges = []
+        to_index = []
+        async for comment in expansion.comments():
+            edges.append((comment.id, comment.parent_id))
+            if comment.id in known_ids or comment.id in written_ids:
+                continue
+            data = thing_data(comment)
+            comment_data = comment_row(data)
+            await self.writers['comments'].add(comment_data)
+            written_ids.add(comment.id)
+            self.submit_author(comment_data['comment_author'], data.get('author_fullname'))
+            to_index.append((comment.id, comment.body))
+            if len(to_index) >= INGEST_BATCH_SIZE:
+                await asyncio.to_thread(index_comments, to_index)
+                to_index = []
+        await asyncio.to_thread(index_comments, to_index)
+        # a stored post is not fetched again, store it only once its
+        #  comments are committed, so a failed expansion is retried next crawl
+        await self.writers['comments'].flush()
+        await self.writers['posts'].add(post_data)
+        return edges, expansion
+
+    async def fetch_post(self, post_id):
+        """Post, its comments not stored yet and, in the background, its
+            authors
+        """
+
+        async with self.post_slots:
+            known_ids = await asyncio.to_thread(db_get_post_comment_ids, post_id)
+            written_ids = set()
+            try:
+                edges, expansion = await self.with_failover(
+                                       lambda reddit: self.load_post(reddit, post_id, known_ids, written_ids))
+            except (AttributeError, exceptions.AsyncPrawcoreException, RedditPoolExhausted) as e:
+                self.errors += 1
+                self.failed.add(post_id)
+                error_message = f'Unable to ingest post {post_id} {e}'
+                logging.error(error_message)
+                logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'ERROR', error_message)
+                return
+
+        self.more_calls += expansion.more_calls
+        self.more_skipped += expansion.more_skipped
+        stored_tree = await asyncio.to_thread(db_get_parent_child_tree, post_id) if known_ids else None
+        tree_row = parent_child_tree_row(post_id, edges, stored_tree)
+        if tree_row:
+            await asyncio.to_thread(insert_data_into_table, 'parent_child_tree_data', tree_row)
+
+    async def open(self):
+        # the least recently rate limited account, see reddit_api.RedditClientPool
+        self.account, account = await asyncio.to_thread(reddit_pool().account)
+        self.session = aiohttp.ClientSession(trace_configs=[self.page_counter()])
+        self.reddit = create_async_reddit_instance(self.session, account)
+
+    async def fetch_posts(self, post_ids):
+        await asyncio.gather(*[self.fetch_post(post_id) for post_id in post_ids])
+        self.author_tasks.append(asyncio.create_task(self.authors.flush_async(self.with_failover, self.budget)))
+        # a failed author batch, e.g. a database error, does not fail the run
+        for result in await asyncio.gather(*self.author_tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                self.errors += 1
+                error_message = f'Unable to resolve authors {result}'
+                logging.error(error_message)
+                logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'ERROR', error_message)
+        await self.flush()
+
+    async def flush(self):
+        for writer in self.writers.values():
+            await writer.flush()
+
+    async def close(self):
+        await self.flush()
+        await self.reddit.close()
+        await self.session.close()
+
+    def page_counter(self):
+        """aiohttp trace counting every request asyncpraw sends
+        """
+
+        async def on_request_start(session, context, params):
+            self.pages += 1
+
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(on_request_start)
+        return trace
+
+    def report(self, sub=None):
+        elapsed = time.monotonic() - self.start_time
+        minutes = elapsed / 60
+        return {
+                'subreddit' : sub,
+                'account' : self.account,
+                'account_failovers' : self.failovers,
+                'elapsed_secs' : round(elapsed, 3),
+                'pages' : self.pages,
+                'pages_per_min' : round(self.pages / minutes, 2) if minutes else 0.0,
+                'posts' : self.writers['posts'].written,
+                'comments' : self.writers['comments'].written,
+                'authors' : self.authors.written,
+                'author_lookups' : self.authors.lookups,
+                'authors_missing' : self.authors.missing,
+                'more_comments_expanded' : self.more_calls,
+                'more_comments_skipped' : self.more_skipped,
+                'errors' : self.errors
+               }
+
+
+async def list_new_posts(subreddit, checkpoint):
+    """Posts of the new listing, newest first, down to the checkpoint - the
+        listing is fetched a page at a time, so stopping early saves requests
+    """
+
+    posts = []
+    async for post in subreddit.new(limit=CRAWL_NEW_LIMIT):
+        if checkpoint and (post.fullname == checkpoint['newest_fullname']
+                           or post.created_utc < checkpoint['newest_created_utc']):
+            break
+        posts.append(post)
+    return posts
+
+async def list_posts(reddit, sub, checkpoint):
+    """New posts down to the checkpoint, and the CRAWL_HOT_LIMIT hot ones
+    """
+
+    subreddit = await reddit.subreddit(sub)
+    new_posts = await list_new_posts(subreddit, checkpoint)
+    hot_posts = [post async for post in subreddit.hot(limit=CRAWL_HOT_LIMIT)]
+    return new_posts, hot_posts
+
+async def ingest_subreddit(sub):
+    """Ingest the posts of a subreddit that are not in the database yet,
+        with their comments and authors
+
+        Returns:
+            dict: counts and pages fetched per minute
+    """
+
+    info_message = f'Getting posts in subreddit {sub}'
+    logging.info(info_message)
+    logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'INFO', info_message)
+
+    ingestion = Ingestion()
+    await ingestion.open()
+    try:
+        checkpoint = await asyncio.to_thread(db_get_crawl_checkpoint, sub)
+        new_posts, hot_posts = await ingestion.with_failover(lambda reddit: list_posts(reddit, sub, checkpoint))
+
+        post_ids = {post.id for post in new_posts + hot_posts}
+        new_post_ids = post_ids - await asyncio.to_thread(get_existing_ids, 'posts', 'post_id', post_ids)
+
+        await ingestion.fetch_posts(new_post_ids)
+
+        # the listing stops at the checkpoint, keep it below the oldest post
+        #  that failed so the next crawl lists that post again
+        failed = [i for i, post in enumerate(new_posts) if post.id in ingestion.failed]
+        checkpoint_posts = new_posts[max(failed) + 1:] if failed else new_posts
+        if checkpoint_posts:
+            await asyncio.to_thread(db_update_crawl_checkpoint,
+                                    sub,
+                                    checkpoint_posts[0].fullname,
+                                    int(checkpoint_posts[0].created_utc),
+                                    len(new_post_ids),
+                                    ingestion.pages)
+    finally:
+        await ingestion.close()
+
+    report = ingestion.report(sub)
+    info_message = f'Ingested subreddit {report}'
+    logging.info(info_message)
+    logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'INFO', info_message)
+    return report
+
+async def ingest_posts(post_ids):
+    """Fetch posts, new or stored, with the comments and authors not stored
+        yet
+
+        Returns:
+            dict: counts and pages fetched per minute
+    """
+
+    ingestion = Ingestion()
+    await ingestion.open()
+    try:
+        await ingestion.fetch_posts(post_ids)
+    finally:
+        await ingestion.close()
+
+    return ingestion.report()
@@ -0,0 +1,273 @@
+# resilience.py
+# ©2024, Ovais Quraishi
+"""Retries and circuit breakers for Ollama calls
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import httpx
+import redis
+from ollama import ResponseError
+
+# Import required local modules
+import logit
+from cache import redis_client
+from config import get_config
+
+get_config()
+
+OLLAMA_API_URLS = [url.strip() for url in (os.environ.get('OLLAMA_API_URLS') or os.environ.get('OLLAMA_API_URL', '')).split(',') if url.strip()]
+RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', 4))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', 1.0))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 30.0))
+# retries may add at most this share of calls, plus RETRY_BUDGET_MIN
+RETRY_BUDGET_RATIO = float(os.environ.get('RETRY_BUDGET_RATIO', 0.1))
+RETRY_BUDGET_MIN = int(os.environ.get('RETRY_BUDGET_MIN', 10))
+BREAKER_FAILURES = int(os.environ.get('BREAKER_FAILURES', 5))
+BREAKER_RESET_SECS = float(os.environ.get('BREAKER_RESET_SECS', 30.0))
+
+BREAKER_STATE = 'ollama_breakers'
+RETRY_STATS = 'ollama_retry_stats'
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# errors worth trying again, on this or another host
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ReadError, httpx.RemoteProtocolError, httpx.TimeoutException)
+
+
+class OllamaUnavailable(Exception):
+    """No healthy Ollama host, or retries exhausted
+    """
+
+
+class OllamaNotConfigured(Exception):
+    """Neither OLLAMA_API_URLS nor OLLAMA_API_URL names a host
+    """
+
+
+def is_retryable(error):
+    """True for connection failures, timeouts and server side errors
+    """
+
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    # Ollama answers 5xx while a model fails to load or the host is overloaded
+    return isinstance(error, ResponseError) and error.status_code >= 500
+
+def backoff_delay(attempt):
+    """Full jitter exponential backoff, in seconds
+    """
+
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+def count(field, amount=1):
+    """Bump a retry counter - only failures are counted, so this stays off
+        the hot path
+    """
+
+    try:
+        redis_client().hincrby(RETRY_STATS, field, amount)
+    except redis.exceptions.RedisError:
+        pass
+
+
+class RetryBudget:
+    """Token bucket of retries, every call deposits RETRY_BUDGET_RATIO of a
+        retry and every retry withdraws a whole one
+    """
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, minimum=RETRY_BUDGET_MIN):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.tokens = float(minimum)
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            # cap keeps a long quiet spell from banking a retry storm
+            self.tokens = min(self.tokens + self.ratio, self.minimum + 100 * self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class CircuitBreaker:
+    """closed -> open after BREAKER_FAILURES consecutive failures,
+        open -> half_open after BREAKER_RESET_SECS, half_open -> closed on a
+        successful trial call or back to open on a failed one
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= BREAKER_RESET_SECS:
+                self.transition(HALF_OPEN)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def retry_after(self):
+        """Seconds until the breaker lets a call through again
+        """
+
+        with self.lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(BREAKER_RESET_SECS - (time.monotonic() - self.opened_at), 0.0)
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.trial_in_flight = False
+            if self.state != CLOSED:
+                self.transition(CLOSED)
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= BREAKER_FAILURES):
+                self.opened_at = time.monotonic()
+                self.transition(OPEN)
+
+    def transition(self, state):
+        old_state, self.state = self.state, state
+        message = f'Circuit breaker {self.host} {old_state} -> {state} after {self.failures} failures'
+        if state == OPEN:
+            logging.warning(message)
+        else:
+            logging.info(message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'WARNING' if state == OPEN else 'INFO', message)
+        try:
+            redis_client().hset(BREAKER_STATE, self.host, json.dumps({
+                                                                      'state' : state,
+                                                                      'failures' : self.failures,
+                                                                      'changed_at' : time.time(),
+                                                                      'pid' : os.getpid()
+                                                                     }))
+        except redis.exceptions.RedisError:
+            pass
+
+
+class HostPool:
+    """Ollama hosts behind circuit breakers, with a shared retry budget
+    """
+
+    def __init__(self, hosts=None):
+        self.hosts = hosts or OLLAMA_API_URLS
+        self.breakers = {host : CircuitBreaker(host) for host in self.hosts}
+        self.budget = RetryBudget()
+        self.in_flight = {host : 0 for host in self.hosts}
+
+    def configured(self):
+        """The hosts of the pool
+
+            Raises:
+                OllamaNotConfigured: the pool has no host
+        """
+
+        if not self.hosts:
+            error_message = 'No Ollama host configured, set OLLAMA_API_URLS or OLLAMA_API_URL'
+            logging.error(error_message)
+            logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'ERROR', error_message)
+            raise OllamaNotConfigured(error_message)
+        return self.hosts
+
+    def pick(self, exclude=()):
+        """Least busy host whose breaker lets a call through, preferring
+            hosts not in exclude, None if every breaker is open
+        """
+
+        candidates = sorted(self.hosts, key=lambda host: (host in exclude, self.in_flight[host]))
+        for host in candidates:
+            if self.breakers[host].allow_request():
+                return host
+        return None
+
+    def retry_after(self):
+        """Seconds until some host accepts calls again
+        """
+
+        return min(breaker.retry_after() for breaker in self.breakers.values())
+
+    async def call(self, func):
+        """Await func(host) on a healthy host, retrying failures elsewhere
+
+            Raises:
+                OllamaUnavailable: no healthy host, or retries/budget exhausted
+        """
+
+        self.configured()
+        self.budget.deposit()
+        tried = []
+        for attempt in range(RETRY_MAX_ATTEMPTS):
+            host = self.pick(exclude=tried)
+            if host is None:
+                count('shed')
+                raise OllamaUnavailable(f'All Ollama hosts unavailable, retry in {self.retry_after():.1f}s')
+
+            self.in_flight[host] += 1
+            try:
+                result = await func(host)
+                self.breakers[host].success()
+                return result
+            except Exception as e:
+                if not is_retryable(e):
+                    # the host answered, the request was bad - not its fault
+                    self.breakers[host].success()
+                    raise
+                self.breakers[host].failure()
+                tried.append(host)
+                warn_message = f'Ollama call to {host} failed, attempt {attempt + 1} of {RETRY_MAX_ATTEMPTS} {e}'
+                logging.warning(warn_message)
+                logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'WARNING', warn_message)
+                if attempt + 1 >= RETRY_MAX_ATTEMPTS:
+                    count('exhausted')
+                    raise OllamaUnavailable(f'Retries exhausted {e}') from e
+                if not self.budget.withdraw():
+                    count('budget_exhausted')
+                    raise OllamaUnavailable(f'Retry budget exhausted {e}') from e
+            finally:
+                self.in_flight[host] -= 1
+
+            count('retries')
+            await asyncio.sleep(backoff_delay(attempt))
+
+    def state(self):
+        return {host : {'state' : breaker.state, 'failures' : breaker.failures} for host, breaker in self.breakers.items()}
+
+
+OLLAMA_HOSTS = HostPool()
+
+
+def resilience_stats():
+    """Breaker states as last published by any worker, and retry counters
+    """
+
+    client = redis_client()
+    return {
+            'breakers' : {k.decode('utf-8'): json.loads(v) for k, v in client.hgetall(BREAKER_STATE).items()},
+            'retries' : {k.decode('utf-8'): int(v) for k, v in client.hgetall(RETRY_STATS).items()}
+           }
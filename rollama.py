@@ -46,30 +46,48 @@ import json
 import logging
 import os
 import random
+import threading
 import time
 
-import langdetect
-from langdetect import detect
 import openlit
 from flask import Flask, request, jsonify
 from flask_jwt_extended import JWTManager, jwt_required, create_access_token
 from prawcore import exceptions
-from concurrent.futures import ProcessPoolExecutor
 
 # Import required local modules
+from analysis_scheduler import ModelAffinityQueue, report_batch, percentile
+from authors import AuthorResolver, chunked
 from cache import add_key, lookup_key, check_and_increment
+from comment_tree import thread
+from concurrency import AIMDController, AdaptiveLimiter
 from config import get_config
 from database import db_get_authors
 from database import insert_data_into_table
-from database import get_new_data_ids
+from database import get_existing_ids, insert_rows_into_table
 from database import get_select_query_results
 from database import get_select_query_result_dicts
 from database import db_get_post_ids
 from database import db_get_comment_ids
+from embeddings import embed_pending, similar, EMBED_TOP_K
+from encryption import rotate_analysis_documents
+from evaluation import evaluate_analyses
 from gptutils import prompt_chat
-from reddit_api import create_reddit_instance
-from utils import unix_ts_str, get_vals_list_of_dicts
-from utils import calculate_prompt_completion_time, store_model_perf_info
+from language import detect_language, is_analyzed_language, backfill_languages
+from ollama_residency import ResidencyManager, residency as ollama_residency
+from near_duplicates import find_near_duplicate_analysis, near_duplicate_hits
+from pipeline import Pipeline, Stage
+from pipeline import PIPELINE_LOAD_CONCURRENCY, PIPELINE_FILTER_CONCURRENCY
+from pipeline import PIPELINE_PERSIST_CONCURRENCY
+from prompt_builder import build_prompt
+from prompt_cache import prompt_cache_key, lookup_prompt_result
+from prompt_cache import store_prompt_result, prompt_cache_stats
+from reddit_api import reddit_pool, RedditPoolExhausted
+from reddit_extract import thing_data, post_row, comment_row
+from reddit_ingest import ingest_subreddit, ingest_posts
+from resilience import OLLAMA_HOSTS, OllamaUnavailable, resilience_stats
+from sanitizer import sanitizer_stats
+from utils import unix_ts_str, get_vals_list_of_dicts, ts_int_to_dt_obj
+from utils import store_model_perf_info
 from logit import log_message_to_db, get_rollama_version
 
 app = Flask('RedditScraper')
@@ -85,8 +103,14 @@ openlit.init(otlp_endpoint=os.environ['OTLP_ENDPOINT_URL'],
              application_name='reddit-scraper')
 
 NUM_ELEMENTS_CHUNK = 25
+# fullnames per reddit.info request, Reddit's limit
+INFO_BATCH_SIZE = 100
 LLMS = os.environ['LLMS'].split(',')
 PROC_WORKERS = int(os.environ['PROC_WORKERS'])
+# times an item waits out an Ollama outage before it is recorded in errors
+REQUEUE_MAX = int(os.environ.get('REQUEUE_MAX', 3))
+# in-flight prompts per model and host, PROC_WORKERS is the ceiling
+CONCURRENCY_CONTROLLER = AIMDController(max_limit=PROC_WORKERS)
 
 # Flask app config
 app.config.update(
@@ -96,8 +120,10 @@ app.config.update(
                  )
 jwt = JWTManager(app)
 
-# Reddit authentication
-REDDIT = create_reddit_instance()
+# Reddit authentication, one client per configured account - REDDIT is the
+#  [reddit] account
+REDDIT_POOL = reddit_pool()
+REDDIT = REDDIT_POOL.clients[0].reddit
 
 @app.route('/login', methods=['POST'])
 def login():
@@ -161,19 +187,29 @@ def analyze_posts():
     if not post_ids:
         return
 
-    with ProcessPoolExecutor(max_workers=PROC_WORKERS) as executor:  # PROC_WORKERS in setup.cfg
-        futures = [executor.submit(analyze_post, a_post_id) for a_post_id in post_ids]
-        results = [future.result() for future in futures]  # if you need the result of each analysis
-        
+    report = asyncio.run(run_analysis(post_ids, load_post))
 
     info_message = 'All posts analyzed'
     logging.info(info_message)
     log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'INFO', info_message)
+    return report
 
 def analyze_post(post_id):
     """Analyze text from Reddit Post
     """
 
+    work_item = load_post(post_id)
+    if work_item and claim_work_item(work_item):
+        for llm in LLMS:
+            prompt_and_store(llm, *work_item)
+
+def load_post(post_id):
+    """Load text of a Reddit Post
+
+        Returns:
+            tuple: (category, reference_id, prompt, text) work item, or None
+    """
+
     print (f'Analyzing post ID {post_id}')
     info_message = f'Analyzing post ID {post_id}'
     logging.info(info_message)
@@ -201,54 +237,13 @@ def analyze_post(post_id):
         warn_message = f'Post ID {post_id} contains no body' 
         logging.warning(warn_message)
         log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'WARNING', warn_message)
-        return
+        return None
 
     # post_title, post_body for ChatGPT
     text = post_data['post_title'] + post_data['post_body']
-    # post_id
-    post_id = post_data['post_id']
-    if add_key('post_id_' + post_id):
-        try:
-            language = detect(text)
-            # starting at ollama 0.1.24 and .25, it hangs on greek text
-            if language not in ('en'):
-                add_key('post_id_' + post_id)
-                info_message = f'Skipping {post_id} - language detected {language}'
-                logging.info(info_message)
-                log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'INFO', info_message)
-                return
-        except langdetect.lang_detect_exception.LangDetectException as e:
-            add_key('post_id_' + post_id)
-            info_message = f'Skipping {post_id} - language detected UNKNOWN {e}'
-            logging.info(info_message)
-            log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'INFO', info_message)
-            
-        prompt = 'respond to this post title and post body: '
+    prompt = 'respond to this post title and post body: '
 
-        for llm in LLMS:
-            start_time = time.time()
-            analyzed_obj, _ = asyncio.run(prompt_chat(llm, prompt + text, False))
-            end_time = time.time()
-            prompt_completion_time = calculate_prompt_completion_time(start_time, end_time)
-
-            # jsonb document
-            #  schema_version key added starting v2
-            analysis_document = {
-                                'schema_version' : '4',
-                                'source' : 'reddit',
-                                'category' : 'post',
-                                'reference_id' : post_id,
-                                'llm' : llm,
-                            'analysis' : analyzed_obj['analysis']
-                            }
-        analysis_data = {
-                        'timestamp': analyzed_obj['timestamp'],
-                        'shasum_512' : analyzed_obj['shasum_512'],
-                        'analysis_document' : json.dumps(analysis_document),
-                        'ollama_ver' : analyzed_obj['ollama_ver']
-                        }
-        insert_data_into_table('analysis_documents', analysis_data)
-        store_model_perf_info(llm, analyzed_obj, prompt_completion_time)
+    return 'post', post_data['post_id'], prompt, text
 
 @app.route('/analyze_comment', methods=['GET'])
 @jwt_required()
@@ -281,18 +276,29 @@ def analyze_comments():
         log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'WARNING', warn_message)
         return
 
-    with ProcessPoolExecutor(max_workers=PROC_WORKERS) as executor:  # PROC_WORKERS in setup.cfg
-        futures = [executor.submit(analyze_comment, a_comment_id) for a_comment_id in comment_ids]
-        results = [future.result() for future in futures]  # if you need the result of each analysis
+    report = asyncio.run(run_analysis(comment_ids, load_comment))
 
     info_message = 'All comments analyzed'
     logging.info(info_message)
     log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'INFO', info_message)
+    return report
 
 def analyze_comment(comment_id):
     """Analyze text
     """
 
+    work_item = load_comment(comment_id)
+    if work_item and claim_work_item(work_item):
+        for llm in LLMS:
+            prompt_and_store(llm, *work_item)
+
+def load_comment(comment_id):
+    """Load text of a Reddit comment
+
+        Returns:
+            tuple: (category, reference_id, prompt, text) work item, or None
+    """
+
     info_message = f'Analyzing comment ID {comment_id}'
     logging.info(info_message)
     log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'INFO', info_message)
@@ -314,55 +320,429 @@ def analyze_comment(comment_id):
         warn_message = f'Comment ID {comment_id} contains no body'
         logging.warning(warn_message)
         log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'WARNING', warn_message)
-        return
+        return None
 
     # comment_body for ChatGPT
     text = comment_data[0][1]
-    # comment_id
-    comment_id = comment_data[0][0]
-    if add_key('comment_id_' + comment_id): 
+    prompt = 'respond to this comment: '
+
+    return 'comment', comment_data[0][0], prompt, text
+
+def claim_work_item(work_item):
+    """Claim a work item so that no other worker analyzes it, and filter it
+        by language
+
+        Returns:
+            bool: True if the work item is to be analyzed
+    """
+
+    category, reference_id, _, text = work_item
+    key = f'{category}_id_{reference_id}'
+
+    # rows ingested with a language are already filtered in SQL, this catches
+    #  rows from before the language column, at the cost of a cache lookup
+    language = detect_language(text)
+    # starting at ollama 0.1.24 and .25, it hangs on greek text
+    if not is_analyzed_language(language):
+        add_key(key)
+        info_message = f'Skipping {reference_id} - language detected {language}'
+        logging.info(info_message)
+        log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'INFO', info_message)
+        return False
+
+    if not add_key(key):
+        return False
+
+    return True
+
+async def run_analysis(reference_ids, load_func):
+    """Prompt every model in LLMS with the text of every reference id
+
+        Runs as an asyncio pipeline: load -> language_filter -> prompt -> persist.
+        Blocking DB and cache service calls run in threads, prompts are awaited
+        directly. The prompt stage serves one model at a time, the next model
+        is loaded while the last prompts of the current one are in flight, and
+        a model is unloaded once its last prompt completes. Prompts go to the
+        healthiest Ollama host in OLLAMA_API_URLS, an item that finds every
+        host unavailable waits for one to recover, up to REQUEUE_MAX times.
+    """
+
+    hosts = OLLAMA_HOSTS.configured()
+    limiter = AdaptiveLimiter(CONCURRENCY_CONTROLLER)
+    residency = ResidencyManager(LLMS, hosts)
+    model_stats = {llm : {'start_time' : None, 'end_time' : None, 'stats' : []} for llm in LLMS}
+
+    def concurrency(llm):
+        # prompts of a model in flight at once, over all hosts
+        return sum(CONCURRENCY_CONTROLLER.limit(llm, host) for host in hosts)
+
+    def preload(llm, pending):
+        # one thread per host, a slow host does not hold up the others
+        for host in hosts:
+            threading.Thread(target=residency.preload,
+                             args=(llm, pending, concurrency(llm), host),
+                             daemon=True).start()
+
+    def preload_next_model(llm, next_llm):
+        if next_llm:
+            preload(next_llm, prompt_queue.pending(next_llm))
+
+    prompt_queue = ModelAffinityQueue(LLMS, on_drained=preload_next_model)
+    # the queue serves the first model in LLMS first
+    preload(LLMS[0], len(reference_ids))
+
+    async def load(reference_id):
+        return await asyncio.to_thread(load_func, reference_id)
+
+    async def language_filter(work_item):
+        if await asyncio.to_thread(claim_work_item, work_item):
+            return work_item
+        return None
+
+    async def prompt(llm_work_item):
+        llm, work_item = llm_work_item
+        if model_stats[llm]['start_time'] is None:
+            model_stats[llm]['start_time'] = time.time()
+
+        residency.started(llm)
+        if prompt_queue.drained(llm):
+            await asyncio.to_thread(residency.drained, llm)
+        keep_alive = residency.keep_alive_for(llm, prompt_queue.pending(llm), concurrency(llm))
+
+        async def prompt_on(prompt_host):
+            await limiter.acquire(llm, prompt_host)
+            prompt_work = None
+            try:
+                prompt_work = await prompt_work_item(llm, work_item, keep_alive, prompt_host)
+            finally:
+                if prompt_work and 'analyzed_obj' in prompt_work:
+                    await limiter.release(llm,
+                                          prompt_host,
+                                          prompt_work['prompt_completion_time'],
+                                          prompt_work['analyzed_obj']['tokens_per_second'])
+                else:
+                    await limiter.release(llm, prompt_host)
+            return prompt_work
+
+        prompt_work = None
         try:
-            language = detect(text)
-            # starting at ollama 0.1.24 and .25, it hangs on greek text
-            if language not in ('en'):
-                add_key('comment_id_' + comment_id)
-                info_message = f'Skipping {comment_id} - language detected {language}'
-                logging.info(info_message)
-                log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'INFO', info_message)
-                return
-        except langdetect.lang_detect_exception.LangDetectException as e:
-            add_key('comment_id_' + comment_id)
-            info_message = f'Skipping {comment_id} - language detected UNKNOWN {e}'
-            logging.info(info_message)
-            log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'INFO', info_message)
+            for attempt in range(REQUEUE_MAX + 1):
+                try:
+                    prompt_work = await OLLAMA_HOSTS.call(prompt_on)
+                    break
+                except OllamaUnavailable as e:
+                    if attempt == REQUEUE_MAX:
+                        await asyncio.to_thread(record_prompt_failure, llm, work_item, e)
+                        return None
+                    await asyncio.sleep(max(OLLAMA_HOSTS.retry_after(), 1.0))
+            if empty_completion(prompt_work):
+                await asyncio.to_thread(record_prompt_failure, llm, work_item, 'generation cut off before the first token')
+                return None
+        finally:
+            if prompt_work and 'analyzed_obj' in prompt_work:
+                await asyncio.to_thread(residency.finished, llm, prompt_work['prompt_completion_time'])
+            else:
+                await asyncio.to_thread(residency.finished, llm)
+        return prompt_work
+
+    async def persist(prompt_work):
+        stats = await asyncio.to_thread(store_prompt_work, prompt_work)
+        llm = prompt_work['llm']
+        model_stats[llm]['stats'].append(stats)
+        model_stats[llm]['end_time'] = time.time()
+        return prompt_work
+
+    pipeline = Pipeline('analysis',
+                        [
+                         Stage('load', load, PIPELINE_LOAD_CONCURRENCY),
+                         Stage('language_filter', language_filter, PIPELINE_FILTER_CONCURRENCY),
+                         # max_limit is the ceiling of one host
+                         Stage('prompt', prompt, CONCURRENCY_CONTROLLER.max_limit * len(hosts), queue=prompt_queue),
+                         Stage('persist', persist, PIPELINE_PERSIST_CONCURRENCY)
+                        ])
+    report = await pipeline.run(reference_ids)
+
+    report['models'] = {}
+    for llm, llm_stats in model_stats.items():
+        if llm_stats['stats']:
+            report['models'][llm] = report_batch(llm,
+                                                 len(llm_stats['stats']),
+                                                 llm_stats['stats'],
+                                                 llm_stats['end_time'] - llm_stats['start_time'])
+    completion_times = [stats['prompt_completion_time'] for llm_stats in model_stats.values() for stats in llm_stats['stats'] if stats]
+    report['p50_prompt_completion_time'] = round(percentile(completion_times, 50), 3)
+    report['p95_prompt_completion_time'] = round(percentile(completion_times, 95), 3)
+    return report
+
+def record_prompt_failure(llm, work_item, error):
+    """Record a work item no Ollama host could prompt
+    """
 
-        prompt = 'respond to this comment: '
+    category, reference_id, _, _ = work_item
+    error_message = f'Unable to prompt {llm} for {category} {reference_id} {error}'
+    logging.error(error_message)
+    log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'ERROR', error_message)
+    insert_data_into_table('errors', {
+                                      'item_id' : reference_id,
+                                      'item_type' : category,
+                                      'error' : error_message
+                                     })
+
+def empty_completion(prompt_work):
+    """True for a generation cut off before its first token - storing it
+        would mark the work item analyzed, as analysis shasums are unique
+    """
 
-        for llm in LLMS:
-            start_time = time.time()
-            analyzed_obj, _ = asyncio.run(prompt_chat(llm, prompt + text, False))
-            end_time = time.time()
-            prompt_completion_time = calculate_prompt_completion_time(start_time, end_time)
-
-            # jsonb document
-            #  schema_version key added starting v2
-            analysis_document = {
-                                'schema_version' : '4',
-                                'source' : 'reddit',
-                                'category' : 'comment',
-                                'reference_id' : comment_id,
-                                'llm' : llm,
-                                'analysis' : analyzed_obj['analysis']
-                                }
-            analysis_data = {
-                            'timestamp': analyzed_obj['timestamp'],
-                            'shasum_512' : analyzed_obj['shasum_512'],
-                            'analysis_document' : json.dumps(analysis_document),
-                            'ollama_ver' : analyzed_obj['ollama_ver']
-                            }
-
-            insert_data_into_table('analysis_documents', analysis_data)
-            store_model_perf_info(llm, analyzed_obj, prompt_completion_time)
+    analyzed_obj = prompt_work.get('analyzed_obj')
+    return bool(analyzed_obj and analyzed_obj['completion_truncated'] and not analyzed_obj['analysis'])
+
+async def prompt_work_item(llm, work_item, keep_alive=None, host=None):
+    """Chat prompt an llm with the text of a work item, unless the same prompt
+        and text have already been answered by this llm
+
+        Returns:
+            dict: prompt work for store_prompt_work
+    """
+
+    category, reference_id, prompt, text = work_item
+    cache_key = prompt_cache_key(llm, prompt, text)
+    prompt_work = {
+                   'llm' : llm,
+                   'category' : category,
+                   'reference_id' : reference_id,
+                   'cache_key' : cache_key
+                  }
+
+    prompt_result = await asyncio.to_thread(lookup_prompt_result, cache_key)
+    if prompt_result:
+        prompt_work['cached_shasum_512'] = prompt_result['shasum_512']
+        return prompt_work
+
+    near_duplicate = await asyncio.to_thread(find_near_duplicate_analysis, llm, category, reference_id, text)
+    if near_duplicate:
+        prompt_work['cached_shasum_512'] = near_duplicate['shasum_512']
+        prompt_work['near_duplicate'] = near_duplicate
+        return prompt_work
+
+    built_prompt = await asyncio.to_thread(build_prompt, llm, prompt, text)
+    start_time = time.time()
+    analyzed_obj, _ = await prompt_chat(llm,
+                                        built_prompt['content'],
+                                        False,
+                                        keep_alive=keep_alive,
+                                        options=built_prompt['options'],
+                                        host=host)
+    end_time = time.time()
+    analyzed_obj['input_tokens_estimate'] = built_prompt['input_tokens_estimate']
+
+    prompt_work['analyzed_obj'] = analyzed_obj
+    prompt_work['prompt_completion_time'] = end_time - start_time
+    return prompt_work
+
+def store_prompt_work(prompt_work):
+    """Store the analysis document and model performance info of prompt work
+
+        Returns:
+            dict: completion time, tokens/sec, load, prompt eval and eval durations,
+                  None for a prompt cache hit
+    """
+
+    llm = prompt_work['llm']
+    if 'cached_shasum_512' in prompt_work:
+        store_cached_analysis(llm,
+                              prompt_work['category'],
+                              prompt_work['reference_id'],
+                              prompt_work['cached_shasum_512'],
+                              prompt_work.get('near_duplicate'))
+        return None
+
+    analyzed_obj = prompt_work['analyzed_obj']
+
+    # jsonb document
+    #  schema_version key added starting v2
+    analysis_document = {
+                         'schema_version' : '4',
+                         'source' : 'reddit',
+                         'category' : prompt_work['category'],
+                         'reference_id' : prompt_work['reference_id'],
+                         'llm' : llm,
+                         'analysis' : analyzed_obj['analysis'],
+                         'completion_truncated' : analyzed_obj.get('completion_truncated', False)
+                        }
+    analysis_data = {
+                     'timestamp': analyzed_obj['timestamp'],
+                     'shasum_512' : analyzed_obj['shasum_512'],
+                     'analysis_document' : json.dumps(analysis_document),
+                     'ollama_ver' : analyzed_obj['ollama_ver']
+                    }
+
+    insert_data_into_table('analysis_documents', analysis_data)
+    store_model_perf_info(llm, analyzed_obj, int(prompt_work['prompt_completion_time']))
+    # a cut off answer is not reused for the same text later
+    if not analysis_document['completion_truncated']:
+        store_prompt_result(prompt_work['cache_key'], analyzed_obj['shasum_512'], prompt_work['prompt_completion_time'])
+
+    return {
+            'prompt_completion_time' : prompt_work['prompt_completion_time'],
+            'tokens_per_second' : analyzed_obj['tokens_per_second'],
+            'load_duration' : analyzed_obj['load_duration'],
+            'prompt_eval_duration' : analyzed_obj['prompt_eval_duration'],
+            'eval_duration' : analyzed_obj['eval_duration']
+           }
+
+def prompt_and_store(llm, category, reference_id, prompt, text, keep_alive=None):
+    """Chat prompt an llm with text and store the analysis document
+    """
+
+    work_item = (category, reference_id, prompt, text)
+    prompt_work = asyncio.run(OLLAMA_HOSTS.call(lambda host: prompt_work_item(llm, work_item, keep_alive, host)))
+    if empty_completion(prompt_work):
+        record_prompt_failure(llm, work_item, 'generation cut off before the first token')
+        return None
+    return store_prompt_work(prompt_work)
+
+def store_cached_analysis(llm, category, reference_id, cached_shasum_512, near_duplicate=None):
+    """Store an analysis document that points at a previously stored analysis
+        instead of carrying its own copy of the analysis text
+    """
+
+    if near_duplicate:
+        info_message = f'Near duplicate hit {category} {reference_id} {llm} of {near_duplicate["reference_id"]} similarity {near_duplicate["similarity"]}'
+    else:
+        info_message = f'Prompt cache hit {category} {reference_id} {llm}'
+    logging.info(info_message)
+    log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'INFO', info_message)
+
+    # shasum_512 is unique, so this document gets its own
+    analysis_sha512 = hashlib.sha512(str.encode(cached_shasum_512 + category + reference_id + llm)).hexdigest()
+    analysis_document = {
+                         'schema_version' : '4',
+                         'source' : 'reddit',
+                         'category' : category,
+                         'reference_id' : reference_id,
+                         'llm' : llm,
+                         'analysis_shasum_512' : cached_shasum_512
+                        }
+    if near_duplicate:
+        analysis_document['near_duplicate_of'] = near_duplicate['reference_id']
+        analysis_document['near_duplicate_similarity'] = near_duplicate['similarity']
+    analysis_data = {
+                     'timestamp': ts_int_to_dt_obj(),
+                     'shasum_512' : analysis_sha512,
+                     'analysis_document' : json.dumps(analysis_document)
+                    }
+    insert_data_into_table('analysis_documents', analysis_data)
+
+@app.route('/prompt_cache_stats', methods=['GET'])
+@jwt_required()
+def prompt_cache_stats_endpoint():
+    """Prompt cache hit ratio and GPU seconds saved
+    """
+
+    return jsonify({**prompt_cache_stats(), 'near_duplicate_hits' : near_duplicate_hits()})
+
+@app.route('/ollama_residency', methods=['GET'])
+@jwt_required()
+def ollama_residency_endpoint():
+    """Models loaded in Ollama and their residency state
+    """
+
+    return jsonify(ollama_residency(OLLAMA_HOSTS.hosts))
+
+@app.route('/ollama_health', methods=['GET'])
+@jwt_required()
+def ollama_health_endpoint():
+    """Circuit breaker state of each Ollama host and retry counters
+    """
+
+    return jsonify(resilience_stats())
+
+@app.route('/sanitizer_stats', methods=['GET'])
+@jwt_required()
+def sanitizer_stats_endpoint():
+    """Hits of each sanitizer phrase, unused phrases first
+    """
+
+    return jsonify(sanitizer_stats())
+
+@app.route('/backfill_languages', methods=['GET'])
+@jwt_required()
+def backfill_languages_endpoint():
+    """Detect and store the language of posts and comments that have none
+    """
+
+    return jsonify({table : backfill_languages(table) for table in ('posts', 'comments')})
+
+@app.route('/rotate_encryption_keys', methods=['GET'])
+@jwt_required()
+def rotate_encryption_keys_endpoint():
+    """Re-encrypt encrypted analyses with the first key in ENCRYPTION_KEY
+    """
+
+    return jsonify(rotate_analysis_documents())
+
+@app.route('/evaluate_analyses', methods=['GET'])
+@jwt_required()
+def evaluate_analyses_endpoint():
+    """Score stored analyses that have not been scored yet
+    """
+
+    limit = request.args.get('limit', type=int)
+    return jsonify(evaluate_analyses(limit))
+
+@app.route('/embed_pending', methods=['GET'])
+@jwt_required()
+def embed_pending_endpoint():
+    """Embed all posts and comments that have no embedding yet
+    """
+
+    return jsonify(embed_pending())
+
+@app.route('/similar', methods=['GET'])
+@jwt_required()
+def similar_endpoint():
+    """Top-k posts and comments most similar to a reference_id or to text
+    """
+
+    reference_id = request.args.get('reference_id')
+    text = request.args.get('text')
+    if not reference_id and not text:
+        return jsonify({'error': 'reference_id or text is required'}), 400
+    # None when k is given but not a number
+    k = request.args.get('k', type=int) if 'k' in request.args else EMBED_TOP_K
+    if k is None or k < 1:
+        return jsonify({'error': 'k must be a positive integer'}), 400
+
+    results = similar(reference_id=reference_id,
+                      text=text,
+                      k=k,
+                      category=request.args.get('category'))
+    if results is None:
+        return jsonify({'error': f'{reference_id or "text"} has no embedding'}), 404
+    return jsonify(results)
+
+@app.route('/get_thread', methods=['GET'])
+@jwt_required()
+def get_thread_endpoint():
+    """Comment thread of a post, rebuilt from its stored parent-child tree
+    """
+
+    post_id = request.args.get('post_id')
+    if not post_id:
+        return jsonify({'error': 'post_id is required'}), 400
+
+    post_thread = thread(post_id)
+    if post_thread is None:
+        return jsonify({'error': f'{post_id} has no stored comment tree'}), 404
+    return jsonify(post_thread)
+
+@app.route('/reddit_pool', methods=['GET'])
+@jwt_required()
+def reddit_pool_endpoint():
+    """Calls, rate limits and remaining requests of each Reddit account
+    """
+
+    return jsonify(REDDIT_POOL.state())
 
 @app.route('/get_sub_post', methods=['GET'])
 @jwt_required()
@@ -371,8 +751,7 @@ def get_post_endpoint():
     """
 
     post_id = request.args.get('post_id')
-    get_sub_post(post_id)
-    return jsonify({'message': 'get_sub_post endpoint'})
+    return jsonify(get_sub_post(post_id))
 
 @app.route('/get_sub_posts', methods=['GET'])
 @jwt_required()
@@ -381,136 +760,55 @@ def get_sub_posts_endpoint():
     """
 
     sub = request.args.get('sub')
-    get_sub_posts(sub)
-    return jsonify({'message': 'get_sub_posts endpoint'})
+    return jsonify(get_sub_posts(sub))
 
 def get_sub_post(post_id):
-    """Get a submission post
+    """Get a submission post, and the comments of it that are not stored yet
     """
 
     info_message = f'Getting post id {post_id}'
     logging.info(info_message)
     log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'INFO', info_message)
 
-    post = REDDIT.submission(post_id)
-    post_data = get_post_details(post)
-    insert_data_into_table('posts', post_data)
-    get_post_comments(post)
+    return asyncio.run(ingest_posts([post_id]))
 
 def get_sub_posts(sub):
-    """Get all posts for a given sub
+    """Get all posts for a given sub, see reddit_ingest.py
+
+        Returns:
+            dict: ingestion report, None if the subreddit could not be read
     """
 
-    info_message = f'Getting posts in subreddit {sub}'
-    logging.info(info_message)
-    log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'INFO', info_message)
     try:
-        posts = REDDIT.subreddit(sub).hot(limit=None)
-        new_post_ids = get_new_data_ids('posts', 'post_id', posts)
-
-        for post_id in new_post_ids:
-            get_sub_post(post_id)
-            if not check_and_increment('rollama'):
-                sleep_for = random.randrange(60, 65)
-                logging.info("Sleeping for %s seconds", sleep_for)
-                time.sleep(sleep_for)
+        return asyncio.run(ingest_subreddit(sub))
     except AttributeError as e:
         # store this for later inspection
         warn_message = f'GET SUB POSTS {sub} {e.args[0]}'
         logging.warning(warn_message)
         log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'WARNING', warn_message)
-
-def get_post_comments(post_obj):
-    """Get all comments made to a submission post
-    """
-
-    info_message = f'Getting comments for post {post_obj.id}'
-    logging.info(info_message)
-    log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'INFO', info_message)
-
-    submission = REDDIT.submission(post_obj.id)
-    submission.comments.replace_more(limit=None)
-    try:
-        all_comments = submission.comments.list()
-    except AttributeError:
-        warn_message = f'{post_obj.id} has no comments'
+    except RedditPoolExhausted as e:
+        warn_message = f'GET SUB POSTS {sub} {e}'
         logging.warning(warn_message)
         log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'WARNING', warn_message)
 
-    # Create a dictionary to store parent-child relationships
-    comment_dict = {c.id: c for c in all_comments}
-    parent_child_tree = {}
-
-    for comment in all_comments:
-        comment_data = get_comment_details(comment)
-        insert_data_into_table('comments', comment_data)
-        parent_comment_id = comment.parent_id.split('_')[1]
-        if parent_comment_id in comment_dict:
-            parent_comment = comment_dict[parent_comment_id]
-
-            # If the parent-comment relationship doesn't already exist in the tree,
-            # add it as a child node of the parent comment.
-            if comment.id not in parent_child_tree.get(parent_comment.id, []):
-                parent_child_tree.setdefault(parent_comment.id, []).append(comment.id)
-
-    dt = unix_ts_str()
-    shasum256 = hashlib.sha256(str(parent_child_tree).encode()).hexdigest()
-    parent_child_tree_data = {
-                              'timestamp' : dt, #string
-                              'shasum256' : shasum256, #string
-                              'post_id' : post_obj.id, #string
-                              'parent_child_tree' : json.dumps(parent_child_tree) #json
-                             }
-
-    insert_data_into_table('parent_child_tree_data', parent_child_tree_data)
-
-def get_post_details(post):
+def get_post_details(post, authors=None, reddit=REDDIT):
     """Get details for a submission post
     """
 
-    post_author = post.author.name if post.author else None
-
-    if post_author and post_author != 'AutoModerator':
-        process_author(post_author)
-
-    post_data = {
-                 'subreddit': post.subreddit.display_name,
-                 'post_id': post.id,
-                 'post_author': post_author,
-                 'post_title': post.title,
-                 'post_body': post.selftext,
-                 'post_created_utc': int(post.created_utc),
-                 'is_post_oc': post.is_original_content,
-                 'is_post_video': post.is_video,
-                 'post_upvote_count': post.ups,
-                 'post_downvote_count': post.downs,
-                 'subreddit_members': post.subreddit_subscribers
-                }
+    data = thing_data(post)
+    post_data = post_row(data)
+    process_author(post_data['post_author'], data.get('author_fullname'), authors, reddit)
+
     return post_data
 
-def get_comment_details(comment):
+def get_comment_details(comment, authors=None, reddit=REDDIT):
     """Get comment details
     """
 
-    comment_author = comment.author.name if comment.author else None
-    comment_submitter = comment.is_submitter if hasattr(comment, 'is_submitter') else None
-    comment_edited = str(int(comment.edited)) if comment.edited else False
-
-    if comment_author and comment_author != 'AutoModerator':
-        process_author(comment_author)
-
-    comment_data = {
-                    'comment_id': comment.id,
-                    'comment_author': comment_author,
-                    'is_comment_submitter': comment_submitter,
-                    'is_comment_edited': comment_edited,
-                    'comment_created_utc': int(comment.created_utc),
-                    'comment_upvote_count': comment.ups,
-                    'comment_downvote_count': comment.downs,
-                    'comment_body': comment.body,
-                    'post_id': comment.submission.id,
-                    'subreddit': comment.subreddit.display_name
-                   }
+    data = thing_data(comment)
+    comment_data = comment_row(data)
+    process_author(comment_data['comment_author'], data.get('author_fullname'), authors, reddit)
+
     return comment_data
 
 @app.route('/get_author_comments', methods=['GET'])
@@ -532,31 +830,19 @@ def get_authors_comments_endpoint():
     get_authors_comments()
     return jsonify({'message': 'get_authors_comments endpoint'})
 
-def process_author(author_name):
+def process_author(author_name, author_fullname=None, authors=None, reddit=REDDIT):
     """Process author information.
-    """
 
-    if not lookup_key('author_id_' + author_name):
-        info_message = f'Processing Author {author_name}'
-        logging.info(info_message)
-        log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'INFO', info_message)
+        authors, an AuthorResolver, batches the authors of a run - without
+        one the author is resolved right away, with reddit
+    """
 
-        author_data = {}
-        try:
-            author = REDDIT.redditor(author_name)
-            if author.name != 'AutoModerator':
-                author_data = {
-                            'author_id': author.id,
-                            'author_name': author.name,
-                            'author_created_utc': int(author.created_utc),
-                            }
-                insert_data_into_table('authors', author_data)
-        except (AttributeError, TypeError, exceptions.NotFound) as e:
-            # store this for later inspection
-            add_key('author_id_' + author_name)
-            warn_message = f'AUTHOR {author_name} {e.args[0]}'
-            logging.warning(warn_message)
-            log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'WARNING', warn_message)
+    if authors is None:
+        authors = AuthorResolver()
+        authors.add(author_name, author_fullname)
+        authors.flush(reddit)
+    elif authors.add(author_name, author_fullname):
+        authors.flush(reddit)
 
 def get_author(anauthor):
     """Get author info of a comment or a submission
@@ -566,22 +852,36 @@ def get_author(anauthor):
         process_author(anauthor)
         get_author_comments(anauthor)
 
-def process_comment(comment):
-    """Process a single comment
+def author_comment_rows(comments, authors, reddit=REDDIT):
+    """comments rows of listed comments, and the ids of the posts they were
+        made on - AutoModerator comments are skipped unless removed or deleted
     """
 
-    comment_body = comment.body
-
-    if comment_body not in ('[removed]', '[deleted]') and comment.author.name != 'AutoModerator':
-        comment_data = get_comment_details(comment)
-        insert_data_into_table('comments', comment_data)
-        orig_post = REDDIT.submission(comment_data['post_id'])
-        post_data = get_post_details(orig_post)
-        insert_data_into_table('posts', post_data)
+    comment_rows = []
+    post_ids = set()
+    for comment in comments:
+        comment_data = get_comment_details(comment, authors, reddit)
+        removed = comment_data['comment_body'] in ('[removed]', '[deleted]')
+        if not removed and comment_data['comment_author'] == 'AutoModerator':
+            continue
+        comment_rows.append(comment_data)
+        if not removed:
+            post_ids.add(comment_data['post_id'])
+    return comment_rows, post_ids
+
+def get_posts_by_id(post_ids, authors, reddit=REDDIT):
+    """posts rows of posts, fetched INFO_BATCH_SIZE per request
+    """
 
-    if comment_body in ('[removed]', '[deleted]'): #removed or deleted comments
-        comment_data = get_comment_details(comment)
-        insert_data_into_table('comments', comment_data)
+    post_rows = []
+    for chunk in chunked(sorted(post_ids), INFO_BATCH_SIZE):
+        for post in reddit.info(fullnames=['t3_' + post_id for post_id in chunk]):
+            post_rows.append(get_post_details(post, authors, reddit))
+        if not check_and_increment('rollama'):
+            sleep_for = random.randrange(60, 65)
+            logging.info("Sleeping for %s seconds", sleep_for)
+            time.sleep(sleep_for)
+    return post_rows
 
 def get_authors_comments():
     """Get comments and posts for authors listed in the author table, 
@@ -626,32 +926,45 @@ def get_author_comments(author):
     log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'INFO', info_message)
 
     try:
-        redditor = REDDIT.redditor(author)
-        comments = redditor.comments.hot(limit=None)
-        
-        author_comments = get_new_data_ids('comments', 'comment_id', comments)
-            
+        # on another account if this one is answered 429
+        REDDIT_POOL.call(lambda reddit: store_author_comments(author, reddit))
+    except RedditPoolExhausted as e:
+        warn_message = f'AUTHOR COMMENTS {author} {e}'
+        logging.warning(warn_message)
+        log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'WARNING', warn_message)
+
+def store_author_comments(author, reddit):
+    """Store the new comments of an author and the posts they were made on
+    """
+
+    try:
+        redditor = reddit.redditor(author)
+        # listed comments come complete, only their posts need fetching
+        comments = list(redditor.comments.hot(limit=None))
+        existing_ids = get_existing_ids('comments', 'comment_id', [comment.id for comment in comments])
+        author_comments = [comment for comment in comments if comment.id not in existing_ids]
+
         if not author_comments:
             info_message = f'{author} has no new comments'
             logging.info(info_message)
             log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'INFO', info_message)
             return
 
-        if author_comments:
-            num_comments = len(author_comments)
-            info_message = f'{author} {num_comments} new comments'
-            logging.info(info_message)
-            log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'INFO', info_message)
-            for comment_id in author_comments:
-                comment = REDDIT.comment(comment_id)
-                process_comment(comment)
-                if not check_and_increment('rollama'):
-                    sleep_for = random.randrange(60, 65)
-                    logging.info("Sleeping for %s seconds", sleep_for)
-                    time.sleep(sleep_for)
+        num_comments = len(author_comments)
+        info_message = f'{author} {num_comments} new comments'
+        logging.info(info_message)
+        log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'INFO', info_message)
+
+        authors = AuthorResolver()
+        comment_rows, post_ids = author_comment_rows(author_comments, authors, reddit)
+        post_ids -= get_existing_ids('posts', 'post_id', post_ids)
+        post_rows = get_posts_by_id(post_ids, authors, reddit)
+        insert_rows_into_table('comments', comment_rows)
+        insert_rows_into_table('posts', post_rows)
+        authors.flush(reddit)
     except AttributeError as e:
         # store this for later inspection
-        warn_message = f'AUTHOR COMMENT {comment_id} {e.args[0]}'
+        warn_message = f'AUTHOR COMMENTS {author} {e.args[0]}'
         logging.warning(warn_message)
         log_message_to_db(os.environ['SRVC_NAME'], get_rollama_version()['version'], 'WARNING', warn_message)
 
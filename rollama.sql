@@ -143,6 +143,27 @@ ALTER TABLE public.analysis_documents ALTER COLUMN id ADD GENERATED BY DEFAULT A
 );
 
 
+--
+-- Name: analysis_evaluations; Type: TABLE; Schema: public; Owner: rollama
+--
+
+CREATE TABLE public.analysis_evaluations (
+    created_at timestamp with time zone DEFAULT now() NOT NULL,
+    shasum_512 text NOT NULL,
+    metric character varying(64) NOT NULL,
+    judge character varying(255) NOT NULL,
+    llm character varying(255),
+    category character varying(16),
+    reference_id character varying(255),
+    score real,
+    success boolean,
+    reason text,
+    evaluation_duration real
+);
+
+
+ALTER TABLE public.analysis_evaluations OWNER TO rollama;
+
 --
 -- Name: authors; Type: TABLE; Schema: public; Owner: rollama
 --
@@ -170,12 +191,62 @@ CREATE TABLE public.comments (
     post_id character varying,
     subreddit text,
     comment_upvote_count integer,
-    comment_downvote_count integer
+    comment_downvote_count integer,
+    language character varying(8)
 );
 
 
 ALTER TABLE public.comments OWNER TO rollama;
 
+--
+-- Name: crawl_checkpoints; Type: TABLE; Schema: public; Owner: rollama
+--
+
+CREATE TABLE public.crawl_checkpoints (
+    subreddit character varying NOT NULL,
+    newest_fullname character varying(32),
+    newest_created_utc integer,
+    last_crawled_at timestamp with time zone DEFAULT now() NOT NULL,
+    last_new_posts integer,
+    last_pages integer
+);
+
+
+ALTER TABLE public.crawl_checkpoints OWNER TO rollama;
+
+--
+-- Name: embedding_neighbors; Type: TABLE; Schema: public; Owner: rollama
+--
+
+CREATE TABLE public.embedding_neighbors (
+    reference_id character varying NOT NULL,
+    category character varying NOT NULL,
+    neighbor_id character varying NOT NULL,
+    neighbor_category character varying NOT NULL,
+    model character varying(255) NOT NULL,
+    score real NOT NULL,
+    created_at timestamp with time zone DEFAULT now() NOT NULL
+);
+
+
+ALTER TABLE public.embedding_neighbors OWNER TO rollama;
+
+--
+-- Name: embeddings; Type: TABLE; Schema: public; Owner: rollama
+--
+
+CREATE TABLE public.embeddings (
+    reference_id character varying NOT NULL,
+    category character varying NOT NULL,
+    model character varying(255) NOT NULL,
+    dims integer NOT NULL,
+    vector bytea NOT NULL,
+    created_at timestamp with time zone DEFAULT now() NOT NULL
+);
+
+
+ALTER TABLE public.embeddings OWNER TO rollama;
+
 --
 -- Name: errors; Type: TABLE; Schema: public; Owner: rollama
 --
@@ -190,6 +261,22 @@ CREATE TABLE public.errors (
 
 ALTER TABLE public.errors OWNER TO rollama;
 
+--
+-- Name: model_residency_events; Type: TABLE; Schema: public; Owner: rollama
+--
+
+CREATE TABLE public.model_residency_events (
+    created_at timestamp with time zone DEFAULT now() NOT NULL,
+    llm character varying(255) NOT NULL,
+    ollama_host character varying,
+    event character varying(16) NOT NULL,
+    keep_alive character varying(16),
+    load_duration real
+);
+
+
+ALTER TABLE public.model_residency_events OWNER TO rollama;
+
 --
 -- Name: parent_child_tree_data; Type: TABLE; Schema: public; Owner: rollama
 --
@@ -242,7 +329,8 @@ CREATE TABLE public.posts (
     is_post_video boolean,
     post_upvote_count integer,
     post_downvote_count integer,
-    subreddit_members integer
+    subreddit_members integer,
+    language character varying(8)
 );
 
 
@@ -266,7 +354,15 @@ CREATE TABLE public.prompt_completion_details (
     size_vram bigint NOT NULL,
     created_at timestamp with time zone DEFAULT now() NOT NULL,
     prompt_completion_time integer NOT NULL,
-    tokens_per_second real
+    tokens_per_second real,
+    input_tokens_estimate integer,
+    time_to_first_token real,
+    load_duration real,
+    prompt_eval_count integer,
+    prompt_eval_duration real,
+    eval_count integer,
+    eval_duration real,
+    completion_truncated boolean DEFAULT false
 );
 
 
@@ -524,6 +620,14 @@ ALTER TABLE ONLY public.analysis_documents
     ADD CONSTRAINT analysis_documents_shasum_512_key UNIQUE (shasum_512);
 
 
+--
+-- Name: analysis_evaluations analysis_evaluations_pkey; Type: CONSTRAINT; Schema: public; Owner: rollama
+--
+
+ALTER TABLE ONLY public.analysis_evaluations
+    ADD CONSTRAINT analysis_evaluations_pkey PRIMARY KEY (shasum_512, metric, judge);
+
+
 --
 -- Name: authors author_pkey; Type: CONSTRAINT; Schema: public; Owner: rollama
 --
@@ -540,6 +644,30 @@ ALTER TABLE ONLY public.comments
     ADD CONSTRAINT comment_pkey PRIMARY KEY (comment_id);
 
 
+--
+-- Name: crawl_checkpoints crawl_checkpoints_pkey; Type: CONSTRAINT; Schema: public; Owner: rollama
+--
+
+ALTER TABLE ONLY public.crawl_checkpoints
+    ADD CONSTRAINT crawl_checkpoints_pkey PRIMARY KEY (subreddit);
+
+
+--
+-- Name: embedding_neighbors embedding_neighbors_pkey; Type: CONSTRAINT; Schema: public; Owner: rollama
+--
+
+ALTER TABLE ONLY public.embedding_neighbors
+    ADD CONSTRAINT embedding_neighbors_pkey PRIMARY KEY (reference_id, neighbor_id, model);
+
+
+--
+-- Name: embeddings embeddings_pkey; Type: CONSTRAINT; Schema: public; Owner: rollama
+--
+
+ALTER TABLE ONLY public.embeddings
+    ADD CONSTRAINT embeddings_pkey PRIMARY KEY (reference_id, model);
+
+
 --
 -- Name: parent_child_tree_data parent_child_tree_data_pkey; Type: CONSTRAINT; Schema: public; Owner: rollama
 --
@@ -709,6 +837,13 @@ CREATE INDEX idx_posts_post_id ON public.posts USING btree (post_id);
 CREATE INDEX post_post_author_idx ON public.posts USING btree (post_author);
 
 
+--
+-- Name: post_subreddit_created_utc_idx; Type: INDEX; Schema: public; Owner: rollama
+--
+
+CREATE INDEX post_subreddit_created_utc_idx ON public.posts USING btree (subreddit, post_created_utc);
+
+
 --
 -- Name: post_subreddit_idx; Type: INDEX; Schema: public; Owner: rollama
 --
@@ -0,0 +1,161 @@
+# sanitizer.py
+# ©2024, Ovais Quraishi
+"""Removal of LLM boilerplate from analyses
+
+    The phrases to remove, and what to put in their place, are read from the
+    SANITIZER_PHRASES JSON file and compiled into a single case-insensitive
+    regex, one named group per phrase, that tolerates any run of whitespace
+    between words and straight or curly apostrophes. An analysis is sanitized
+    in one pass however many phrases there are. The file is re-read when it
+    changes, checked at most every SANITIZER_RELOAD_SECS.
+
+    Hits are counted per phrase in Redis so phrases models no longer produce
+    can be pruned, see sanitizer_stats().
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from pathlib import Path
+
+import redis
+
+# Import required local modules
+import logit
+from cache import redis_client
+from config import get_config
+
+get_config()
+
+SANITIZER_PHRASES = os.environ.get('SANITIZER_PHRASES', 'sanitizer_phrases.json')
+SANITIZER_RELOAD_SECS = float(os.environ.get('SANITIZER_RELOAD_SECS', 30))
+
+SANITIZER_HITS = 'sanitizer_hits'
+APOSTROPHES = "['‘’]"
+
+
+def phrases_path():
+    path = Path(SANITIZER_PHRASES)
+    if not path.is_absolute():
+        path = Path(__file__).resolve().parent / path
+    return path
+
+def phrase_pattern(phrase):
+    """Regex of a phrase, any whitespace between words and any apostrophe
+    """
+
+    words = phrase.split()
+    return r'\s+'.join(re.escape(word).replace("'", APOSTROPHES) for word in words)
+
+def compile_phrases(phrases):
+    """One alternation of every phrase, longest first so that a phrase wins
+        over another phrase it starts with
+    """
+
+    phrases = sorted({p.strip() for p in phrases if p.strip()}, key=len, reverse=True)
+    if not phrases:
+        return None, {}
+    groups = {f'p{i}' : phrase for i, phrase in enumerate(phrases)}
+    pattern = '|'.join(f'(?P<{name}>{phrase_pattern(phrase)})' for name, phrase in groups.items())
+    # whitespace after a phrase goes with it, the replacement brings its own
+    return re.compile(f'(?:{pattern})\\s*', re.IGNORECASE), groups
+
+
+class Sanitizer:
+    """Compiled phrase set, reloaded when the phrases file changes
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.checked_at = 0.0
+        self.regex = None
+        self.groups = {}
+        self.replacement = ''
+
+    def reload(self):
+        """Re-read the phrases file if it changed since it was last read
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            if self.mtime is not None and now - self.checked_at < SANITIZER_RELOAD_SECS:
+                return
+            self.checked_at = now
+            try:
+                mtime = self.path.stat().st_mtime
+                if mtime == self.mtime:
+                    return
+                with open(self.path, 'r', encoding='utf-8') as phrases_file:
+                    config = json.load(phrases_file)
+                self.regex, self.groups = compile_phrases(config['phrases'])
+                self.replacement = config.get('replacement', '')
+                self.mtime = mtime
+            except (OSError, ValueError, KeyError, re.error) as e:
+                # keep sanitizing with the phrases loaded last
+                self.mtime = self.mtime or 0.0
+                error_message = f'Unable to load sanitizer phrases {self.path} {e}'
+                logging.error(error_message)
+                logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'ERROR', error_message)
+                return
+
+        info_message = f'Loaded {len(self.groups)} sanitizer phrases from {self.path}'
+        logging.info(info_message)
+
+    def sanitize(self, text):
+        """Replace every phrase in text
+
+            Returns:
+                tuple: (sanitized text, {phrase: hits})
+        """
+
+        self.reload()
+        regex, groups, replacement = self.regex, self.groups, self.replacement
+        if regex is None:
+            return text, {}
+
+        hits = {}
+        def replace(match):
+            phrase = groups[match.lastgroup]
+            hits[phrase] = hits.get(phrase, 0) + 1
+            return replacement
+
+        return regex.sub(replace, text), hits
+
+
+SANITIZER = Sanitizer(phrases_path())
+
+
+def count_hits(hits):
+    try:
+        pipe = redis_client().pipeline()
+        for phrase, count in hits.items():
+            pipe.hincrby(SANITIZER_HITS, phrase, count)
+        pipe.execute()
+    except redis.exceptions.RedisError as e:
+        logging.warning('Unable to count sanitizer hits %s', e)
+
+def sanitize_string(a_string):
+    """Search and replace AI model related text in strings"""
+
+    sanitized, hits = SANITIZER.sanitize(a_string)
+    if hits:
+        count_hits(hits)
+    return sanitized
+
+def sanitizer_stats():
+    """Hits of every configured phrase, phrases with no hits first - those are
+        candidates for pruning
+    """
+
+    SANITIZER.reload()
+    counted = {k.decode('utf-8'): int(v) for k, v in redis_client().hgetall(SANITIZER_HITS).items()}
+    hits = {phrase : counted.get(phrase, 0) for phrase in SANITIZER.groups.values()}
+    return {
+            'phrases_file' : str(SANITIZER.path),
+            'hits' : dict(sorted(hits.items(), key=lambda item: item[1]))
+           }
@@ -2,16 +2,48 @@
 # ©2024, Ovais Quraishi
 
 import os
+import sys
+import tempfile
+import threading
 import unittest
 import json
 from unittest.mock import patch, MagicMock
 
+import praw
+
 from config import get_config
 get_config()
 SRVC_SHARED_SECRET=os.environ['SRVC_SHARED_SECRET']
 
 # Import the Flask app
 from rollama import app
+from reddit_extract import listing_rows, post_row, comment_row
+from reddit_api import RedditClientPool, RedditPoolExhausted
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tools'))
+import reddit_replay
+
+def post_thing(post_id, author='poster'):
+    return {'kind': 't3', 'data': {
+            'id': post_id, 'name': 't3_' + post_id, 'author': author, 'author_fullname': 't2_poster',
+            'subreddit': 'test', 'subreddit_subscribers': 42, 'title': 'A title ',
+            'selftext': 'and a body long enough to detect its language', 'created_utc': 1700000000.0,
+            'is_original_content': False, 'is_video': False, 'ups': 3, 'downs': 0}}
+
+def comment_thing(comment_id, parent_id, replies=''):
+    return {'kind': 't1', 'data': {
+            'id': comment_id, 'name': 't1_' + comment_id, 'author': 'commenter', 'author_fullname': 't2_commenter',
+            'subreddit': 'test', 'link_id': 't3_p1', 'parent_id': parent_id, 'is_submitter': False,
+            'edited': False, 'created_utc': 1700000100.0, 'ups': 1, 'downs': 0,
+            'body': 'a comment long enough to detect its language', 'replies': replies}}
+
+def listing(children):
+    return {'kind': 'Listing', 'data': {'after': None, 'before': None, 'children': children}}
+
+# as /comments/p1 answers, a reply and a "load more" stub included
+COMMENTS_PAGE = [listing([post_thing('p1')]),
+                 listing([comment_thing('c1', 't3_p1', listing([comment_thing('c2', 't1_c1')])),
+                          {'kind': 'more', 'data': {'id': 'c3', 'count': 1, 'children': ['c3'], 'parent_id': 't3_p1'}}])]
 
 class TestFlaskApp(unittest.TestCase):
 
@@ -50,5 +82,100 @@ class TestFlaskApp(unittest.TestCase):
 
     # Add more test cases for other endpoints...
 
+class TestRedditExtract(unittest.TestCase):
+    """Rows are built from data already downloaded, with no HTTP request
+        per item
+    """
+
+    def setUp(self):
+        self.reddit = praw.Reddit(client_id='test', client_secret='test', user_agent='testit',
+                                  check_for_updates=False)
+        patcher = patch('prawcore.Requestor.request')
+        self.http = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_listing_rows(self):
+        rows = listing_rows(COMMENTS_PAGE)
+        self.assertEqual([row['post_id'] for row in rows['posts']], ['p1'])
+        self.assertEqual([row['comment_id'] for row in rows['comments']], ['c1', 'c2'])
+        self.assertEqual(rows['posts'][0]['subreddit'], 'test')
+        self.assertEqual(rows['posts'][0]['subreddit_members'], 42)
+        self.assertEqual(rows['comments'][1]['post_id'], 'p1')
+        self.assertEqual(self.http.call_count, 0)
+
+    def test_praw_listing_objects(self):
+        posts = self.reddit._objector.objectify(data=listing([post_thing(f'p{i}') for i in range(25)]))
+        rows = [post_row(post) for post in posts]
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[0]['subreddit'], 'test')
+        self.assertEqual(rows[0]['post_author'], 'poster')
+        self.assertEqual(self.http.call_count, 0)
+
+    def test_praw_comment_objects(self):
+        comments = self.reddit._objector.objectify(data=listing([comment_thing(f'c{i}', 't3_p1') for i in range(25)]))
+        rows = [comment_row(comment) for comment in comments]
+        self.assertEqual({row['post_id'] for row in rows}, {'p1'})
+        self.assertEqual(rows[0]['comment_author'], 'commenter')
+        self.assertEqual(self.http.call_count, 0)
+
+    def test_deleted_author(self):
+        rows = listing_rows(listing([post_thing('p2', author='[deleted]')]))
+        self.assertIsNone(rows['posts'][0]['post_author'])
+
+class TestRedditClientPool(unittest.TestCase):
+    """Requests fail over to another account when one is answered 429, on
+        two local replay servers standing in for Reddit
+    """
+
+    def setUp(self):
+        cassette = tempfile.NamedTemporaryFile('w', suffix='.cassette', delete=False)
+        cassette.write(json.dumps({'key': reddit_replay.request_key('GET', '/r/test/new', 'limit=1&raw_json=1'),
+                                   'status': 200, 'headers': {'content-type': 'application/json'},
+                                   'body': json.dumps(listing([post_thing('p1')]))}) + '\n')
+        cassette.close()
+        self.addCleanup(os.unlink, cassette.name)
+        # every request to the first account is answered 429
+        self.throttled = self.replay_server(cassette.name, 1.0)
+        self.serving = self.replay_server(cassette.name, 0.0)
+        patcher = patch('reddit_api.logit.log_message_to_db')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = RedditClientPool({'reddit': self.account(self.throttled),
+                                      'reddit:second': self.account(self.serving)})
+
+    def replay_server(self, cassette, throttle_rate):
+        server = reddit_replay.make_server(reddit_replay.parse_args(
+                     ['--replay', cassette, '--port', '0', '--throttle-rate', str(throttle_rate)]))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def account(self, server):
+        url = f'http://{server.server_address[0]}:{server.server_address[1]}'
+        return {'client_id': 'test', 'client_secret': 'test', 'username': 'test', 'rpassword': 'test',
+                'user_agent': 'testit', 'reddit_oauth_url': url, 'reddit_url': url}
+
+    def new_posts(self):
+        return self.pool.call(lambda reddit: [post.id for post in reddit.get('r/test/new', params={'limit': 1})])
+
+    def test_failover(self):
+        self.assertEqual(self.new_posts(), ['p1'])
+        self.assertEqual(self.throttled.replay.counts['throttled'], 1)
+        self.assertEqual(self.serving.replay.counts['replayed'], 1)
+        self.assertEqual(self.pool.state()['reddit']['limited'], 1)
+
+    def test_limited_account_set_aside(self):
+        self.new_posts()
+        requests = self.throttled.replay.counts['requests']
+        self.assertEqual(self.new_posts(), ['p1'])
+        self.assertEqual(self.throttled.replay.counts['requests'], requests)
+
+    def test_exhausted(self):
+        self.new_posts()
+        self.pool.clients[1].set_aside(30, 'test')
+        with self.assertRaises(RedditPoolExhausted):
+            self.new_posts()
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""Throughput benchmark of the analysis pipeline, no GPU needed
+
+    Seeds the database with synthetic posts and comments, starts the fake
+    Ollama server (tools/fake_ollama.py) in process, runs analyze_posts and
+    analyze_comments against it, and writes items/sec, p50/p95 prompt latency
+    and per-stage overhead as JSON. Options not listed below are passed on to
+    the fake server, e.g. --latency-mean, --tokens-per-sec, --error-rate.
+
+    Run against a scratch database and Redis, never production - the
+    analysis queries pick up every unanalyzed row, not just seeded ones:
+        > ./tools/bench_analysis.py --posts 200 --comments 1000 --output bench.json
+
+   ©2024, Ovais Quraishi
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import config
+import fake_ollama
+from cache import redis_client
+from database import get_select_query_results, insert_rows_into_table
+
+BENCH_PREFIX = 'bench_'
+VOCABULARY = ('model update phone battery price game team season city rent job market coffee '
+              'dog cat movie book code bug release server weekend family school car bike '
+              'really think people would never always maybe because great terrible weird').split()
+
+
+def point_config_at(url):
+    """Copy of setup.config with the Ollama hosts pointed at url - the host
+        pool reads them on import and get_config re-reads the file on every
+        call, so the environment alone would not do
+    """
+
+    config_obj = config.read_config(config.CONFIG_FILE)
+    if config_obj is None:
+        sys.exit(f'{config.CONFIG_FILE} not found')
+    for section, option in (('service', 'OLLAMA_API_URL'), ('resilience', 'OLLAMA_API_URLS')):
+        if not config_obj.has_section(section):
+            config_obj.add_section(section)
+        config_obj.set(section, option, url)
+
+    with tempfile.NamedTemporaryFile('w', suffix='.config', delete=False) as config_file:
+        config_obj.write(config_file)
+    config.CONFIG_FILE = config_file.name
+    config.get_config()
+    return config_file.name
+
+def random_text(rng, min_words, max_words, run_id):
+    # the run id keeps texts unique across runs, so the prompt cache stays cold
+    words = [rng.choice(VOCABULARY) for _ in range(rng.randint(min_words, max_words))]
+    return f'{run_id} ' + ' '.join(words)
+
+def seed_database(run_id, num_posts, num_comments, rng):
+    """Insert synthetic posts and comments
+
+        Returns:
+            tuple: (post ids, comment ids)
+    """
+
+    now = int(time.time())
+    posts = [{
+              'post_id' : f'{BENCH_PREFIX}{run_id}_p{i}',
+              'subreddit' : 'bench',
+              'post_author' : 'bench',
+              'post_title' : random_text(rng, 4, 12, run_id),
+              'post_body' : random_text(rng, 30, 300, run_id),
+              'post_created_utc' : now,
+              'language' : 'en'
+             } for i in range(num_posts)]
+    comments = [{
+                 'comment_id' : f'{BENCH_PREFIX}{run_id}_c{i}',
+                 'comment_author' : 'bench',
+                 'comment_created_utc' : now,
+                 'comment_body' : random_text(rng, 5, 80, run_id),
+                 'post_id' : rng.choice(posts)['post_id'] if posts else None,
+                 'subreddit' : 'bench',
+                 'language' : 'en'
+                } for i in range(num_comments)]
+
+    insert_rows_into_table('posts', posts)
+    insert_rows_into_table('comments', comments)
+    return [p['post_id'] for p in posts], [c['comment_id'] for c in comments]
+
+def cleanup():
+    """Remove every seeded row and the cache keys analysis left behind
+    """
+
+    pattern = f'{BENCH_PREFIX}%'
+    get_select_query_results("""DELETE FROM prompt_completion_details
+                                WHERE doc_shasum_512 IN (SELECT shasum_512 FROM analysis_documents
+                                                         WHERE analysis_document ->> 'reference_id' LIKE %s);""", (pattern,))
+    get_select_query_results("""DELETE FROM analysis_documents
+                                WHERE analysis_document ->> 'reference_id' LIKE %s;""", (pattern,))
+    get_select_query_results('DELETE FROM comments WHERE comment_id LIKE %s;', (pattern,))
+    get_select_query_results('DELETE FROM posts WHERE post_id LIKE %s;', (pattern,))
+
+    client = redis_client()
+    for key_pattern in (f'post_id_{BENCH_PREFIX}*', f'comment_id_{BENCH_PREFIX}*', f'minhash_*:{BENCH_PREFIX}*'):
+        keys = list(client.scan_iter(key_pattern))
+        if keys:
+            client.delete(*keys)
+
+def other_unanalyzed_rows():
+    """Rows that are not seeded - analyze_* would prompt them too
+    """
+
+    pattern = f'{BENCH_PREFIX}%'
+    posts = get_select_query_results('SELECT count(*) FROM posts WHERE post_id NOT LIKE %s;', (pattern,))
+    comments = get_select_query_results('SELECT count(*) FROM comments WHERE comment_id NOT LIKE %s;', (pattern,))
+    return posts[0][0] + comments[0][0]
+
+def summarize(name, items, report, wall_secs):
+    """Machine readable result of one analyze_* run
+    """
+
+    if not report:
+        return {'phase' : name, 'items' : items, 'wall_secs' : round(wall_secs, 3), 'error' : 'nothing analyzed'}
+
+    stages = {}
+    for stage_name, stage in report['stages'].items():
+        handled = stage['processed'] + stage['dropped']
+        stages[stage_name] = {**stage, 'secs_per_item' : round(stage['busy_secs'] / handled, 6) if handled else 0.0}
+
+    prompts = report['stages']['persist']['processed']
+    return {
+            'phase' : name,
+            'items' : items,
+            'prompts' : prompts,
+            'wall_secs' : round(wall_secs, 3),
+            'items_per_sec' : round(items / wall_secs, 3) if wall_secs else 0.0,
+            'prompts_per_sec' : round(prompts / wall_secs, 3) if wall_secs else 0.0,
+            'p50_prompt_completion_time' : report['p50_prompt_completion_time'],
+            'p95_prompt_completion_time' : report['p95_prompt_completion_time'],
+            'stages' : stages,
+            'models' : report['models']
+           }
+
+def main():
+    parser = argparse.ArgumentParser(description='Analysis pipeline benchmark', add_help=False)
+    parser.add_argument('--posts', type=int, default=100)
+    parser.add_argument('--comments', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file, stdout when not given')
+    parser.add_argument('--keep', action='store_true', help='keep seeded rows after the run')
+    parser.add_argument('--allow-nonempty', action='store_true',
+                        help='run even though the database has rows that were not seeded')
+    args, fake_argv = parser.parse_known_args()
+
+    if not args.allow_nonempty and other_unanalyzed_rows():
+        sys.exit('Database has rows that were not seeded by the benchmark, use a scratch database')
+
+    fake_args = fake_ollama.parse_args(['--port', '0', '--seed', str(args.seed)] + fake_argv)
+    server = fake_ollama.make_server(fake_args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config_file = point_config_at(f'http://{server.server_address[0]}:{server.server_address[1]}')
+
+    # imported once the config points at the fake server, the Ollama host
+    #  pool is built on import
+    import rollama
+
+    run_id = uuid.uuid4().hex[:8]
+    rng = random.Random(args.seed)
+    results = {
+               'run_id' : run_id,
+               'llms' : rollama.LLMS,
+               'fake_ollama' : vars(fake_args),
+               'phases' : []
+              }
+
+    try:
+        post_ids, comment_ids = seed_database(run_id, args.posts, args.comments, rng)
+        for name, items, analyze in (('posts', len(post_ids), rollama.analyze_posts),
+                                     ('comments', len(comment_ids), rollama.analyze_comments)):
+            start = time.monotonic()
+            report = analyze()
+            results['phases'].append(summarize(name, items, report, time.monotonic() - start))
+        results['fake_ollama_counts'] = server.fake.counts
+    finally:
+        server.shutdown()
+        os.unlink(config_file)
+        if not args.keep:
+            cleanup()
+
+    output = json.dumps(results, indent=2, default=str)
+    if args.output:
+        Path(args.output).write_text(output, encoding='utf-8')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""Ingestion benchmark against recorded Reddit traffic, no Reddit account
+    needed
+
+    Starts the replay server (tools/reddit_replay.py) in process on a
+    cassette, points praw and asyncpraw at it, then runs subreddit, post and
+    author ingestion and writes, per phase, wall time, API calls, 429s, DB
+    write statements and rows, and all of them per ingested post, as JSON.
+    Options not listed below are passed on to the replay server, e.g.
+    --latency-mean, --throttle-rate.
+
+    Record a cassette by running the same phases once against the replay
+    server in --record mode. Run against a scratch database and Redis, never
+    production - a run stores everything it ingests, so running it again
+    measures a steady-state crawl, where every post is stored already:
+        > ./tools/bench_ingestion.py reddit.cassette --subs python,golang --authors spez --output bench.json
+
+   ©2024, Ovais Quraishi
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import config
+import reddit_replay
+
+# modules that write rows, their insert functions are counted
+WRITER_MODULES = ('rollama', 'reddit_ingest', 'authors')
+INSERT_FUNCTIONS = ('insert_rows_into_table', 'insert_data_into_table')
+
+
+def point_config_at(url):
+    """Copy of setup.config with the Reddit urls pointed at url, get_config
+        re-reads the file on every call so the environment alone would not do
+    """
+
+    config_obj = config.read_config(config.CONFIG_FILE)
+    if config_obj is None:
+        sys.exit(f'{config.CONFIG_FILE} not found')
+    if not config_obj.has_section('reddit'):
+        config_obj.add_section('reddit')
+    # every account, [reddit:<name>] ones too
+    for section in config_obj.sections():
+        if section == 'reddit' or section.startswith('reddit:'):
+            config_obj.set(section, 'reddit_oauth_url', url)
+            config_obj.set(section, 'reddit_url', url)
+
+    with tempfile.NamedTemporaryFile('w', suffix='.config', delete=False) as config_file:
+        config_obj.write(config_file)
+    config.CONFIG_FILE = config_file.name
+    config.get_config()
+    return config_file.name
+
+
+class WriteCounter:
+    """Counts insert statements and rows by table
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statements = 0
+        self.rows = {}
+
+    def wrap(self, func, many):
+        def counted(table_name, data):
+            with self.lock:
+                self.statements += 1
+                self.rows[table_name] = self.rows.get(table_name, 0) + (len(data) if many else 1)
+            return func(table_name, data)
+        return counted
+
+    def install(self):
+        for module_name in WRITER_MODULES:
+            module = sys.modules[module_name]
+            for function_name in INSERT_FUNCTIONS:
+                if hasattr(module, function_name):
+                    func = getattr(module, function_name)
+                    setattr(module, function_name, self.wrap(func, function_name == 'insert_rows_into_table'))
+
+    def snapshot(self):
+        with self.lock:
+            return self.statements, dict(self.rows)
+
+
+def run_phase(name, func, server, writes):
+    """Run one phase and what it cost
+    """
+
+    counts = server.replay.counts
+    requests_before, throttled_before, misses_before = counts['requests'], counts['throttled'], counts['misses']
+    tokens_before = counts['tokens']
+    statements_before, rows_before = writes.snapshot()
+
+    start = time.monotonic()
+    error = None
+    try:
+        report = func()
+    except Exception as e:
+        report = None
+        error = f'{type(e).__name__}: {e}'
+    wall_secs = time.monotonic() - start
+
+    statements, rows = writes.snapshot()
+    rows = {table : count - rows_before.get(table, 0) for table, count in rows.items() if count - rows_before.get(table, 0)}
+    # token requests are an artifact of starting up, not of ingestion
+    api_calls = counts['requests'] - requests_before - (counts['tokens'] - tokens_before)
+    db_writes = statements - statements_before
+    posts = rows.get('posts', 0)
+
+    def per_post(value):
+        return round(value / posts, 3) if posts else None
+
+    return {
+            'phase' : name,
+            'wall_secs' : round(wall_secs, 3),
+            'api_calls' : api_calls,
+            'throttled' : counts['throttled'] - throttled_before,
+            'misses' : counts['misses'] - misses_before,
+            'db_writes' : db_writes,
+            'rows' : rows,
+            'posts' : posts,
+            'wall_secs_per_post' : per_post(wall_secs),
+            'api_calls_per_post' : per_post(api_calls),
+            'db_writes_per_post' : per_post(db_writes),
+            'report' : report,
+            'error' : error
+           }
+
+def main():
+    parser = argparse.ArgumentParser(description='Ingestion benchmark on recorded Reddit traffic', add_help=False)
+    parser.add_argument('cassette', help='cassette to replay, or record to with --record')
+    parser.add_argument('--record', action='store_true', help='proxy to Reddit and record instead of replaying')
+    parser.add_argument('--subs', default='', help='comma separated subreddits to ingest')
+    parser.add_argument('--posts', default='', help='comma separated post ids to ingest')
+    parser.add_argument('--authors', default='', help='comma separated authors whose comments to ingest')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file, stdout when not given')
+    args, replay_argv = parser.parse_known_args()
+
+    mode = '--record' if args.record else '--replay'
+    replay_args = reddit_replay.parse_args([mode, args.cassette, '--port', '0', '--seed', str(args.seed)] + replay_argv)
+    server = reddit_replay.make_server(replay_args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://{server.server_address[0]}:{server.server_address[1]}'
+    config_file = point_config_at(url)
+
+    # imported once the config points at the replay server, rollama
+    #  connects to Reddit on import
+    import rollama
+    from reddit_ingest import ingest_posts
+
+    writes = WriteCounter()
+    writes.install()
+    results = {
+               'cassette' : args.cassette,
+               'mode' : mode.strip('-'),
+               'replay' : vars(replay_args),
+               'phases' : []
+              }
+
+    try:
+        for sub in filter(None, args.subs.split(',')):
+            results['phases'].append(run_phase(f'subreddit {sub}', lambda sub=sub: rollama.get_sub_posts(sub), server, writes))
+        post_ids = list(filter(None, args.posts.split(',')))
+        if post_ids:
+            results['phases'].append(run_phase('posts', lambda: asyncio.run(ingest_posts(post_ids)), server, writes))
+        for author in filter(None, args.authors.split(',')):
+            results['phases'].append(run_phase(f'author {author}', lambda author=author: rollama.get_author_comments(author), server, writes))
+        results['replay_counts'] = server.replay.counts
+    finally:
+        server.shutdown()
+        os.unlink(config_file)
+
+    output = json.dumps(results, indent=2, default=str)
+    if args.output:
+        Path(args.output).write_text(output, encoding='utf-8')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""Offline stand-in for an Ollama server, for benchmarks and tests that must
+    not burn GPU time
+
+    Implements /api/chat (streamed and not), /api/generate (model load only),
+    /api/embed, /api/ps and /api/version. Prompt latency, token rate, response
+    length, model load delay and errors are drawn from configurable
+    distributions, seeded so runs are repeatable.
+
+    Run:
+        > ./tools/fake_ollama.py --port 11435 --latency-mean 0.2 --tokens-per-sec 40
+
+    then point OLLAMA_API_URL at http://localhost:11435
+
+   ©2024, Ovais Quraishi
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+NS_PER_SEC = 1000000000
+# Ollama's keep_alive when a request does not send one
+DEFAULT_KEEP_ALIVE_SECS = 300
+DURATION_UNITS = {'ms' : 0.001, 's' : 1, 'm' : 60, 'h' : 3600}
+WORDS = ('the model said that this post is about a thing people care about and '
+         'it is mostly positive with some concern about the details').split()
+
+
+def keep_alive_secs(keep_alive):
+    """Seconds a model stays loaded for a request's keep_alive, 300, "300s",
+        "5m" - negative is forever, 0 unloads
+    """
+
+    if keep_alive is None or keep_alive == '':
+        return DEFAULT_KEEP_ALIVE_SECS
+    if isinstance(keep_alive, str):
+        for unit in sorted(DURATION_UNITS, key=len, reverse=True):
+            if keep_alive.endswith(unit):
+                secs = float(keep_alive[:-len(unit)]) * DURATION_UNITS[unit]
+                break
+        else:
+            secs = float(keep_alive)
+    else:
+        secs = float(keep_alive)
+    return float('inf') if secs < 0 else secs
+
+
+class FakeOllama:
+    """Simulated model residency, latencies and failures
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.lock = threading.Lock()
+        # model name -> time its keep_alive runs out, most recently used last
+        self.loaded = {}
+        # Ollama serves OLLAMA_NUM_PARALLEL requests per model at once
+        self.slots = {}
+        self.counts = {'requests' : 0, 'errors' : 0, 'loads' : 0, 'unloads' : 0}
+
+    def draw(self, name):
+        """Sample one of the configured distributions
+        """
+
+        with self.lock:
+            if name == 'latency':
+                mean, sigma = self.args.latency_mean, self.args.latency_sigma
+                if self.args.latency_dist == 'fixed' or not sigma:
+                    return mean
+                if self.args.latency_dist == 'uniform':
+                    return max(self.random.uniform(mean - sigma, mean + sigma), 0.0)
+                # lognormal with the given mean
+                return self.random.lognormvariate(0, sigma) * mean / (2.718281828 ** (sigma * sigma / 2))
+            if name == 'tokens':
+                return max(int(self.random.gauss(self.args.tokens_mean, self.args.tokens_sigma)), 1)
+            if name == 'error':
+                return self.random.random() < self.args.error_rate
+        raise ValueError(name)
+
+    def expire(self):
+        """Drop models whose keep_alive ran out, call with the lock held
+        """
+
+        now = time.time()
+        for model in [model for model, expires_at in self.loaded.items() if expires_at <= now]:
+            del self.loaded[model]
+
+    def load(self, model, keep_alive=None):
+        """Load a model, evicting the least recently used one when over
+            --max-loaded, returns seconds spent loading
+        """
+
+        expires_at = time.time() + keep_alive_secs(keep_alive)
+        with self.lock:
+            self.expire()
+            if model in self.loaded:
+                self.loaded.pop(model)
+                self.loaded[model] = expires_at
+                return 0.0
+            while len(self.loaded) >= self.args.max_loaded:
+                self.loaded.pop(next(iter(self.loaded)))
+            self.loaded[model] = expires_at
+            self.slots.setdefault(model, threading.Semaphore(self.args.num_parallel))
+            self.counts['loads'] += 1
+        time.sleep(self.args.load_delay)
+        return self.args.load_delay
+
+    def unload(self, model):
+        with self.lock:
+            self.loaded.pop(model, None)
+            self.counts['unloads'] += 1
+
+    def ps(self):
+        def iso(expires_at):
+            if expires_at == float('inf'):
+                # as Ollama reports models kept loaded forever
+                return '2318-01-01T00:00:00+00:00'
+            return datetime.datetime.fromtimestamp(expires_at, tz=datetime.timezone.utc).isoformat()
+
+        with self.lock:
+            self.expire()
+            return {'models' : [{
+                                 'name' : model,
+                                 'model' : model,
+                                 'size' : 4000000000,
+                                 'digest' : hashlib.sha256(model.encode()).hexdigest(),
+                                 'details' : {'family' : 'fake', 'parameter_size' : '0B', 'quantization_level' : 'none'},
+                                 'expires_at' : iso(expires_at),
+                                 'size_vram' : 4000000000
+                                } for model, expires_at in self.loaded.items()]}
+
+
+class Handler(BaseHTTPRequestHandler):
+    """HTTP front end of FakeOllama
+    """
+
+    server_version = 'FakeOllama/0.1'
+
+    def log_message(self, format, *args):
+        if self.server.fake.args.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        fake = self.server.fake
+        if self.path == '/api/version':
+            self.send_json(200, {'version' : fake.args.version})
+        elif self.path == '/api/ps':
+            self.send_json(200, fake.ps())
+        elif self.path == '/fake/stats':
+            self.send_json(200, fake.counts)
+        else:
+            self.send_json(404, {'error' : f'{self.path} not found'})
+
+    def do_POST(self):
+        fake = self.server.fake
+        body = self.read_json()
+        with fake.lock:
+            fake.counts['requests'] += 1
+
+        if self.path in ('/api/chat', '/api/embed', '/api/generate') and fake.draw('error'):
+            with fake.lock:
+                fake.counts['errors'] += 1
+            self.send_json(fake.args.error_status, {'error' : 'injected error'})
+            return
+
+        if self.path == '/api/chat':
+            self.chat(body)
+        elif self.path == '/api/generate':
+            if keep_alive_secs(body.get('keep_alive')) == 0:
+                # a request without a prompt and keep_alive 0 unloads
+                fake.unload(body['model'])
+                load_duration = 0.0
+            else:
+                load_duration = fake.load(body['model'], body.get('keep_alive'))
+            self.send_json(200, {
+                                 'model' : body['model'],
+                                 'created_at' : datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+                                 'response' : '',
+                                 'done' : True,
+                                 'load_duration' : int(load_duration * NS_PER_SEC)
+                                })
+        elif self.path == '/api/embed':
+            fake.load(body['model'], body.get('keep_alive'))
+            inputs = body['input'] if isinstance(body['input'], list) else [body['input']]
+            self.send_json(200, {'model' : body['model'], 'embeddings' : [self.embedding(text) for text in inputs]})
+        else:
+            self.send_json(404, {'error' : f'{self.path} not found'})
+
+    def embedding(self, text):
+        """Deterministic pseudo embedding - equal texts get equal vectors
+        """
+
+        rng = random.Random(hashlib.sha256(text.encode()).hexdigest())
+        return [rng.uniform(-1, 1) for _ in range(self.server.fake.args.embed_dims)]
+
+    def chat(self, body):
+        fake = self.server.fake
+        model = body['model']
+        stream = body.get('stream', True)
+        num_predict = (body.get('options') or {}).get('num_predict') or 0
+        prompt_eval_count = sum(len(m.get('content', '').split()) for m in body.get('messages', []))
+
+        start = time.monotonic()
+        load_duration = fake.load(model, body.get('keep_alive'))
+        with fake.slots[model]:
+            prompt_eval_duration = fake.draw('latency')
+            time.sleep(prompt_eval_duration)
+
+            tokens = fake.draw('tokens')
+            if num_predict > 0:
+                tokens = min(tokens, num_predict)
+            per_token = 1 / fake.args.tokens_per_sec
+
+            if stream:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+
+            eval_start = time.monotonic()
+            content = []
+            try:
+                for i in range(tokens):
+                    time.sleep(per_token)
+                    token = WORDS[i % len(WORDS)] + ' '
+                    content.append(token)
+                    if stream:
+                        self.write_line(self.chunk(model, token))
+            except (BrokenPipeError, ConnectionResetError):
+                # client cancelled the generation
+                return
+            eval_duration = time.monotonic() - eval_start
+
+        final = self.chunk(model, '' if stream else ''.join(content))
+        final.update({
+                      'done' : True,
+                      'done_reason' : 'length' if num_predict and tokens >= num_predict else 'stop',
+                      'total_duration' : int((time.monotonic() - start) * NS_PER_SEC),
+                      'load_duration' : int(load_duration * NS_PER_SEC),
+                      'prompt_eval_count' : prompt_eval_count,
+                      'prompt_eval_duration' : int(prompt_eval_duration * NS_PER_SEC),
+                      'eval_count' : tokens,
+                      'eval_duration' : int(eval_duration * NS_PER_SEC)
+                     })
+        if stream:
+            try:
+                self.write_line(final)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            self.close_connection = True
+        else:
+            self.send_json(200, final)
+
+    def chunk(self, model, content):
+        return {
+                'model' : model,
+                'created_at' : datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+                'message' : {'role' : 'assistant', 'content' : content},
+                'done' : False
+               }
+
+    def write_line(self, body):
+        self.wfile.write(json.dumps(body).encode() + b'\n')
+        self.wfile.flush()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Fake Ollama server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--version', default='0.0.0-fake')
+    parser.add_argument('--latency-dist', choices=('fixed', 'uniform', 'lognormal'), default='lognormal',
+                        help='distribution of prompt eval latency')
+    parser.add_argument('--latency-mean', type=float, default=0.2, help='seconds')
+    parser.add_argument('--latency-sigma', type=float, default=0.5)
+    parser.add_argument('--tokens-per-sec', type=float, default=50.0)
+    parser.add_argument('--tokens-mean', type=float, default=64)
+    parser.add_argument('--tokens-sigma', type=float, default=16)
+    parser.add_argument('--load-delay', type=float, default=2.0, help='seconds to load a model')
+    parser.add_argument('--max-loaded', type=int, default=1, help='models resident at once')
+    parser.add_argument('--num-parallel', type=int, default=4, help='concurrent requests per model')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests that fail')
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--embed-dims', type=int, default=768)
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args(argv)
+
+def make_server(args):
+    """Build, but do not start, a fake Ollama server
+    """
+
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    server.fake = FakeOllama(args)
+    return server
+
+if __name__ == '__main__':
+    fake_server = make_server(parse_args())
+    print(f'Fake Ollama listening on http://{fake_server.server_address[0]}:{fake_server.server_address[1]}')
+    try:
+        fake_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
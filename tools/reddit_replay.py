@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""Record and replay Reddit API traffic, for benchmarks and tests that must
+    not depend on a live Reddit account or its rate limits
+
+    record: a proxy in front of oauth.reddit.com and www.reddit.com, every
+    exchange it forwards is appended to a cassette, one JSON object a line.
+    Credentials and access tokens are not recorded.
+
+    replay: answers from the cassette. Requests are matched on method, path,
+    query and - for POSTs - form body; a request recorded more than once gets
+    its answers in recorded order, the last one repeating. Latency and 429
+    Too Many Requests answers are injected from seeded distributions, so runs
+    are repeatable. Unrecorded requests get a 404 and are counted as misses.
+
+    Run:
+        > ./tools/reddit_replay.py --record reddit.cassette --port 8081
+        > ./tools/reddit_replay.py --replay reddit.cassette --port 8081 --latency-mean 0.3 --throttle-rate 0.02
+
+    then set reddit_oauth_url and reddit_url to http://localhost:8081
+
+   ©2024, Ovais Quraishi
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+
+TOKEN_PATH = '/api/v1/access_token'
+REPLAY_TOKEN = {'access_token' : 'replay-token', 'expires_in' : 86400, 'scope' : '*', 'token_type' : 'bearer'}
+# answer headers worth keeping, the rest describe the recording connection
+KEPT_HEADERS = ('content-type',)
+
+
+def request_key(method, path, query, body=b''):
+    """Cassette key of a request, independent of parameter order
+    """
+
+    key = {'method' : method, 'path' : path.rstrip('/') or '/', 'query' : sorted(parse_qsl(query))}
+    if method == 'POST' and path != TOKEN_PATH:
+        key['body'] = sorted(parse_qsl(body.decode('utf-8', 'replace')))
+    return json.dumps(key, sort_keys=True)
+
+
+class Cassette:
+    """Recorded exchanges by request key
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.exchanges = {}
+        self.served = {}
+
+    def load(self):
+        with open(self.path, 'r', encoding='utf-8') as cassette_file:
+            for line in cassette_file:
+                if line.strip():
+                    exchange = json.loads(line)
+                    self.exchanges.setdefault(exchange['key'], []).append(exchange)
+        return self
+
+    def record(self, key, status, headers, body):
+        exchange = {'key' : key, 'status' : status, 'headers' : headers, 'body' : body}
+        with self.lock:
+            self.exchanges.setdefault(key, []).append(exchange)
+            with open(self.path, 'a', encoding='utf-8') as cassette_file:
+                cassette_file.write(json.dumps(exchange) + '\n')
+
+    def next(self, key):
+        """Next recorded answer to a request, None if it was never recorded
+        """
+
+        with self.lock:
+            exchanges = self.exchanges.get(key)
+            if not exchanges:
+                return None
+            index = self.served.get(key, 0)
+            self.served[key] = index + 1
+            return exchanges[min(index, len(exchanges) - 1)]
+
+
+class RedditReplay:
+    """Recording proxy or replaying stand-in, with injected latency and
+        throttling
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.cassette = Cassette(args.record or args.replay)
+        if args.replay:
+            self.cassette.load()
+        self.upstream = requests.Session()
+        self.counts = {'requests' : 0, 'tokens' : 0, 'replayed' : 0, 'recorded' : 0, 'misses' : 0, 'throttled' : 0, 'by_path' : {}}
+
+    def count(self, field, path=None):
+        with self.lock:
+            self.counts[field] += 1
+            if path:
+                # ids vary, the endpoint is the first two path segments
+                endpoint = '/'.join(path.split('/')[:3])
+                self.counts['by_path'][endpoint] = self.counts['by_path'].get(endpoint, 0) + 1
+
+    def draw(self, name):
+        """Sample one of the configured distributions
+        """
+
+        with self.lock:
+            if name == 'latency':
+                mean, sigma = self.args.latency_mean, self.args.latency_sigma
+                if not mean:
+                    return 0.0
+                if self.args.latency_dist == 'fixed' or not sigma:
+                    return mean
+                if self.args.latency_dist == 'uniform':
+                    return max(self.random.uniform(mean - sigma, mean + sigma), 0.0)
+                return self.random.lognormvariate(0, sigma) * mean
+            return self.random.random() < self.args.throttle_rate
+
+    def forward(self, method, path, query, headers, body):
+        """Send a request on to Reddit
+
+            Returns:
+                tuple: (status, headers, body text)
+        """
+
+        base = self.args.upstream_www if path == TOKEN_PATH else self.args.upstream_oauth
+        url = base.rstrip('/') + path + (f'?{query}' if query else '')
+        forwarded = {k: v for k, v in headers.items() if k.lower() in ('authorization', 'user-agent', 'content-type')}
+        response = self.upstream.request(method, url, headers=forwarded, data=body or None,
+                                         timeout=self.args.upstream_timeout, allow_redirects=False)
+        kept = {k.lower(): v for k, v in response.headers.items() if k.lower() in KEPT_HEADERS}
+        return response.status_code, kept, response.text
+
+    def ratelimit_headers(self):
+        return {
+                'x-ratelimit-remaining' : str(self.args.ratelimit_remaining),
+                'x-ratelimit-used' : '0',
+                'x-ratelimit-reset' : str(self.args.ratelimit_reset)
+               }
+
+
+class Handler(BaseHTTPRequestHandler):
+    """HTTP front end of RedditReplay
+    """
+
+    server_version = 'RedditReplay/0.1'
+
+    def log_message(self, format, *args):
+        if self.server.replay.args.verbose:
+            super().log_message(format, *args)
+
+    def send(self, status, headers, body):
+        payload = body.encode() if isinstance(body, str) else body
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_json(self, status, body, headers=None):
+        self.send(status, {'Content-Type' : 'application/json', **(headers or {})}, json.dumps(body))
+
+    def do_GET(self):
+        if self.path == '/replay/stats':
+            self.send_json(200, self.server.replay.counts)
+        else:
+            self.handle_api('GET')
+
+    def do_POST(self):
+        self.handle_api('POST')
+
+    def handle_api(self, method):
+        replay = self.server.replay
+        parts = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        key = request_key(method, parts.path, parts.query, body)
+        replay.count('requests', parts.path)
+        if parts.path == TOKEN_PATH:
+            replay.count('tokens')
+
+        if replay.args.record:
+            status, headers, text = replay.forward(method, parts.path, parts.query, self.headers, body)
+            # never write a live token to disk, replay makes up its own
+            if parts.path != TOKEN_PATH:
+                replay.cassette.record(key, status, headers, text)
+                replay.count('recorded')
+            self.send(status, headers, text)
+            return
+
+        if parts.path == TOKEN_PATH:
+            self.send_json(200, REPLAY_TOKEN)
+            return
+
+        time.sleep(replay.draw('latency'))
+        if replay.draw('throttle'):
+            replay.count('throttled')
+            self.send_json(429, {'message' : 'Too Many Requests', 'error' : 429},
+                           {**replay.ratelimit_headers(), 'x-ratelimit-remaining' : '0', 'retry-after' : str(replay.args.ratelimit_reset)})
+            return
+
+        exchange = replay.cassette.next(key)
+        if exchange is None:
+            replay.count('misses')
+            self.send_json(404, {'message' : 'Not Found', 'error' : 404})
+            return
+
+        replay.count('replayed')
+        self.send(exchange['status'], {**exchange['headers'], **replay.ratelimit_headers()}, exchange['body'])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Reddit API record and replay server')
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument('--record', metavar='CASSETTE', help='proxy to Reddit, appending exchanges to CASSETTE')
+    mode.add_argument('--replay', metavar='CASSETTE', help='answer from CASSETTE')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--upstream-oauth', default='https://oauth.reddit.com')
+    parser.add_argument('--upstream-www', default='https://www.reddit.com')
+    parser.add_argument('--upstream-timeout', type=float, default=16.0)
+    parser.add_argument('--latency-dist', choices=('fixed', 'uniform', 'lognormal'), default='lognormal',
+                        help='distribution of replayed answer latency')
+    parser.add_argument('--latency-mean', type=float, default=0.0, help='seconds')
+    parser.add_argument('--latency-sigma', type=float, default=0.5)
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of requests answered 429')
+    parser.add_argument('--ratelimit-remaining', type=int, default=1000,
+                        help='x-ratelimit-remaining sent with every answer')
+    parser.add_argument('--ratelimit-reset', type=int, default=60, help='seconds')
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args(argv)
+
+def make_server(args):
+    """Build, but do not start, a record or replay server
+    """
+
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    server.replay = RedditReplay(args)
+    return server
+
+if __name__ == '__main__':
+    replay_server = make_server(parse_args())
+    mode = 'Recording to' if replay_server.replay.args.record else 'Replaying'
+    print(f'{mode} {replay_server.replay.cassette.path} on http://{replay_server.server_address[0]}:{replay_server.server_address[1]}')
+    try:
+        replay_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
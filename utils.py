@@ -16,23 +16,6 @@ from datetime import datetime as DT
 import database
 import logit
 
-# substrings to be replaced
-TBR = ["As an AI language model, I don't have personal preferences or feelings. However,",
-       "As an AI language model, I don't have personal preferences or opinions, but ",
-       "I'm sorry to hear you're feeling that way! As an AI language model, I don't have access to real-time information on Hypmic or its future plans. However,",
-       "As an AI language model, I don't have personal beliefs or experiences. However,",
-       "I'm just an AI, I don't have personal beliefs or opinions, and I cannot advocate for or against any particular religion. However,",
-       "As an AI, I don't have real-time information on specific individuals or their projects. However,"
-      ]
-
-def sanitize_string(a_string):
-    """Search and replace AI model related text in strings"""
-
-    for i in TBR:
-        if i in a_string:
-            a_string = a_string.replace(i,'FWIW - ')
-    return a_string
-
 def unix_ts_str():
     """Unix time as a string"""
 
@@ -110,7 +93,7 @@ def get_vals_list_of_dicts(dict_key, list_of_dicts):
 
     return vals
 
-def get_model_from_list(name):
+def get_model_from_list(name, host=None):
     """Retrieve a model from a list of dictionaries based on the provided name.
     """
 
@@ -120,7 +103,7 @@ def get_model_from_list(name):
     else:
         actual_name = name+':latest'
 
-    dicts = get_model_info()
+    dicts = get_model_info(host)
     # find the matching dictionary
     for model in dicts:
         if model['name'] == actual_name:
@@ -135,14 +118,18 @@ def calculate_prompt_completion_time(start_time, end_time):
 
     return int(end_time - start_time)
 
-def get_semver():
+def get_semver(host=None, timeout=None):
     """Hit the API endpoint for semantic version.
     """
 
-    host = os.environ['OLLAMA_API_URL']
+    host = host or os.environ['OLLAMA_API_URL']
     url = f"{host}/api/version"
 
-    response = requests.get(url)
+    try:
+        response = requests.get(url, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        logging.error('Failed to get SemVer from %s %s', host, e)
+        return False
 
     # check if the GET request was successful
     if response.status_code == 200:
@@ -155,14 +142,14 @@ def get_semver():
         logging.error('Failed to get SemVer. Status code: %s', {response.status_code})
         return False
 
-def get_model_info():
+def get_model_info(host=None, timeout=None):
     """Retrieve model information from a specified API endpoint.
     """
     
-    host = os.environ['OLLAMA_API_URL']
+    host = host or os.environ['OLLAMA_API_URL']
     url = f"{host}/api/ps" # API URL for getting models
 
-    response = requests.get(url)
+    response = requests.get(url, timeout=timeout)
     
     response.raise_for_status()
     
@@ -170,15 +157,33 @@ def get_model_info():
     
     return models
 
+def prewarm_model(llm, keep_alive, host=None, timeout=None):
+    """Load a model ahead of use and keep it loaded for keep_alive.
+        Returns the load duration in seconds, False on failure.
+    """
+
+    host = host or os.environ['OLLAMA_API_URL']
+    url = f"{host}/api/generate" # a request without a prompt only loads the model
+
+    try:
+        response = requests.post(url, json={'model' : llm, 'keep_alive' : keep_alive, 'stream' : False}, timeout=timeout)
+        response.raise_for_status()
+        return response.json().get('load_duration', 0) / 1000000000
+    except requests.exceptions.RequestException as e:
+        error_message = f'Unable to prewarm {llm} on {host} {e}'
+        logging.error(error_message)
+        logit.log_message_to_db(os.environ['SRVC_NAME'], logit.get_rollama_version()['version'], 'ERROR', error_message)
+        return False
+
 def store_model_perf_info(llm, analyzed_obj, prompt_completion_time):
     """Store model performance information into a database table.
     """
     
     try:
-        model_info_obj = get_model_from_list(llm)
+        model_info_obj = get_model_from_list(llm, analyzed_obj.get('ollama_host'))
         prompt_completion_info_obj = {
                                        'doc_shasum_512' : analyzed_obj['shasum_512'],
-                                       'ollama_host' : '',
+                                       'ollama_host' : analyzed_obj.get('ollama_host', ''),
                                        'ollama_ver'  : analyzed_obj['ollama_ver'],
                                        'name' : model_info_obj['name'],
                                        'model' : model_info_obj['model'],
@@ -188,7 +193,15 @@ def store_model_perf_info(llm, analyzed_obj, prompt_completion_time):
                                        'expires_at' : model_info_obj['expires_at'],
                                        'size_vram' : model_info_obj['size_vram'],
                                        'prompt_completion_time' : prompt_completion_time,
-                                       'tokens_per_second' : analyzed_obj['tokens_per_second']
+                                       'tokens_per_second' : analyzed_obj['tokens_per_second'],
+                                       'input_tokens_estimate' : analyzed_obj.get('input_tokens_estimate'),
+                                       'time_to_first_token' : analyzed_obj['time_to_first_token'],
+                                       'load_duration' : analyzed_obj['load_duration'],
+                                       'prompt_eval_count' : analyzed_obj['prompt_eval_count'],
+                                       'prompt_eval_duration' : analyzed_obj['prompt_eval_duration'],
+                                       'eval_count' : analyzed_obj['eval_count'],
+                                       'eval_duration' : analyzed_obj['eval_duration'],
+                                       'completion_truncated' : analyzed_obj['completion_truncated']
                                      }
         database.insert_data_into_table('prompt_completion_details', prompt_completion_info_obj)
     except Exception as e: